@@ -46,6 +46,14 @@ const char nr_of_controlled_motors = 2;
 const char nr_of_motors = nr_of_coordinated_motors + nr_of_controlled_motors;
 const char homing_max_following_motors = nr_of_controlled_motors - 1;
 
+//the serial line starts with this baud rate - the server can switch to a faster one
+#define DEFAULT_BAUD_RATE 38400
+//how long a new baud rate has to be confirmed before we fall back to the default
+#define BAUD_RATE_CONFIRMATION_TIME 3000
+
+//if there is space in the queue again the server is told early - but not more often than every x ms
+#define QUEUE_STATUS_INTERVAL 20
+
 //how much space do we have to store commands
 #define COMMAND_QUEUE_LENGTH 40
 
@@ -104,6 +112,10 @@ TMC4361_info motors[nr_of_coordinated_motors] = {
 
 //how many otors can be theoretically geared together
 #define MAX_FOLLOWING_MOTORS (nr_of_motors-1)
+//motor, target, type, vMax, aMax, jerk
+#define BINARY_MOVE_MOTOR_LENGTH 18
+//length, number of motors, the motors, checksum
+#define BINARY_MOVE_MAX_FRAME_LENGTH (3+nr_of_motors*BINARY_MOVE_MOTOR_LENGTH)
 
 
 motion_state current_motion_state = no_motion;
@@ -164,7 +176,7 @@ void setup() {
   analogReference(EXTERNAL);
 
   //initialize the serial port for commands
-  Serial1.begin(38400);
+  Serial1.begin(DEFAULT_BAUD_RATE);
   Serial.begin(115200);
 
   //at least we should try deactivate the motion drivers
@@ -195,19 +207,30 @@ void setup() {
 }
 
 unsigned long last_millis=0;
+//the longest queue since the last keep alive - if it gets shorter the server wants to know
+int reported_queue_count=0;
+//when a switched baud rate has to be confirmed, 0 if there is nothing to confirm
+unsigned long baud_rate_confirmation_deadline=0;
 
 void loop() {
   //move if neccessary
   checkMotion();
   // Process incoming serial data, and perform callbacks
   messenger.feedinSerialData();
+  //fall back if a new baud rate does not work
+  checkBaudRate();
 
-  if (millis()-last_millis>1000) {
+  int queue_count = moveQueue.count();
+  if (queue_count>reported_queue_count) {
+    reported_queue_count = queue_count;
+  }
+  if (millis()-last_millis>1000 || (queue_count<reported_queue_count && millis()-last_millis>QUEUE_STATUS_INTERVAL)) {
 #ifdef RX_TX_BLINKY
     TXLED1;
 #endif
     watchDogPing();
     last_millis=millis();
+    reported_queue_count = queue_count;
 #ifdef RX_TX_BLINKY
     TXLED0;
 #endif
@@ -14,10 +14,13 @@ enum {
   kMovement = 11, //controls if a new movement is started or a running one is stopped
   kHome=12, //Home one axis
   kSetPos = 13, //set an axis position
+  kBinaryMove = 14, //like kMove but as binary frame - see onBinaryMove
+  kBaudRate = 15, //switch the serial line to another baud rate - see onBaudRate
   //Kommandos zur Information
   kPos = 30,
   kCommands = 31,
   kStatus = 32,
+  kStatusAll = 33, //the status of several motors at once - see onStatusAll
   //weiteres
   kCurrentReading = 41,
   // direkter SPI-Zugriff
@@ -41,10 +44,13 @@ void attachCommandCallbacks() {
   messenger.attach(kEndStops,onConfigureEndStop);
   messenger.attach(kInvertMotor,onInvertMotor);
   messenger.attach(kMove, onMove);
+  messenger.attach(kBinaryMove, onBinaryMove);
+  messenger.attach(kBaudRate, onBaudRate);
   messenger.attach(kMovement, onMovement);
   messenger.attach(kSetPos, onSetPosition);
   messenger.attach(kPos, onPosition);
   messenger.attach(kStatus, onStatus);
+  messenger.attach(kStatusAll, onStatusAll);
   messenger.attach(kHome, onHome);
   messenger.attach(kCommands, onCommands);
 //  messenger.attach(kCurrentReading, onCurrentReading);
@@ -62,6 +68,8 @@ void OnUnknownCommand() {
 }
 
 void onInit() {
+  //1 asks if we understand binary moves
+  char binary_moves = messenger.readIntArg();
   //initialize the 43x
   initialzeTMC4361();
   //start the tmc260 driver
@@ -74,8 +82,13 @@ void onInit() {
   while(!moveQueue.isEmpty()) {
     moveQueue.pop();
   }
-  //and we are done here
-  messenger.sendCmd(kOK,0);
+  //and we are done here - telling if we can handle binary moves
+  if (binary_moves==1) {
+    messenger.sendCmd(kOK,1);
+  } 
+  else {
+    messenger.sendCmd(kOK,0);
+  }
 }
 
 //Motor Strom einstellen
@@ -253,11 +266,93 @@ void onMove() {
 #ifdef DEBUG_MOTOR_QUEUE
   Serial.println();
 #endif
+  queueMovements(&move, followers, following_motors);
+#ifdef RX_TX_BLINKY_1
+  RXLED0;
+#endif
+
+} 
+
+/*
+ a binary move is a single argument: the frame 
+ length | number of motors | motor, target, type, vMax, aMax, jerk for every motor | checksum
+ all values little endian (long, float), COBS encoded so that there is no 0 and escaped for the messenger
+ */
+void onBinaryMove() {
+#ifdef RX_TX_BLINKY_1
+  RXLED1;
+#endif
+  char* encoded_frame = messenger.readStringArg();
+  messenger.unescape(encoded_frame);
+  unsigned char frame[BINARY_MOVE_MAX_FRAME_LENGTH];
+  int frame_length = cobsDecode((unsigned char*)encoded_frame, strlen(encoded_frame), frame, BINARY_MOVE_MAX_FRAME_LENGTH);
+  if (frame_length<3 || frame[0]!=frame_length-2) {
+    messenger.sendCmd(kError,-7);
+    return;
+  }
+  unsigned char checksum = 0;
+  for (int i=0; i<frame_length-1; i++) {
+    checksum += frame[i];
+  }
+  if (checksum!=frame[frame_length-1]) {
+    messenger.sendCmd(kError,-8);
+    return;
+  }
+  unsigned char motor_count = frame[1];
+  if (motor_count<1 || motor_count>nr_of_motors || frame[0]!=1+motor_count*BINARY_MOVE_MOTOR_LENGTH) {
+    messenger.sendCmd(kError,-7);
+    return;
+  }
+  movement move;
+  movement followers[MAX_FOLLOWING_MOTORS];
+  unsigned char* motor_data = frame+2;
+  for (char i=0; i<motor_count; i++) {
+    char motor = motor_data[0];
+    if (motor<1 || motor>nr_of_motors) {
+      messenger.sendCmdStart(kError);
+      messenger.sendCmdArg(motor,DEC);
+      messenger.sendCmdArg(1,DEC);
+      messenger.sendCmdArg(nr_of_motors,DEC);
+      messenger.sendCmdEnd();
+      return;
+    }
+    long target;
+    float vMax;
+    float aMax;
+    long jerk;
+    memcpy(&target, motor_data+1, 4);
+    char movementType = motor_data[5];
+    memcpy(&vMax, motor_data+6, 4);
+    memcpy(&aMax, motor_data+10, 4);
+    memcpy(&jerk, motor_data+14, 4);
+    movement* current_move;
+    if (i==0) {
+      current_move = &move;
+      current_move->type = move_to;
+    } 
+    else {
+      current_move = &followers[i-1];
+      current_move->type = follow_to;
+    }
+    current_move->motor = motor - 1;
+    if (setMovementParameters(current_move, target, movementType, vMax, aMax, jerk)) {
+      //if there was an error return 
+      return;
+    }
+    motor_data += BINARY_MOVE_MOTOR_LENGTH;
+  }
+  queueMovements(&move, followers, motor_count-1);
+#ifdef RX_TX_BLINKY_1
+  RXLED0;
+#endif
+}
+
+void queueMovements(movement* move, movement* followers, int following_motors) {
   if (moveQueue.count()+following_motors+1>COMMAND_QUEUE_LENGTH) {
     messenger.sendCmd(kError,-100);
     return;
   }
-  moveQueue.push(move);
+  moveQueue.push(*move);
   for (char i=0; i<following_motors; i++) {
     moveQueue.push(followers[i]);
   }
@@ -272,16 +367,18 @@ void onMove() {
     messenger.sendCmdArg(-1);
   }
   messenger.sendCmdEnd();
-#ifdef RX_TX_BLINKY_1
-  RXLED0;
-#endif
-
-} 
+}
 
 char readMovementParameters(movement* move) {
   long newPos = messenger.readLongArg();
-
   char movementType = (char)messenger.readIntArg();
+  double vMax = messenger.readFloatArg();
+  double aMax = messenger.readFloatArg();
+  long jerk = messenger.readLongArg();
+  return setMovementParameters(move, newPos, movementType, vMax, aMax, jerk);
+}
+
+char setMovementParameters(movement* move, long newPos, char movementType, double vMax, double aMax, long jerk) {
   boolean isWaypoint;
   if (movementType == 's') {
     //the movement is no waypoint  we do not have to do anything
@@ -303,17 +400,14 @@ char readMovementParameters(movement* move) {
     //isWaypoint = false;
 
   }  
-  double vMax = messenger.readFloatArg();
   if (vMax<=0) {
     messenger.sendCmd (kError,-3);
     return -4;
   }
-  double aMax = messenger.readFloatArg();
   if (aMax<=0) {
     messenger.sendCmd(kError,-4);
     return -5;
   }
-  long jerk = messenger.readLongArg();
   if (jerk<0) {
     messenger.sendCmd (kError,-5); 
     return -6;
@@ -480,6 +574,72 @@ void onStatus() {
   char stopl, stopr;
   char motor = decodeMotorNumber(true);
   
+  if (!readMotorStatus(motor, &status, &position, &encoder_pos, &stopl, &stopr)) {
+    return;
+  }
+
+  messenger.sendCmdStart(kStatus);
+  messenger.sendCmdArg(status);
+  messenger.sendCmdArg(position);
+  messenger.sendCmdArg((int)stopl);
+  messenger.sendCmdArg((int)stopr);
+  messenger.sendCmdArg(encoder_pos);
+  messenger.sendCmdEnd();
+}
+
+/*
+ reports the status of all given motors (or of all motors if none is given) in one reply:
+ for every motor: motor number, position, encoder position, left & right end stop
+ */
+void onStatusAll() {
+  char motors[nr_of_motors];
+  char motor_count = 0;
+  int motor;
+  do {
+    motor = messenger.readIntArg();
+    if (motor!=0) {
+      if (motor<1 || motor>nr_of_motors || motor_count>=nr_of_motors) {
+        messenger.sendCmdStart(kError);
+        messenger.sendCmdArg(motor,DEC);
+        messenger.sendCmdArg(1,DEC);
+        messenger.sendCmdArg(nr_of_motors,DEC);
+        messenger.sendCmdEnd();
+        return;
+      }
+      motors[motor_count++] = motor - 1;
+    }
+  } 
+  while (motor!=0);
+  if (motor_count==0) {
+    for (char i=0; i<nr_of_motors; i++) {
+      motors[motor_count++] = i;
+    }
+  }
+
+  unsigned long status;
+  long position;
+  long encoder_pos;
+  char stopl, stopr;
+  messenger.sendCmdStart(kStatusAll);
+  for (char i=0; i<motor_count; i++) {
+    if (readMotorStatus(motors[i], &status, &position, &encoder_pos, &stopl, &stopr)) {
+      messenger.sendCmdArg(motors[i]+1,DEC);
+      messenger.sendCmdArg(position);
+      messenger.sendCmdArg(encoder_pos);
+      messenger.sendCmdArg((int)stopl);
+      messenger.sendCmdArg((int)stopr);
+    }
+  }
+  messenger.sendCmdEnd();
+}
+
+//reads the status of one motor (0 based), returns false if there is no such motor
+boolean readMotorStatus(char motor, unsigned long* status_out, long* position_out, long* encoder_pos_out, char* stopl_out, char* stopr_out) {
+  unsigned long status;
+  long position;
+  long encoder_pos;
+  char stopl, stopr;
+
   switch (motor) {
     case 0:
     case 1:
@@ -505,7 +665,7 @@ void onStatus() {
       break;
 
     default:
-      return;  
+      return false;  
   }
 
   switch (motor) {
@@ -541,16 +701,15 @@ void onStatus() {
       break;
 
     default:
-      return;  
+      return false;  
   }
 
-  messenger.sendCmdStart(kStatus);
-  messenger.sendCmdArg(status);
-  messenger.sendCmdArg(position);
-  messenger.sendCmdArg((int)stopl);
-  messenger.sendCmdArg((int)stopr);
-  messenger.sendCmdArg(encoder_pos);
-  messenger.sendCmdEnd();
+  *status_out = status;
+  *position_out = position;
+  *encoder_pos_out = encoder_pos;
+  *stopl_out = stopl;
+  *stopr_out = stopr;
+  return true;
   
 /*
   if (motor<0) {
@@ -773,6 +932,36 @@ void onHome() {
   }
 }
 
+/*
+ a baud rate switches the serial line after the acknowledgement, 0 confirms that the new baud rate works
+ if it is not confirmed in time we fall back to the default baud rate - see checkBaudRate
+ */
+void onBaudRate() {
+  long baud_rate = messenger.readLongArg();
+  if (baud_rate==0) {
+    baud_rate_confirmation_deadline = 0;
+    messenger.sendCmd(kOK,0);
+    return;
+  }
+  if (baud_rate<DEFAULT_BAUD_RATE) {
+    messenger.sendCmd(kError,-1);
+    return;
+  }
+  messenger.sendCmd(kOK,baud_rate);
+  //wait until the acknowledgement is out
+  Serial1.flush();
+  Serial1.begin(baud_rate);
+  baud_rate_confirmation_deadline = millis()+BAUD_RATE_CONFIRMATION_TIME;
+}
+
+void checkBaudRate() {
+  if (baud_rate_confirmation_deadline!=0 && millis()>baud_rate_confirmation_deadline) {
+    //nobody understood us - back to the baud rate everybody knows
+    Serial1.begin(DEFAULT_BAUD_RATE);
+    baud_rate_confirmation_deadline = 0;
+  }
+}
+
 void onCommands() {
   messenger.sendCmdStart(kCommands);
   messenger.sendCmdArg(moveQueue.count());
@@ -947,6 +1136,32 @@ void watchDogStart() {
   watchDogPing();
 }
 
+//decodes consistent overhead byte stuffing, returns the decoded length or -1 if it is broken
+int cobsDecode(const unsigned char* input, int length, unsigned char* output, int max_length) {
+  int read_index = 0;
+  int write_index = 0;
+  while (read_index < length) {
+    unsigned char code = input[read_index];
+    if (code==0 || read_index+code>length) {
+      return -1;
+    }
+    read_index++;
+    for (unsigned char i=1; i<code; i++) {
+      if (write_index>=max_length) {
+        return -1;
+      }
+      output[write_index++] = input[read_index++];
+    }
+    if (code!=0xFF && read_index!=length) {
+      if (write_index>=max_length) {
+        return -1;
+      }
+      output[write_index++] = 0;
+    }
+  }
+  return write_index;
+}
+
 char decodeMotorNumber(const boolean complaint) {
   char motor = messenger.readIntArg();
   if (motor<1) {
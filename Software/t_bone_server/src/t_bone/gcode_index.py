@@ -0,0 +1,288 @@
+# coding=utf-8
+from bisect import bisect_right
+from collections import namedtuple
+import logging
+import mmap
+import os
+import re
+import struct
+
+from gcode_tokenizer import tokenize_gcode_line, X_WORD, Y_WORD, Z_WORD, E_WORD, F_WORD, S_WORD
+
+__author__ = 'marcus'
+_logger = logging.getLogger(__name__)
+
+# the index is stored next to the g code:
+# header | every nth line | z changes | layer comments | modal states
+INDEX_FILE_EXTENSION = '.index'
+_index_magic = 'TBI\x03'
+# magic, source size & source modification time, line interval, number of lines
+_header = struct.Struct('<4sQdIQ')
+_count = struct.Struct('<I')
+# line number, offset
+_line_entry = struct.Struct('<QQ')
+# line number, offset, z height
+_z_entry = struct.Struct('<QQd')
+# offset, the modal state before it - see ModalState
+_state_entry = struct.Struct('<Qddqddddd3s3s3s')
+_default_line_interval = 1000
+_read_buffer_size = 1024 * 1024
+# ';LAYER:3' (Cura), ';LAYER_CHANGE' (Slic3r), '; layer 3, Z = 0.3' (Simplify3D) - but not header lines like
+# '; layer_height = 0.2' or ';LAYER_COUNT:42'
+_layer_comment_pattern = re.compile(r';\s*(layer:\s*-?\d+|layer_change\s*$|layer\s+\d+)', re.IGNORECASE)
+_axis_words = (('x', X_WORD), ('y', Y_WORD), ('z', Z_WORD), ('e', E_WORD))
+_temperature_codes = {'M104': 'extruder_temperature', 'M109': 'extruder_temperature',
+                      'M140': 'bed_temperature', 'M190': 'bed_temperature'}
+_mode_codes = {'G20': 'units', 'G21': 'units', 'G90': 'positioning', 'G91': 'positioning',
+               'M82': 'extruder_mode', 'M83': 'extruder_mode'}
+
+# everything a print starting at a layer has to restore - None if the g code has not set it before.
+# home_words are the words of the G28s so far (0 is all axes), f is the last feedrate, x/y/z/e the last position
+# and units, positioning & extruder_mode the last g code setting them
+ModalState = namedtuple('ModalState', ['extruder_temperature', 'bed_temperature', 'home_words', 'f', 'x', 'y', 'z',
+                                       'e', 'units', 'positioning', 'extruder_mode'])
+# how the unknown values are stored in the index
+_unknown_state_values = (float('nan'), float('nan'), -1, float('nan'), float('nan'), float('nan'), float('nan'),
+                         float('nan'), '', '', '')
+UNKNOWN_STATE = ModalState(*([None] * len(ModalState._fields)))
+
+
+def index_file_name(gcode_file):
+    return gcode_file + INDEX_FILE_EXTENSION
+
+
+def _source_signature(gcode_file):
+    stat = os.stat(gcode_file)
+    return stat.st_size, stat.st_mtime
+
+
+class GCodeIndex(object):
+    def __init__(self, source_signature, line_interval, line_count, lines, z_changes, layer_comments, states):
+        self.source_signature = source_signature
+        self.line_interval = line_interval
+        self.line_count = line_count
+        # (line number, offset) of every line_interval-th line
+        self.lines = lines
+        # (line number, offset, z) of every change of z
+        self.z_changes = z_changes
+        # (line number, offset) of every layer comment
+        self.layer_comments = layer_comments
+        # if the slicer marks the layers we trust it, else every new z is a new layer
+        if layer_comments:
+            self.layers = layer_comments
+        else:
+            self.layers = [(line_number, offset) for line_number, offset, z in z_changes]
+        self._layer_offsets = [offset for line_number, offset in self.layers]
+        # (offset, modal state) at every change of z and every layer comment
+        self.states = states
+        self._states_by_offset = dict(states)
+
+    def layer_offset(self, layer):
+        # the layers are counted from 1
+        if layer < 1 or layer > len(self.layers):
+            raise IndexError("There is no layer %s, only %s" % (layer, len(self.layers)))
+        return self.layers[layer - 1][1]
+
+    def layer_state(self, layer):
+        # the modal state before the first line of the layer
+        return self._states_by_offset.get(self.layer_offset(layer), UNKNOWN_STATE)
+
+    def layer_at(self, offset):
+        # 0 is everything before the first layer
+        return bisect_right(self._layer_offsets, offset)
+
+    def line_offset(self, line_number):
+        # the offset of the indexed line at or before line_number
+        entry = bisect_right(self.lines, (line_number, float('inf'))) - 1
+        if entry < 0:
+            return 0, 0
+        return self.lines[entry]
+
+    def write(self, index_file):
+        temporary_file = index_file + '.tmp'
+        with open(temporary_file, 'wb') as index_output:
+            source_size, source_mtime = self.source_signature
+            index_output.write(_header.pack(_index_magic, source_size, source_mtime, self.line_interval,
+                                            self.line_count))
+            for entries, entry_struct in ((self.lines, _line_entry),
+                                          (self.z_changes, _z_entry),
+                                          (self.layer_comments, _line_entry)):
+                index_output.write(_count.pack(len(entries)))
+                for entry in entries:
+                    index_output.write(entry_struct.pack(*entry))
+            index_output.write(_count.pack(len(self.states)))
+            for offset, state in self.states:
+                index_output.write(_state_entry.pack(offset, *_encode_state(state)))
+        os.rename(temporary_file, index_file)
+
+    @classmethod
+    def read(cls, index_file):
+        with open(index_file, 'rb') as index_input:
+            data = index_input.read()
+        if len(data) < _header.size:
+            raise GCodeIndexError("Index too short")
+        magic, source_size, source_mtime, line_interval, line_count = _header.unpack_from(data)
+        if magic != _index_magic:
+            raise GCodeIndexError("Not a g code index")
+        offset = _header.size
+        sections = []
+        for entry_struct in (_line_entry, _z_entry, _line_entry, _state_entry):
+            try:
+                entry_count = _count.unpack_from(data, offset)[0]
+                offset += _count.size
+                entries = [entry_struct.unpack_from(data, offset + entry_number * entry_struct.size)
+                           for entry_number in xrange(entry_count)]
+            except struct.error:
+                raise GCodeIndexError("Index is incomplete")
+            offset += entry_count * entry_struct.size
+            sections.append(entries)
+        lines, z_changes, layer_comments, state_entries = sections
+        states = [(entry[0], _decode_state(entry[1:])) for entry in state_entries]
+        return cls((source_size, source_mtime), line_interval, line_count, lines, z_changes, layer_comments, states)
+
+
+def _encode_state(state):
+    return [unknown if value is None else value for value, unknown in zip(state, _unknown_state_values)]
+
+
+def _decode_state(values):
+    state = []
+    for value, unknown in zip(values, _unknown_state_values):
+        if isinstance(value, str):
+            value = value.rstrip('\x00')
+        # nan is not even equal to itself
+        if value != value or value == unknown:
+            value = None
+        state.append(value)
+    return ModalState(*state)
+
+
+def _follow_state(state, gcode):
+    # applies a g code to the modal state (a dictionary of the ModalState fields)
+    code = gcode.code
+    present = gcode.present
+    if code in ("G0", "G1", "G92"):
+        for name, bit in _axis_words:
+            if present & bit:
+                state[name] = getattr(gcode, name)
+        if present & F_WORD and code != "G92":
+            state['f'] = gcode.f
+    elif code == "G28":
+        words = present & (X_WORD | Y_WORD | Z_WORD | E_WORD)
+        home_words = state['home_words']
+        if home_words is None:
+            state['home_words'] = words
+        elif home_words and words:
+            state['home_words'] = home_words | words
+        else:
+            state['home_words'] = 0
+        # homing puts the axes to zero
+        for name, bit in _axis_words[:3]:
+            if not words or words & bit:
+                state[name] = 0.0
+    elif code in _temperature_codes:
+        if present & S_WORD:
+            state[_temperature_codes[code]] = gcode.s
+    elif code in _mode_codes:
+        state[_mode_codes[code]] = code
+
+
+def build_index(gcode_file, line_interval=_default_line_interval):
+    # one pass over the file - only the comments and the g & m codes get decoded
+    source_signature = _source_signature(gcode_file)
+    lines = []
+    z_changes = []
+    layer_comments = []
+    states = []
+    state = UNKNOWN_STATE._asdict()
+    last_z = None
+    offset = 0
+    line_number = 0
+    with open(gcode_file, 'rb', _read_buffer_size) as gcode_input:
+        for line in gcode_input:
+            if line_number % line_interval == 0:
+                lines.append((line_number, offset))
+            first = line[:1]
+            if first == ';':
+                if _layer_comment_pattern.match(line):
+                    layer_comments.append((line_number, offset))
+                    states.append((offset, ModalState(**state)))
+            elif first in ('G', 'g', 'M', 'm'):
+                gcode = tokenize_gcode_line(line)
+                if gcode:
+                    if gcode.present & Z_WORD and gcode.code in ("G0", "G1") and gcode.z != last_z:
+                        last_z = gcode.z
+                        z_changes.append((line_number, offset, last_z))
+                        states.append((offset, ModalState(**state)))
+                    _follow_state(state, gcode)
+            offset += len(line)
+            line_number += 1
+    return GCodeIndex(source_signature, line_interval, line_number, lines, z_changes, layer_comments, states)
+
+
+def index_gcode(gcode_file, line_interval=_default_line_interval):
+    index = build_index(gcode_file, line_interval)
+    index.write(index_file_name(gcode_file))
+    _logger.info("Indexed %s: %s lines, %s layers", gcode_file, index.line_count, len(index.layers))
+    return index
+
+
+def current_index(gcode_file):
+    # the stored index - if there is one and it belongs to the current version of the g code
+    index_file = index_file_name(gcode_file)
+    if not os.path.isfile(index_file):
+        return None
+    try:
+        index = GCodeIndex.read(index_file)
+    except GCodeIndexError as e:
+        _logger.warn("Ignoring broken index %s: %s", index_file, e)
+        return None
+    if index.source_signature != _source_signature(gcode_file):
+        _logger.info("Index %s is outdated", index_file)
+        return None
+    return index
+
+
+def get_index(gcode_file):
+    index = current_index(gcode_file)
+    if not index:
+        index = index_gcode(gcode_file)
+    return index
+
+
+class MappedGCode(object):
+    """
+    Random access to a g code file by memory mapping it.
+    """
+
+    def __init__(self, gcode_file):
+        self.gcode_file = gcode_file
+        self.size = os.path.getsize(gcode_file)
+        self._mapped = None
+        if self.size:
+            with open(gcode_file, 'rb') as gcode_input:
+                self._mapped = mmap.mmap(gcode_input.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._mapped:
+            self._mapped.close()
+            self._mapped = None
+
+    def lines(self, start_offset=0):
+        if not self._mapped:
+            return
+        mapped = self._mapped
+        mapped.seek(start_offset)
+        readline = mapped.readline
+        line = readline()
+        while line:
+            yield line
+            line = readline()
+
+
+class GCodeIndexError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
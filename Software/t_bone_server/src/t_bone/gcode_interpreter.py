@@ -1,39 +1,98 @@
 import logging
+import os
 import re
 from threading import Thread
+import time
 
-from helpers import file_len
+from gcode_index import current_index, get_index, MappedGCode
+from gcode_tokenizer import tokenize_gcode_line, GCodeRecord, X_WORD, Y_WORD, Z_WORD, S_WORD
+from metrics import metrics
+from print_job import current_job
 from printer import PrinterError
 
 
 __author__ = 'marcus'
 
 _text_and_number_pattern = re.compile('([a-zA-Z]+)(\-?\d+(.\d+)?)')
+# big read ahead - the uploads are large and the sd card is slow
+_read_buffer_size = 1024 * 1024
+# M109 & M190 give up if the heater does not get there in time
+_temperature_wait_timeout = 20 * 60
 _logger = logging.getLogger(__name__)
+_parse_time = metrics.histogram('gcode_parse_seconds')
+_lines_read = metrics.counter('gcode_lines')
+_home_words = (('x', X_WORD), ('y', Y_WORD), ('z', Z_WORD))
 
 
 class GCodePrintThread(Thread):
-    def __init__(self, file, printer, callback):
+    def __init__(self, file, printer, callback, start_layer=None):
         # this constructor could be a bit more elegant
         super(GCodePrintThread, self).__init__()
         self.file = file
         self.printer = printer
         self.callback = callback
-        #let's see how many lines the print file got and reset progress
-        self.lines_to_print = file_len(file)
+        self.start_layer = start_layer
+        if start_layer:
+            # we need to know where the layer starts - even if we have to index the file for it
+            self.index = get_index(file)
+            self.start_offset = self.index.layer_offset(start_layer)
+            self.start_state = self.index.layer_state(start_layer)
+            self.job = None
+        else:
+            self.index = current_index(file)
+            self.start_offset = 0
+            self.start_state = None
+            # if the upload has already been compiled we replay the binary job instead of parsing text
+            self.job = current_job(file)
+        # we do not scan the whole file up front - the progress is measured by the bytes read so far
+        if self.job:
+            self.bytes_to_print = self.job.record_count * self.job.record_size
+        else:
+            self.bytes_to_print = os.path.getsize(file) - self.start_offset
+        self.bytes_printed = 0
         self.lines_printed = 0
         self.printing = False
 
+    @property
+    def layer(self):
+        if self.job:
+            return self.job.layer_at(self.bytes_printed)
+        elif self.index:
+            return self.index.layer_at(self.start_offset + self.bytes_printed)
+        return None
+
+    @property
+    def layers(self):
+        if self.job:
+            return len(self.job.layers)
+        elif self.index:
+            return len(self.index.layers)
+        return None
+
+    @property
+    def lines_to_print(self):
+        # just an estimate by the average line length so far
+        if not self.bytes_printed:
+            return 0
+        return int(self.lines_printed * float(self.bytes_to_print) / float(self.bytes_printed))
+
+    @property
+    def percent_printed(self):
+        if not self.bytes_to_print:
+            return 0.0
+        return float(self.bytes_printed) / float(self.bytes_to_print) * 100.0
+
     def run(self):
         self.printing = True
         try:
-            gcode_input = open(self.file)
-            _logger.info("starting GCODE interptretation from %s to %s", input, self.printer)
+            _logger.info("starting GCODE interptretation from %s to %s", self.file, self.printer)
             self.lines_printed = 0
+            self.bytes_printed = 0
             self.printer.start_print()
-            for line in gcode_input:
-                read_gcode_to_printer(line, self.printer)
-                self.lines_printed += 1
+            if self.job:
+                self._print_job()
+            else:
+                self._print_gcode()
             self.printer.finish_print()
             _logger.info("fininshed gcode reading to %s ", self.printer)
             # todo and here we need some more or less clever plan - since we cannot restart the print thread
@@ -42,17 +101,114 @@ class GCodePrintThread(Thread):
             if self.callback:
                 self.callback()
 
+    def _print_gcode(self):
+        if self.start_offset:
+            self._print_mapped_gcode()
+            return
+        with open(self.file, 'r', _read_buffer_size) as gcode_input:
+            for line in gcode_input:
+                read_gcode_to_printer(line, self.printer)
+                self.lines_printed += 1
+                self.bytes_printed += len(line)
+
+    def _print_mapped_gcode(self):
+        _logger.info("starting at layer %s", self.start_layer)
+        mapped_gcode = MappedGCode(self.file)
+        try:
+            # the layers before are skipped - but not what they have done to the printer
+            restore_modal_state(self.start_state, self.printer)
+            for line in mapped_gcode.lines(self.start_offset):
+                read_gcode_to_printer(line, self.printer)
+                self.lines_printed += 1
+                self.bytes_printed += len(line)
+        finally:
+            mapped_gcode.close()
+
+    def _print_job(self):
+        _logger.info("using compiled print job %s", self.job.job_file)
+        record_size = self.job.record_size
+        for gcode in self.job:
+            execute_gcode(gcode, self.printer)
+            self.lines_printed += 1
+            self.bytes_printed += record_size
+
 
 def read_gcode_to_printer(line, printer):
-    gcode = decode_gcode_line(line)
+    if metrics.enabled:
+        start = time.time()
+        gcode = tokenize_gcode_line(line)
+        _parse_time.observe(time.time() - start)
+        _lines_read.increment()
+    else:
+        gcode = tokenize_gcode_line(line)
+    execute_gcode(gcode, printer)
+
+
+def restore_modal_state(state, printer):
+    """
+    Brings the printer into the state the g code before a layer has left it in: the modes, the temperatures, homed
+    and at the last position & feedrate.
+    """
+    for code in (state.units, state.positioning, state.extruder_mode):
+        if code:
+            execute_gcode(GCodeRecord(code), printer)
+    # both heat up at once - and then we wait for them
+    temperatures = (("M140", "M190", state.bed_temperature), ("M104", "M109", state.extruder_temperature))
+    for set_code, wait_code, temperature in temperatures:
+        if temperature:
+            execute_gcode(_temperature_gcode(set_code, temperature), printer)
+    for set_code, wait_code, temperature in temperatures:
+        if temperature:
+            execute_gcode(_temperature_gcode(wait_code, temperature), printer)
+    homed_axes = []
+    if state.home_words is not None:
+        home = GCodeRecord("G28")
+        home.present = state.home_words
+        execute_gcode(home, printer)
+        if state.home_words:
+            homed_axes = [axis_name for axis_name, bit in _home_words if state.home_words & bit]
+        else:
+            homed_axes = [axis_name for axis_name, axis in printer.axis.iteritems() if axis['homeable']]
+    positions = {}
+    for axis_name in ('x', 'y', 'z', 'e'):
+        if getattr(state, axis_name) is not None:
+            positions[axis_name] = getattr(state, axis_name)
+    target_speed = None
+    if state.f:
+        # the feedrate is measured in mm/minute - but we use mm/second
+        target_speed = state.f / 60.0
+    # what has not been homed is where the g code has left it
+    set_positions = dict((axis_name, position) for axis_name, position in positions.iteritems()
+                         if axis_name not in homed_axes)
+    if target_speed:
+        set_positions['target_speed'] = target_speed
+    if set_positions:
+        printer.set_position(set_positions)
+    # the homed axes go back - z first so that the head does not run into the print
+    for axis_names in (('z',), ('x', 'y')):
+        move = dict((axis_name, positions[axis_name]) for axis_name in axis_names
+                    if axis_name in homed_axes and axis_name in positions)
+        if move:
+            if target_speed:
+                move['target_speed'] = target_speed
+            printer.move_to(move)
+
+
+def _temperature_gcode(code, temperature):
+    gcode = GCodeRecord(code)
+    gcode.s = temperature
+    gcode.present = S_WORD
+    return gcode
+
+
+def execute_gcode(gcode, printer):
     # handling the negative case first is silly but gives us more flexibility in the elif struct
     if not gcode:
         #nothing to do fine!
         pass
     elif "G0" == gcode.code or "G1" == gcode.code:  #TODO G1 & G0 is different
         #we simply interpret the arguments as positions
-        positions = _decode_positions(gcode, line)
-        printer.move_to(positions)
+        printer.move_to(gcode.positions())
     elif "G20" == gcode.code:
         #we cannot switch to inches - sorry folks
         raise PrinterError("Currently only metric units are supported!")
@@ -60,7 +216,7 @@ def read_gcode_to_printer(line, printer):
         _logger.info("Using metric units according to the g code")
     elif "G28" == gcode.code:
         #TODO in'st that also to enqueue??
-        positions = _decode_positions(gcode, line)
+        positions = gcode.positions()
         homing_axis = []
         if not printer.homed:
             printer.homed = True
@@ -87,28 +243,25 @@ def read_gcode_to_printer(line, printer):
         raise PrinterError("Currently only absolute positions are supported!")
     elif "G92" == gcode.code:
         #set XPOS
-        positions = _decode_positions(gcode, line)
-        printer.set_position(positions)
+        printer.set_position(gcode.positions())
     elif "M82" == gcode.code:
         _logger.info("Using absolute positions")
         #todo we can support relative positions - if we are a bit careful
     elif "M83" == gcode.code:
         raise PrinterError("Currently only absolute positions are supported!")
     elif "M104" == gcode.code:
-        options = _decode_positions(gcode, line)
-        if 's' in options:
-            temperature = options['s']
+        if gcode.present & S_WORD:
+            temperature = gcode.s
             if not temperature > printer.extruder_heater.max_temperature:
                 printer.extruder_heater.set_temperature(temperature)
             else:
                 _logger.error("Setting be temperature to %s got ignored, too hot", temperature)
     elif "M106" == gcode.code:
-        options = _decode_positions(gcode, line)
-        if 's' in options:
-            fan_speed = options['s'] / 255.0
+        if gcode.present & S_WORD:
+            fan_speed = gcode.s / 255.0
             # printer.set_fan(fan_speed)
         else:
-            _logger.info("No fan speed given in %", gcode)
+            _logger.info("No fan speed given in %s", gcode)
     elif "M107" == gcode.code:
         try:
             #printer.set_fan(0)
@@ -116,19 +269,13 @@ def read_gcode_to_printer(line, printer):
         except RuntimeError as e:
             _logger.error("Unable to set printer fan to 0:%s", e)
     elif "M109" == gcode.code:
-        options = _decode_positions(gcode, line)
         #Set extruder heater temperature in degrees celsius and wait for this temperature to be achieved
         #Example: M190 S60"
-        if 's' in options:
-            temperature = options['s']
-            printer.extruder_heater.set_temperature(temperature)
-            while printer.extruder_heater.temperature < temperature:
-                #todo a timeout value would be great?
-                pass
+        if gcode.present & S_WORD:
+            _wait_for_temperature(printer.extruder_heater, gcode.s)
     elif "M140" == gcode.code:
-        options = _decode_positions(gcode, line)
-        if 's' in options:
-            temperature = options['s']
+        if gcode.present & S_WORD:
+            temperature = gcode.s
             if printer.heated_bed:
                 printer.heated_bed.set_temperature(temperature)
                 #todo can this go wrong??
@@ -142,35 +289,28 @@ def read_gcode_to_printer(line, printer):
     elif "M190" == gcode.code:
         #Wait for bed temperature to reach target temp
         #Example: M190 S60"
-        options = _decode_positions(gcode, line)
-        if 's' in options:
-            temperature = options['s']
+        if gcode.present & S_WORD:
+            temperature = gcode.s
             if printer.heated_bed:
-                printer.heated_bed.set_temperature(temperature)
-                if printer.heated_bed.get_set_temperature() < temperature:
-                    _logger.warn("The set temperature of %s can never reach the target temperature of %s",
-                                 printer.heated_bed.set_temperature, temperature)
-                    return
-                while printer.heated_bed.get_set_temperature() < temperature:
-                    #todo a timeout value would be great?
-                    pass
+                _wait_for_temperature(printer.heated_bed, temperature)
+            else:
+                _logger.warn("Waiting for bed temperature %s got ignored", temperature)
     else:
         _logger.warn("Unknown GCODE %s ignored", gcode)
 
 
-def _decode_positions(gcode, line):
-    positions = {}
-    if gcode.options:
-        for argument in gcode.options:
-            position = decode_text_and_number(argument)
-            if position:
-                positions[position[0].lower()] = position[1]
-            else:
-                _logger.warn("Unable to interpret position %s in %s", argument, line)
-    if 'f' in positions:
-        # the feedrate is measured in mm/minute - but we use mm/second -> so recalculate everything
-        positions['target_speed'] = positions['f'] / 60.0
-    return positions
+def _wait_for_temperature(heater, temperature):
+    heater.set_temperature(temperature)
+    if temperature <= 0:
+        # the heater is switched off - it cools down to the room temperature and never gets to 0
+        return
+    if heater.get_set_temperature() != temperature:
+        _logger.warn("The set temperature of %s can never reach the target temperature of %s",
+                     heater.get_set_temperature(), temperature)
+        return
+    if not heater.wait_for_temperature(temperature, timeout=_temperature_wait_timeout):
+        raise PrinterError("Temperature %s not reached within %ss, it is %s" % (
+            temperature, _temperature_wait_timeout, heater.temperature))
 
 
 class GCode:
@@ -0,0 +1,89 @@
+import logging
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+# the presence bits of the g code words
+X_WORD = 1
+Y_WORD = 2
+Z_WORD = 4
+E_WORD = 8
+F_WORD = 16
+S_WORD = 32
+_word_bits = (('x', X_WORD), ('y', Y_WORD), ('z', Z_WORD), ('e', E_WORD), ('f', F_WORD), ('s', S_WORD))
+
+
+class GCodeRecord(object):
+    """
+    A decoded line of g code: the code and a fixed slot for each word we understand.
+    Which of the words were given is stored as bits in present.
+    """
+    __slots__ = ('code', 'present', 'x', 'y', 'z', 'e', 'f', 's')
+
+    def __init__(self, code):
+        self.code = code
+        self.present = 0
+        self.x = 0.0
+        self.y = 0.0
+        self.z = 0.0
+        self.e = 0.0
+        self.f = 0.0
+        self.s = 0.0
+
+    def positions(self):
+        # the dictionary form the printer wants
+        positions = {}
+        present = self.present
+        if present & X_WORD:
+            positions['x'] = self.x
+        if present & Y_WORD:
+            positions['y'] = self.y
+        if present & Z_WORD:
+            positions['z'] = self.z
+        if present & E_WORD:
+            positions['e'] = self.e
+        if present & F_WORD:
+            positions['f'] = self.f
+            # the feedrate is measured in mm/minute - but we use mm/second -> so recalculate everything
+            positions['target_speed'] = self.f / 60.0
+        if present & S_WORD:
+            positions['s'] = self.s
+        return positions
+
+    def __repr__(self):
+        result = self.code
+        for name, bit in _word_bits:
+            if self.present & bit:
+                result += " %s%s" % (name.upper(), getattr(self, name))
+        return result
+
+
+# maps the word letter to its presence bit and the setter of its slot - so decoding is just one lookup per word
+_word_dispatch = {}
+for _name, _bit in _word_bits:
+    _word_dispatch[_name] = _word_dispatch[_name.upper()] = (_bit, getattr(GCodeRecord, _name).__set__)
+
+
+# decode a line of text to a g code record in one go
+def tokenize_gcode_line(line):
+    comment_start = line.find(';')
+    if comment_start >= 0:
+        line = line[:comment_start]
+    words = line.split()
+    if not words:
+        return None
+    result = GCodeRecord(words[0])
+    present = 0
+    dispatch = _word_dispatch.get
+    for word_number in xrange(1, len(words)):
+        word = words[word_number]
+        slot = dispatch(word[0])
+        if slot:
+            try:
+                slot[1](result, float(word[1:]))
+                present |= slot[0]
+            except ValueError:
+                _logger.warn("Unable to interpret position %s in %s", word, line)
+    result.present = present
+    return result
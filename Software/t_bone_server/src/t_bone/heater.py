@@ -11,6 +11,11 @@ _DEFAULT_READOUT_DELAY = 0.1
 _DEFAULT_CURRENT_READOUT_DELAY = 60
 _PWM_LOCK = threading.Lock()
 _DEFAULT_MAX_TEMPERATURE = 250
+# how close and for how long the temperature has to be at the target before we consider it reached
+_DEFAULT_TEMPERATURE_TOLERANCE = 2.0
+_DEFAULT_TEMPERATURE_SETTLE_TIME = 3.0
+# how often a waiting thread checks if the heater thread is still alive
+_DEFAULT_LIVENESS_CHECK_INTERVAL = 1.0
 ADC.setup()
 
 ADC_LOCK = threading.Lock()
@@ -26,7 +31,6 @@ class Heater(Thread):
         self._thermometer = thermometer
         self._output = output
         self._machine = machine
-        self.active = False
         self._set_temperature = 0.0
         self.temperature = 0.0
         self.readout_delay = _DEFAULT_READOUT_DELAY
@@ -34,6 +38,10 @@ class Heater(Thread):
         self.current_consumption = 0.0
         self.current_readout_delay = _DEFAULT_CURRENT_READOUT_DELAY
         self._wait_for_current_readout = 0
+        # notified on every new temperature reading
+        self.temperature_updated = threading.Condition()
+        # active before the thread runs - a stop right after the start must not get lost
+        self.active = True
         self.start()
 
     def stop(self):
@@ -48,12 +56,52 @@ class Heater(Thread):
     def get_set_temperature(self):
         return self._set_temperature
 
+    def wait_for_temperature(self, target=None, tolerance=_DEFAULT_TEMPERATURE_TOLERANCE, timeout=None,
+                             settle_time=_DEFAULT_TEMPERATURE_SETTLE_TIME):
+        """
+        Blocks until the temperature has been within tolerance of the target (default: the set temperature)
+        for settle_time seconds. If the heater is above the target it has to cool down, which is done as soon as
+        it is within tolerance. Returns False if that did not happen within timeout seconds and raises a
+        HeaterError if the heater thread is not running.
+        """
+        if target is None:
+            target = self._set_temperature
+        if timeout is not None:
+            end_time = time.time() + timeout
+        within_tolerance_since = None
+        with self.temperature_updated:
+            cooling = self.temperature > target + tolerance
+            while True:
+                now = time.time()
+                if cooling:
+                    if self.temperature <= target + tolerance:
+                        return True
+                elif abs(self.temperature - target) <= tolerance:
+                    if within_tolerance_since is None:
+                        within_tolerance_since = now
+                    if now - within_tolerance_since >= settle_time:
+                        return True
+                else:
+                    within_tolerance_since = None
+                if timeout is not None and now >= end_time:
+                    _logger.warn("Temperature %s did not reach %s within %ss", self.temperature, target, timeout)
+                    return False
+                if not self.is_alive():
+                    raise HeaterError("Heater is not running, the temperature %s will never reach %s" % (
+                        self.temperature, target))
+                wait_time = _DEFAULT_LIVENESS_CHECK_INTERVAL
+                if timeout is not None:
+                    wait_time = min(wait_time, end_time - now)
+                self.temperature_updated.wait(wait_time)
+
     def run(self):
         self._wait_for_current_readout = self.current_readout_delay + self.readout_delay
-        self.active = True
         try:
             while self.active:
-                self.temperature = self._thermometer.read()
+                temperature = self._thermometer.read()
+                with self.temperature_updated:
+                    self.temperature = temperature
+                    self.temperature_updated.notify_all()
                 self.update_heater()
                 time.sleep(self.readout_delay)
         except Exception as e:
@@ -72,9 +120,7 @@ class PwmHeater(Heater):
     def __init__(self, thermometer, pid_controller, output, maximum_duty_cycle=None, current_measurement=None,
                  machine=None,
                  pwm_frequency=None, max_temperature=None):
-        super(PwmHeater, self).__init__(thermometer=thermometer, output=output,
-                                        machine=machine, max_temperature=max_temperature,
-                                        current_measurement=current_measurement)
+        # the heater thread starts right away - everything it uses has to be there before
         self._pid_controller = pid_controller
         if maximum_duty_cycle:
             self._maximum_duty_cycle = float(maximum_duty_cycle)
@@ -87,10 +133,11 @@ class PwmHeater(Heater):
         else:
             self.pwm_frequency = pwm_frequency
 
-        self._wait_for_current_readout = 0
-
         with _PWM_LOCK:
-            PWM.start(self._output, 0.0, self.pwm_frequency, 0)
+            PWM.start(output, 0.0, self.pwm_frequency, 0)
+        super(PwmHeater, self).__init__(thermometer=thermometer, output=output,
+                                        machine=machine, max_temperature=max_temperature,
+                                        current_measurement=current_measurement)
 
     def set_temperature(self, temperature):
         super(PwmHeater, self).set_temperature(temperature)
@@ -135,9 +182,7 @@ class OnOffHeater(Heater):
     def __init__(self, thermometer, output, active_high=True,
                  max_temperature=None, hysteresis=0,
                  machine=None, current_measurement=None):
-        super(OnOffHeater, self).__init__(thermometer=thermometer, output=output,
-                                          machine=machine, max_temperature=max_temperature,
-                                          current_measurement=current_measurement)
+        # the heater thread starts right away - everything it uses has to be there before
         self.hysteresis = hysteresis
         GPIO.setup(output, GPIO.OUT)
         if active_high:
@@ -152,7 +197,10 @@ class OnOffHeater(Heater):
             }
 
         self._is_active = False
-        self._set_active(False)
+        GPIO.output(output, self._on_off_config['off'])
+        super(OnOffHeater, self).__init__(thermometer=thermometer, output=output,
+                                          machine=machine, max_temperature=max_temperature,
+                                          current_measurement=current_measurement)
 
     def _set_active(self, active):
         self._is_active = active
@@ -179,6 +227,8 @@ class OnOffHeater(Heater):
 class Thermometer(object):
     def __init__(self, themistor_type, analog_input):
         self._thermistor_type = themistor_type
+        # unknown thermistors fail right away - not at the first reading
+        self._thermistor = thermistors.get_thermistor(themistor_type)
         self._input = analog_input
 
     def read(self):
@@ -196,7 +246,12 @@ class Thermometer(object):
                     unsuccesfull += 1
                     if unsuccesfull > 100:
                         raise e
-        return thermistors.get_thermistor_reading(self._thermistor_type, value)
+        return self._thermistor.convert(value)
+
+
+class HeaterError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
 
 
 # from http://code.activestate.com/recipes/577231-discrete-pid-controller/
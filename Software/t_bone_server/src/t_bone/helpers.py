@@ -53,11 +53,3 @@ def find_shortest_vector(vector_list):
             x_square = find_list[shortest_vector]['x'] ** 2
             y_square = find_list[shortest_vector]['y'] ** 2
     return find_list[shortest_vector]
-
-
-def file_len(fname):
-    i = 0
-    with open(fname) as f:
-        for i, l in enumerate(f):
-            pass
-    return i + 1
\ No newline at end of file
@@ -1,25 +1,55 @@
 # coding=utf-8
-from Queue import Queue, Empty
+from Queue import Queue
+from collections import deque
 import logging
-import re
 from threading import Thread
 import serial
 import threading
 import time
 import Adafruit_BBIO.GPIO as GPIO
+from machine_protocol import encode_binary_move, decode_binary_move, encode_binary_arguments, \
+    decode_binary_arguments, MachineError
+from metrics import metrics, FILL_BUCKETS
 
 __author__ = 'marcus'
 
 _default_timeout = 120
-_commandEndMatcher = re.compile(";")  # needed to search for command ends
 _min_command_buffer_free_space = 5  # how much arduino buffer to preserve
 _initial_buffer_length = 20  # how much buffer do we need befoer starting to print
-_buffer_empyting_wait_time = 0.1
 _buffer_warn_waittime = 10
+# how many commands may be sent before their reply has been received
+_default_pipeline_depth = 2
+# the arduino only starts a move if there are more commands (one per motor) in its queue - unless the motion finishes
+FIRMWARE_MIN_BUFFER_DEPTH = 5
+# moves can be sent as binary frame: length | payload | checksum - COBS encoded & escaped for CmdMessenger
+_binary_move_command = 14
+_move_command = 10
+# the arduino always starts with the default baud rate, we can ask it to switch to a faster one
+_default_baud_rate = 38400
+_baud_rate_command = 15
+# the arduino pings once a second - at the new baud rate it has to be heard within this time
+_baud_rate_verification_timeout = 2.5
+# the arduino falls back to the default baud rate if the new one is not confirmed in 3 seconds
+_baud_rate_fallback_timeout = 5
+_link_test_command_count = 100
+# the arduino pings once a second - if it is running we hear it within this time
+_soft_connect_timeout = 1.5
+# how long the arduino may take to boot after a reset
+_reset_timeout = 20
+_reset_pulse_time = 0.1
+# reading the serial port must not block forever - so that we can stop listening
+_serial_read_timeout = 0.1
 clock_frequency = 16000000
 
 _logger = logging.getLogger(__name__)
 
+_round_trip_time = metrics.histogram('serial_round_trip_seconds')
+_commands_sent = metrics.counter('serial_commands_sent')
+_bytes_sent = metrics.counter('serial_bytes_sent')
+_command_buffer_wait_time = metrics.histogram('machine_command_buffer_wait_seconds')
+_arduino_queue_length = metrics.gauge('arduino_queue_length')
+_arduino_buffer_fill = metrics.histogram('arduino_buffer_fill', FILL_BUCKETS)
+
 MAXIMUM_FREQUENCY_ACCELERATION = 2 ** 22 - 2
 MAXIMUM_FREQUENCY_BOW = 2 ** 24 - 2
 
@@ -36,40 +66,182 @@ class Machine():
         self.machine_connection = None
         self.command_queue = Queue()
         self.batch_mode = False
+        self.pipeline_depth = _default_pipeline_depth
+        # the moves sent in batch mode, whose reply is still to be checked and how many motors they move
+        self._moves_in_flight = deque()
+        # what the arduino told us in the last reply to a move
+        self.command_buffer_length = 0
+        self.command_max_buffer_length = 0
+        self.command_queue_running = False
+        # we ask for binary moves, the machine tells us at kInit if it can handle them
+        self.binary_moves = True
+        self.binary_moves_supported = False
+        # older firmwares can only report the status of one motor at once
+        self.status_all_supported = True
+        # the baud rate we want to talk - we start with the default & negotiate the rest
+        self.baud_rate = _default_baud_rate
+        # called with the queue length & max queue length whenever the arduino reports them - from any thread
+        self.queue_listeners = []
+
+    def connect(self, soft_connect=True):
+        """
+        Connects to the arduino. With soft_connect a running arduino is just initialized - only if it does not answer
+        it gets reset.
+        """
+        if not (soft_connect and self._soft_connect()):
+            self._reset_machine()
+            _logger.info("waiting for arduino")
+            if not self.machine_connection:
+                self.machine_connection = _MachineConnection(self._open_serial(), ready_timeout=_reset_timeout,
+                                                             queue_listener=self._queue_reported)
+                self.machine_connection.pipeline_depth = self.pipeline_depth
+            else:
+                # after the reset the arduino is back at the default baud rate
+                self.machine_connection.change_baud_rate(_default_baud_rate)
+                if not self.machine_connection.wait_for_keep_alive(_reset_timeout):
+                    raise MachineError("Machine does not seem to be ready")
+            self._init_machine()
+        if self.baud_rate != _default_baud_rate:
+            self.set_baud_rate(self.baud_rate)
+
+    def _soft_connect(self):
+        if self.machine_connection:
+            return False
+        _logger.info("looking for a running arduino at %s", self.serial_port)
+        try:
+            self.machine_connection = _MachineConnection(self._open_serial(), ready_timeout=_soft_connect_timeout,
+                                                         queue_listener=self._queue_reported)
+            self.machine_connection.pipeline_depth = self.pipeline_depth
+            self._init_machine(_soft_connect_timeout)
+            return True
+        except MachineError as e:
+            _logger.info("No running arduino found: %s", e)
+            self.disconnect()
+            return False
+
+    def _open_serial(self):
+        return serial.Serial(self.serial_port, _default_baud_rate, timeout=_serial_read_timeout)
 
-    def connect(self):
+    def _reset_machine(self):
         _logger.info("resetting arduino at %s", self.serial_port)
         GPIO.output(self.reset_pin, GPIO.LOW)
-        # reset the arduino
-        time.sleep(1)
+        time.sleep(_reset_pulse_time)
         GPIO.output(self.reset_pin, GPIO.HIGH)
-        time.sleep(15)
-        _logger.info("waiting for arduino")
-        if not self.machine_connection:
-            machineSerial = serial.Serial(self.serial_port, 38400, timeout=_default_timeout)
-            self.machine_connection = _MachineConnection(machineSerial)
+
+    def _init_machine(self, timeout=None):
         init_command = MachineCommand()
         init_command.command_number = 9
-        reply = self.machine_connection.send_command(init_command)
+        # 1 asks for binary moves
+        init_command.arguments = [1]
+        reply = self.machine_connection.send_command(init_command, timeout)
         if reply.command_number != 0:
             _logger.fatal("Unable to start, received %s which is not OK", reply)
             raise MachineError("Unable to start")
+        # older firmwares just acknowledge with 0
+        self.binary_moves_supported = bool(reply.arguments) and reply.arguments[0].strip() == '1'
+        _logger.info("Machine understands binary moves: %s", self.binary_moves_supported)
+
+    def configure_serial(self, serial_config):
+        if 'binary-moves' in serial_config:
+            # ascii is way easier to debug
+            self.binary_moves = bool(serial_config['binary-moves'])
+        if 'pipeline-depth' in serial_config:
+            self.pipeline_depth = max(int(serial_config['pipeline-depth']), 1)
+            if self.machine_connection:
+                self.machine_connection.pipeline_depth = self.pipeline_depth
+            _logger.info("Sending up to %s commands ahead", self.pipeline_depth)
+        if 'baud-rate' in serial_config:
+            self.baud_rate = int(serial_config['baud-rate'])
+            if self.machine_connection and self.machine_connection.baud_rate() != self.baud_rate:
+                self.set_baud_rate(self.baud_rate)
+
+    def set_baud_rate(self, baud_rate):
+        """
+        Asks the arduino to switch to the new baud rate and checks if we can still hear it. If not both sides fall
+        back to the default baud rate. Returns if the new baud rate is used.
+        """
+        _logger.info("Switching to %s baud", baud_rate)
+        connection = self.machine_connection
+        baud_rate_command = MachineCommand()
+        baud_rate_command.command_number = _baud_rate_command
+        baud_rate_command.arguments = [int(baud_rate)]
+        reply = connection.send_command(baud_rate_command)
+        if not reply or reply.command_number != 0:
+            # older firmwares do not know how to switch
+            _logger.warn("Machine cannot switch to %s baud: %s", baud_rate, reply)
+            return False
+        connection.change_baud_rate(baud_rate)
+        if connection.wait_for_keep_alive(_baud_rate_verification_timeout):
+            confirm_command = MachineCommand()
+            confirm_command.command_number = _baud_rate_command
+            confirm_command.arguments = [0]
+            pending_command = connection.queue_command(confirm_command, _baud_rate_verification_timeout)
+            if pending_command.wait(_baud_rate_verification_timeout) and pending_command.reply \
+                    and pending_command.reply.command_number == 0:
+                _logger.info("Talking with %s baud to the machine", baud_rate)
+                self.measure_link_throughput()
+                return True
+            connection.cancel_command(pending_command)
+        _logger.warn("Machine cannot be heard at %s baud, falling back to %s baud", baud_rate, _default_baud_rate)
+        connection.change_baud_rate(_default_baud_rate)
+        if not connection.wait_for_keep_alive(_baud_rate_fallback_timeout):
+            raise MachineError("Machine cannot be heard after falling back to %s baud" % _default_baud_rate)
+        return False
+
+    def measure_link_throughput(self, command_count=_link_test_command_count):
+        """
+        Sends a bunch of status queries as fast as the pipeline allows and reports how many commands per second
+        get through the serial link.
+        """
+        connection = self.machine_connection
+        info_command = MachineCommand()
+        info_command.command_number = 31
+        command_length = len(_encode_command(info_command))
+        start = time.time()
+        pending_commands = [connection.queue_command(info_command) for command in range(command_count)]
+        for pending_command in pending_commands:
+            connection.wait_for_reply(pending_command)
+        duration = max(time.time() - start, 0.000001)
+        result = {
+            'baud-rate': connection.baud_rate(),
+            'commands-per-second': command_count / duration,
+            'bytes-per-second': command_count * command_length / duration
+        }
+        _logger.info("Link at %s baud: %0.0f commands/s, %0.0f bytes/s", result['baud-rate'],
+                     result['commands-per-second'], result['bytes-per-second'])
+        return result
 
     def disconnect(self):
         if self.machine_connection:
+            if self.machine_connection.run_on and self.machine_connection.baud_rate() != _default_baud_rate:
+                # so that the next connect finds the arduino at the baud rate it expects
+                baud_rate_command = MachineCommand()
+                baud_rate_command.command_number = _baud_rate_command
+                baud_rate_command.arguments = [_default_baud_rate]
+                try:
+                    pending_command = self.machine_connection.queue_command(baud_rate_command,
+                                                                            _baud_rate_verification_timeout)
+                    pending_command.wait(_baud_rate_verification_timeout)
+                except MachineError:
+                    _logger.warn("Unable to switch the machine back to %s baud", _default_baud_rate)
             self.machine_connection.stop()
+            self.machine_connection = None
 
     def set_current(self, motor=None, current=None):
+        self.set_current_async(motor, current).result()
+
+    def set_current_async(self, motor=None, current=None):
         command = MachineCommand()
         command.command_number = 1
         command.arguments = (
             int(motor),
             int(current * 1000)
         )
-        reply = self.machine_connection.send_command(command)
-        if not reply or reply.command_number != 0:
-            _logger.fatal("Unable to set motor current:%s", reply)
-            raise MachineError("Unable to set motor current", reply)
+        return self._send_async(command, lambda reply: _checked_reply(reply, 0, "Unable to set motor current"))
+
+    def _send_async(self, command, convert=None):
+        pending_command = self.machine_connection.queue_command(command)
+        return MachineFuture(self.machine_connection, pending_command, convert)
 
     def invert_motor(self, motor=None, inverted=False):
         command = MachineCommand()
@@ -218,11 +390,19 @@ class Machine():
         if not reply or not reply.command_number == 0:
             _logger.error("Unable to start motion", reply)
             raise MachineError("Unable to start motion")
+        self._moves_in_flight.clear()
+        # until the first move is accepted the keep alive pings tell us about the buffer
+        self.command_buffer_length = int(self.machine_connection.internal_queue_length)
+        self.command_max_buffer_length = int(self.machine_connection.internal_queue_max_length)
+        self.command_queue_running = False
         self.batch_mode = True
 
 
     def finish_motion(self):
         _logger.info("Finishing movement")
+        # every move has to be accepted before we stop
+        while self._moves_in_flight:
+            self._check_next_move_reply(wait=True)
         stop_command = MachineCommand()
         stop_command.command_number = 11
         stop_command.arguments = [-1]
@@ -234,187 +414,409 @@ class Machine():
 
 
     def move_to(self, motors):
+        future = self.move_to_async(motors)
+        if future and not self.batch_mode:
+            future.result()
+
+    def move_to_async(self, motors):
+        """
+        Sends the move without waiting for the machine to accept it. In batch mode it only waits if the command buffer
+        of the arduino is full.
+        """
         if not motors:
             logging.warn("no motor to move??")
-            return
-        command = MachineCommand()
-        command.command_number = 10
-        command.arguments = []
-        _logger.debug("Adding Move:")
-        for motor in motors:
-            command.arguments.append(int(motor['motor']))
-            command.arguments.append(int(motor['target']))
-            if motor['type'] == 'stop':
-                command.arguments.append(ord('s'))
-            else:
-                command.arguments.append(ord('w'))
-            command.arguments.append(abs(float(motor['speed'])))
-            acceleration_ = min(float(motor['acceleration']), MAXIMUM_FREQUENCY_ACCELERATION)
-            command.arguments.append(acceleration_)
-            bow_ = min(int(motor['startBow']), MAXIMUM_FREQUENCY_BOW)
-            command.arguments.append(bow_)
-            _logger.debug("Motor %s to %s as %s with %s", int(motor['motor']), int(motor['target']), motor['type'],
-                          motor['speed'])
+            return None
+        if self.binary_moves and self.binary_moves_supported:
+            command = binary_move_command(motors)
+        else:
+            command = move_command(motors)
+        pending_command = self.machine_connection.queue_command(command)
+        if not self.batch_mode:
+            return MachineFuture(self.machine_connection, pending_command,
+                                 lambda reply: self._check_move_reply(command, reply))
+        # in batch mode we do not wait for the reply - it is checked as soon as it is there
+        self._moves_in_flight.append((pending_command, len(motors)))
+        while self._moves_in_flight and self._moves_in_flight[0][0].answered():
+            self._check_next_move_reply()
+        measured = metrics.enabled
+        if measured:
+            start = time.time()
+        # the moves in flight will take their space in the buffer too, their replies tell us how much is left
+        while self._moves_in_flight and self._command_buffer_free() <= _min_command_buffer_free_space:
+            self._check_next_move_reply(wait=True)
+        if self.command_queue_running and self._command_buffer_free() <= _min_command_buffer_free_space:
+            self._wait_for_free_command_buffer()
+        if measured:
+            _command_buffer_wait_time.observe(time.time() - start)
+        # the buffer is tracked by the move replies - the future just tells if the move was accepted
+        return MachineFuture(self.machine_connection, pending_command,
+                             lambda reply: _checked_reply(reply, 0, "Unable to add motor move"))
 
-        reply = self.machine_connection.send_command(command)
+    def moves_accepted(self):
+        """
+        How many moves & command queue entries the arduino has accepted so far - counted by the thread listening to
+        the machine, so the queue listeners see them in step with the queue length.
+        """
+        if not self.machine_connection:
+            return 0, 0
+        return self.machine_connection.moves_accepted, self.machine_connection.queue_entries_accepted
+
+    @property
+    def commands_in_flight(self):
+        # sent or waiting to be sent - but not answered yet
+        if not self.machine_connection:
+            return 0
+        return self.machine_connection.commands_in_flight()
+
+    def _command_buffer_free(self):
+        motors_in_flight = sum(motor_count for pending_command, motor_count in self._moves_in_flight)
+        return self.command_max_buffer_length - self.command_buffer_length - motors_in_flight
+
+    def _check_next_move_reply(self, wait=False):
+        pending_command, motor_count = self._moves_in_flight[0]
+        self._moves_in_flight.popleft()
+        if wait or pending_command.error:
+            reply = self.machine_connection.wait_for_reply(pending_command)
+        else:
+            reply = pending_command.reply
+        self._check_move_reply(pending_command.command, reply)
+
+    def _check_move_reply(self, command, reply):
         if not reply or reply.command_number != 0:
             _logger.error("Unable to move motor: %s -> %s", command, reply)
             raise MachineError("Unable to add motor move", reply)
         if self.batch_mode:
-            command_buffer_length = int(reply.arguments[0])
-            command_max_buffer_length = int(reply.arguments[1])
-            command_buffer_free = command_max_buffer_length - command_buffer_length
-            command_queue_running = int(reply.arguments[2]) > 0
-            _logger.debug("Arduino command Buffer at %s of %s", command_buffer_length, command_max_buffer_length)
-            if command_queue_running and command_buffer_free <= _min_command_buffer_free_space:
-                buffer_free = False
-                wait_time = 0
-                while not buffer_free:
-                    # sleep a bit
-                    time.sleep(_buffer_empyting_wait_time)
-                    wait_time += _buffer_empyting_wait_time
-                    info_command = MachineCommand()
-                    info_command.command_number = 31
-                    reply = self.machine_connection.send_command(info_command)
-                    if reply:
-                        command_buffer_length = int(reply.arguments[0])
-                        command_max_buffer_length = int(reply.arguments[1])
-                        command_buffer_free = command_max_buffer_length - command_buffer_length
-                        buffer_free = (command_buffer_free > _min_command_buffer_free_space)
-                        if wait_time > _buffer_warn_waittime:
-                            _logger.warning(
-                                "Waiting for free arduino command buffer: %s free of % s total, waiting for %s free",
-                                command_buffer_free, command_buffer_length, _min_command_buffer_free_space)
-                            wait_time = 0
-                        else:
-                            _logger.debug("waiting for free buffer")
-                    else:
-                        _logger.warn("Waiting for a free command timed out!")
-        else:
-            # while self.machine_connection.internal_queue_length > 0:
-            pass  # just wait TODO timeout??
+            self.command_buffer_length = int(reply.arguments[0])
+            self.command_max_buffer_length = int(reply.arguments[1])
+            self.command_queue_running = int(reply.arguments[2]) > 0
+            _logger.debug("Arduino command Buffer at %s of %s", self.command_buffer_length,
+                          self.command_max_buffer_length)
+        return reply
+
+    def _queue_reported(self, queue_length, max_queue_length):
+        try:
+            queue_length = int(queue_length)
+            max_queue_length = int(max_queue_length)
+        except ValueError:
+            # garbled - nobody can do anything with it
+            return
+        if metrics.enabled:
+            _arduino_queue_length.set(queue_length)
+            if max_queue_length > 0:
+                _arduino_buffer_fill.observe(float(queue_length) / max_queue_length)
+        for listener in self.queue_listeners:
+            try:
+                listener(queue_length, max_queue_length)
+            except Exception as e:
+                # it is called by the thread listening to the machine - that one must not die
+                _logger.error("Queue listener %s failed: %s", listener, e)
+
+    def _wait_for_free_command_buffer(self):
+        # the arduino pushes its queue status as soon as there is space again - no need to ask for it
+        connection = self.machine_connection
+        buffer_free = False
+        while not buffer_free:
+            if not connection.run_on:
+                raise MachineError("Machine connection lost while waiting for a free command buffer")
+            if not connection.wait_for_keep_alive(_buffer_warn_waittime):
+                _logger.warning(
+                    "Waiting for free arduino command buffer: %s free of % s total, waiting for %s free",
+                    self.command_max_buffer_length - self.command_buffer_length, self.command_max_buffer_length,
+                    _min_command_buffer_free_space)
+                continue
+            self.command_buffer_length = int(connection.internal_queue_length)
+            self.command_max_buffer_length = int(connection.internal_queue_max_length)
+            buffer_free = self.command_max_buffer_length - self.command_buffer_length > _min_command_buffer_free_space
+            _logger.debug("Arduino command Buffer at %s of %s", self.command_buffer_length,
+                          self.command_max_buffer_length)
 
     def read_positon(self, motor):
+        return self.read_positon_async(motor).result()
+
+    def read_positon_async(self, motor):
         command = MachineCommand()
         command.command_number = 30
         command.arguments = [
             int(motor)
         ]
-        reply = self.machine_connection.send_command(command)
-        if not reply or reply.command_number != 30:
-            _logger.error("Unable read motor position: %s", reply)
-            raise MachineError("Unable read motor position", reply)
-        return int(reply.arguments[0])
+        return self._send_async(command, lambda reply: int(
+            _checked_reply(reply, 30, "Unable read motor position").arguments[0]))
 
     def read_axis_status(self, motor):
+        return self.read_axis_status_async(motor).result()
+
+    def read_axis_status_async(self, motor):
         command = MachineCommand()
         command.command_number = 32
         command.arguments = [
             int(motor)
         ]
-        reply = self.machine_connection.send_command(command)
-        if not reply or reply.command_number != 32:
-            _logger.error("Unable read motor stats: %s", reply)
-            raise MachineError("Unable read motor position", reply)
-        status = {
-            "position": int(reply.arguments[0]),
-        }
-        if len(reply.arguments) > 1:
-            status["encoder_pos"] = int(reply.arguments[1])
+        return self._send_async(command, _decode_axis_status)
 
-            if int(reply.arguments[2]) > 0:
-                left_endstop = True
-            else:
-                left_endstop = False
-            status["left_endstop"] = left_endstop
-
-            if int(reply.arguments[3]) > 0:
-                right_endstop = True
-            else:
-                right_endstop = False
-            status["right_endstop"] = right_endstop
+    def read_axes_status(self, motors):
+        """
+        Reads the status of all given motors - with one command if the firmware can do it.
+        Returns a dict motor -> status.
+        """
+        axes_status = {}
+        if self.status_all_supported:
+            try:
+                axes_status = self.read_axes_status_async(motors).result()
+            except MachineError as e:
+                _logger.warn("Machine cannot report the status of all motors at once, asking one by one: %s", e)
+                self.status_all_supported = False
+        # whatever the machine did not report is asked for one by one
+        missing_motors = [motor for motor in motors if motor not in axes_status]
+        if missing_motors and self.status_all_supported:
+            _logger.debug("Machine did not report the status of motors %s, asking one by one", missing_motors)
+        status_futures = dict((motor, self.read_axis_status_async(motor)) for motor in missing_motors)
+        for motor, status_future in status_futures.iteritems():
+            axes_status[motor] = status_future.result()
+        return axes_status
 
-        return status
+    def read_axes_status_async(self, motors):
+        command = MachineCommand()
+        command.command_number = 33
+        command.arguments = [int(motor) for motor in motors]
+        return self._send_async(command, _decode_axes_status)
 
     def read_current(self, input):
+        return self.read_current_async(input).result()
+
+    def read_current_async(self, input):
         command = MachineCommand()
         command.command_number = 41
         command.arguments = [
             int(input)
         ]
-        reply = self.machine_connection.send_command(command)
-        if not reply or reply.command_number != 41:
-            _logger.error("Unable read current: %s", reply)
-            raise MachineError("Unable read current", reply)
-        return int(reply.arguments[1])
+        return self._send_async(command, lambda reply: int(
+            _checked_reply(reply, 41, "Unable read current").arguments[1]))
+
+
+def _checked_reply(reply, command_number, message):
+    if not reply or reply.command_number != command_number:
+        _logger.error("%s: %s", message, reply)
+        raise MachineError(message, reply)
+    return reply
+
+
+def _decode_axis_status(reply):
+    # status register, position, left end stop, right end stop, encoder position
+    _checked_reply(reply, 32, "Unable read motor status")
+    status = {
+        "position": int(reply.arguments[1]),
+    }
+    if len(reply.arguments) > 4:
+        status["encoder_pos"] = int(reply.arguments[4])
+        status["left_endstop"] = int(reply.arguments[2]) > 0
+        status["right_endstop"] = int(reply.arguments[3]) > 0
+    return status
+
+
+def _decode_axes_status(reply):
+    # for every motor: motor, position, encoder position, left end stop, right end stop
+    _checked_reply(reply, 33, "Unable read motor status")
+    arguments = reply.arguments or []
+    axes_status = {}
+    for index in range(0, len(arguments) - 4, 5):
+        motor, position, encoder_pos, left_endstop, right_endstop = [int(argument) for argument in
+                                                                     arguments[index:index + 5]]
+        axes_status[motor] = {
+            "position": position,
+            "encoder_pos": encoder_pos,
+            "left_endstop": left_endstop > 0,
+            "right_endstop": right_endstop > 0
+        }
+    return axes_status
+
+
+def _move_arguments(motors):
+    arguments = []
+    _logger.debug("Adding Move:")
+    for motor in motors:
+        arguments.append(int(motor['motor']))
+        arguments.append(int(motor['target']))
+        if motor['type'] == 'stop':
+            arguments.append(ord('s'))
+        else:
+            arguments.append(ord('w'))
+        arguments.append(abs(float(motor['speed'])))
+        acceleration_ = min(float(motor['acceleration']), MAXIMUM_FREQUENCY_ACCELERATION)
+        arguments.append(acceleration_)
+        bow_ = min(int(motor['startBow']), MAXIMUM_FREQUENCY_BOW)
+        arguments.append(bow_)
+        _logger.debug("Motor %s to %s as %s with %s", int(motor['motor']), int(motor['target']), motor['type'],
+                      motor['speed'])
+    return arguments
+
+
+def move_command(motors):
+    command = MachineCommand()
+    command.command_number = _move_command
+    command.arguments = _move_arguments(motors)
+    command.queue_entries = len(motors)
+    return command
+
+
+def binary_move_command(motors):
+    command = MachineCommand()
+    command.command_number = _binary_move_command
+    command.binary_arguments = encode_binary_move(_move_arguments(motors))
+    command.queue_entries = len(motors)
+    return command
 
 
 class _MachineConnection:
-    def __init__(self, machine_serial):
+    def __init__(self, machine_serial, ready_timeout=_default_timeout, queue_listener=None):
         self.listening_thread = Thread(target=self)
+        # only this thread writes to the machine - nobody has to wait for the serial port
+        self.writing_thread = Thread(target=self._write_commands)
+        self._outgoing_commands = Queue()
         self.machine_serial = machine_serial
-        self.remaining_buffer = ""
-        self.response_queue = Queue()
-        # let's suck empty the serial connection by reading everything with an extremely short timeout
-        init_start = time.clock()
-        last = ''
-        while not last is ';' and time.clock() - init_start < _default_timeout:
-            last = machine_serial.read()
-            #after we have started let's see if the connection is alive
+        self._reader = _CommandReader(machine_serial)
+        # the commands sent to the machine waiting for their reply - the machine answers in order
+        self.pipeline_depth = _default_pipeline_depth
+        self._pending_commands = deque()
+        self._pending_condition = threading.Condition()
+        self.run_on = True
+        # the machine is ready as soon as it sends its first keep alive ping - everything before is thrown away
+        ready_end = time.time() + ready_timeout
         command = None
-        while (not command or command.command_number != -128) and time.clock() - init_start < _default_timeout:
-            command = self._read_next_command()
+        while (not command or command.command_number != -128) and time.time() < ready_end:
+            command = self._read_next_command(ready_end - time.time())
         if not command or command.command_number != -128:
+            machine_serial.close()
             raise MachineError("Machine does not seem to be ready")
             #ok and if everything is nice we can start a nwe heartbeat thread
-        self.last_heartbeat = time.clock()
-        self.run_on = True
-        self.listening_thread.start()
         self.internal_queue_length = 0
         self.internal_queue_max_length = 1
+        if command.arguments and len(command.arguments) == 2:
+            self.internal_queue_length = command.arguments[0]
+            self.internal_queue_max_length = command.arguments[1]
         self.serial_lock = threading.Lock()
+        self.last_heartbeat = time.clock()
+        # gets every queue length the machine reports - by keep alive pings & move replies
+        self._queue_listener = queue_listener
+        # what went into the queue so far - together with the queue length it tells how fast the machine moves
+        self.moves_accepted = 0
+        self.queue_entries_accepted = 0
+        # every keep alive ping is counted - so that we can wait for the next one
+        self._keep_alive_count = 0
+        self._keep_alive_condition = threading.Condition()
+        self.listening_thread.start()
+        self.writing_thread.start()
 
     def stop(self):
         self.run_on = False
+        self._outgoing_commands.put(None)
+        if self.writing_thread.isAlive():
+            self.writing_thread.join()
         if self.listening_thread.isAlive():
             self.listening_thread.join()
         with self.serial_lock:
             self.machine_serial.close()
 
     def send_command(self, command, timeout=None):
-        with self.serial_lock:
-            _logger.debug("sending command %s", command)
-            if not timeout:
-                timeout = _default_timeout
-                # empty the queue?? shouldn't it be empty??
-            self.response_queue.empty()
-            self.machine_serial.write(str(command.command_number))
-            if command.arguments:
-                self.machine_serial.write(",")
-                for param in command.arguments[:-1]:
-                    if isinstance(param, float):
-                        self.machine_serial.write("%.6g" % param)
-                        # todo on the other hand an e representation may as well be helpful?
-                    else:
-                        self.machine_serial.write(repr(param))
-                    self.machine_serial.write(",")
-                self.machine_serial.write(repr(command.arguments[-1]))
-            self.machine_serial.write(";\n")
-            self.machine_serial.flush()
+        if not timeout:
+            timeout = _default_timeout
+        pending_command = self.queue_command(command, timeout)
+        return self.wait_for_reply(pending_command, timeout)
+
+    def queue_command(self, command, timeout=None):
+        """
+        Hands the command to the writing thread and returns at once. It is sent as soon as there are less than
+        pipeline_depth commands waiting for a reply - if that takes longer than timeout the command fails.
+        """
+        if not timeout:
+            timeout = _default_timeout
+        pending_command = _PendingCommand(command, timeout)
+        if not self.run_on:
+            pending_command.fail(MachineError("Machine connection is stopped"))
+        else:
+            self._outgoing_commands.put(pending_command)
+        return pending_command
+
+    def _write_commands(self):
+        while True:
+            pending_command = self._outgoing_commands.get()
+            if pending_command is None:
+                break
+            if not self.run_on:
+                pending_command.fail(MachineError("Machine connection is stopped"))
+                continue
+            with self._pending_condition:
+                end_time = time.time() + pending_command.timeout
+                while len(self._pending_commands) >= self.pipeline_depth and self.run_on:
+                    remaining_time = end_time - time.time()
+                    if remaining_time <= 0:
+                        break
+                    self._pending_condition.wait(remaining_time)
+                if len(self._pending_commands) >= self.pipeline_depth:
+                    # disconnect in panic
+                    self.run_on = False
+                    pending_command.fail(MachineError("Machine does not listen!"))
+                    continue
+                # it has to be pending before the reply can arrive
+                self._pending_commands.append(pending_command)
+            _logger.debug("sending command %s", pending_command.command)
             try:
-                while True:
-                    response = self.response_queue.get(timeout=timeout)
-                    if not response.command_number == -1:
-                        _logger.debug("Received %s as response to %s", response, command)
-                        return response
-                    else:
-                        # todo do we timeout here?
-                        _logger.debug("Still waiting: %s", response)
-            except Empty:
-                # disconnect in panic
-                self.run_on = False
-                raise MachineError("Machine does not listen!")
+                encoded_command = _encode_command(pending_command.command)
+                if metrics.enabled:
+                    pending_command.sent = time.time()
+                    _commands_sent.increment()
+                    _bytes_sent.increment(len(encoded_command))
+                with self.serial_lock:
+                    self.machine_serial.write(encoded_command)
+                    self.machine_serial.flush()
+            except Exception as e:
+                _logger.error("Unable to send %s: %s", pending_command.command, e)
+                self.cancel_command(pending_command)
+                pending_command.fail(MachineError("Unable to send command", e))
+
+    def wait_for_reply(self, pending_command, timeout=None):
+        if not timeout:
+            timeout = _default_timeout
+        if not pending_command.wait(timeout):
+            # disconnect in panic
+            self.run_on = False
+            raise MachineError("Machine does not listen!")
+        if pending_command.error:
+            raise pending_command.error
+        _logger.debug("Received %s as response to %s", pending_command.reply, pending_command.command)
+        return pending_command.reply
 
+    def commands_in_flight(self):
+        return self._outgoing_commands.qsize() + len(self._pending_commands)
+
+    def cancel_command(self, pending_command):
+        # the reply is not expected anymore
+        with self._pending_condition:
+            if pending_command in self._pending_commands:
+                self._pending_commands.remove(pending_command)
+                self._pending_condition.notify_all()
+
+    def baud_rate(self):
+        return self.machine_serial.baudrate
+
+    def change_baud_rate(self, baud_rate):
+        with self.serial_lock:
+            self.machine_serial.baudrate = baud_rate
+            # whatever is in there was garbled by the switch
+            self.machine_serial.flushInput()
+
+    def wait_for_keep_alive(self, timeout):
+        """
+        Waits for the next keep alive ping & returns if it has been received.
+        """
+        with self._keep_alive_condition:
+            keep_alive_count = self._keep_alive_count
+            end_time = time.time() + timeout
+            while self._keep_alive_count == keep_alive_count:
+                remaining_time = end_time - time.time()
+                if remaining_time <= 0:
+                    return False
+                self._keep_alive_condition.wait(remaining_time)
+        return True
 
     def last_heart_beat(self):
         if self.last_heartbeat:
@@ -432,15 +834,43 @@ class _MachineConnection:
                     if command.arguments and len(command.arguments) == 2:
                         self.internal_queue_length = command.arguments[0]
                         self.internal_queue_max_length = command.arguments[1]
+                        if self._queue_listener:
+                            self._queue_listener(self.internal_queue_length, self.internal_queue_max_length)
                     else:
                         _logger.warn("did not understand status command %s", command)
+                    with self._keep_alive_condition:
+                        self._keep_alive_count += 1
+                        self._keep_alive_condition.notify_all()
+                elif command.command_number is None:
+                    # e.g. garbage while switching the baud rate - it cannot be the reply to anything
+                    _logger.warn("Ignoring unreadable data from the machine")
+                elif command.command_number == -1:
+                    # todo do we timeout here?
+                    _logger.debug("Still waiting: %s", command)
                 else:
-                    # we add it to the response queue
-                    self.response_queue.put(command)
                     _logger.debug("received command %s", command)
+                    self._reply_received(command)
+
+    def _reply_received(self, reply):
+        # the machine answers in the order the commands were sent
+        with self._pending_condition:
+            if not self._pending_commands:
+                _logger.warn("Received %s without any command waiting for it", reply)
+                return
+            pending_command = self._pending_commands.popleft()
+            self._pending_condition.notify_all()
+        if pending_command.sent is not None:
+            _round_trip_time.observe(time.time() - pending_command.sent)
+        # the replies to moves are checked whenever there is time - but the queue length is news right now
+        if _reports_queue(pending_command.command, reply):
+            self.moves_accepted += 1
+            self.queue_entries_accepted += pending_command.command.queue_entries
+            if self._queue_listener:
+                self._queue_listener(reply.arguments[0], reply.arguments[1])
+        pending_command.answer(reply)
 
-    def _read_next_command(self):
-        line = self._doRead()  # read a ';' terminated line
+    def _read_next_command(self, timeout=_default_timeout):
+        line = self._doRead(timeout)  # read a ';' terminated line
         if not line or not line.strip():
             return None
         line = line.strip()
@@ -448,27 +878,134 @@ class _MachineConnection:
         command = MachineCommand(line)
         return command
 
-    def _doRead(self):
-        buff = self.remaining_buffer
-        tic = time.time()
-        buff += self.machine_serial.read()
+    def _doRead(self, timeout=_default_timeout):
+        end_time = time.time() + timeout
+        line = self._reader.next_line()
+        while line is None and self.run_on and time.time() < end_time:
+            self._reader.fill()
+            line = self._reader.next_line()
+        return line or ''
 
-        # you can use if not ('\n' in buff) too if you don't like re
-        while ((time.time() - tic) < _default_timeout) and (not _commandEndMatcher.search(buff)):
-            buff += self.machine_serial.read()
 
-        if _commandEndMatcher.search(buff):
-            split_result = buff.split(';', 1)
-            self.remaining_buffer = split_result[1]
-            return split_result[0]
-        else:
-            return ''
+class _CommandReader(object):
+    """
+    Reads the serial connection in chunks and splits it into the ';' terminated commands. Every byte is only looked
+    at once - incomplete commands stay in the buffer until the rest arrives.
+    """
+
+    def __init__(self, machine_serial):
+        self.machine_serial = machine_serial
+        self.buffer = bytearray()
+        # where the next command starts & how far we already know that there is no ';'
+        self._start = 0
+        self._scanned = 0
+
+    def fill(self):
+        """
+        Reads everything that is waiting - or waits as long as the serial timeout for at least one byte.
+        """
+        data = self.machine_serial.read(max(_bytes_waiting(self.machine_serial), 1))
+        if data:
+            if self._start:
+                del self.buffer[:self._start]
+                self._scanned -= self._start
+                self._start = 0
+            self.buffer.extend(data)
+        return len(data)
+
+    def next_line(self):
+        end = self.buffer.find(';', self._scanned)
+        if end < 0:
+            self._scanned = len(self.buffer)
+            return None
+        line = str(self.buffer[self._start:end])
+        self._start = self._scanned = end + 1
+        return line
+
+
+def _reports_queue(command, reply):
+    # moves are answered with OK, the queue length & the max queue length
+    return command.command_number in (_move_command, _binary_move_command) and reply.command_number == 0 \
+        and bool(reply.arguments) and len(reply.arguments) >= 2
+
+
+def _bytes_waiting(machine_serial):
+    # pyserial 3 calls it in_waiting
+    if hasattr(machine_serial, 'in_waiting'):
+        return machine_serial.in_waiting
+    return machine_serial.inWaiting()
+
+
+def _encode_command(command):
+    encoded = str(command.command_number)
+    if command.binary_arguments is not None:
+        encoded += "," + encode_binary_arguments(command.binary_arguments)
+    elif command.arguments:
+        encoded_arguments = []
+        for param in command.arguments:
+            if isinstance(param, float):
+                encoded_arguments.append("%.6g" % param)
+                # todo on the other hand an e representation may as well be helpful?
+            else:
+                encoded_arguments.append(repr(param))
+        encoded += "," + ",".join(encoded_arguments)
+    return encoded + ";\n"
+
+
+class _PendingCommand(object):
+    def __init__(self, command, timeout=_default_timeout):
+        self.command = command
+        self.timeout = timeout
+        self.reply = None
+        self.error = None
+        # when it was written to the serial port - if the round trip is measured
+        self.sent = None
+        self._answered = threading.Event()
+
+    def answered(self):
+        return self._answered.is_set()
+
+    def answer(self, reply):
+        self.reply = reply
+        self._answered.set()
+
+    def fail(self, error):
+        self.error = error
+        self._answered.set()
+
+    def wait(self, timeout):
+        return self._answered.wait(timeout)
+
+
+class MachineFuture(object):
+    """
+    The result of a command that has been sent to the machine - it is there as soon as the machine has answered.
+    """
+
+    def __init__(self, machine_connection, pending_command, convert=None):
+        self._machine_connection = machine_connection
+        self._pending_command = pending_command
+        # turns the reply into the result - & raises a MachineError if the reply is not what we wanted
+        self._convert = convert
+
+    def done(self):
+        return self._pending_command.answered()
+
+    def result(self, timeout=None):
+        reply = self._machine_connection.wait_for_reply(self._pending_command, timeout)
+        if self._convert:
+            return self._convert(reply)
+        return reply
 
 
 class MachineCommand():
     def __init__(self, input_line=None):
         self.command_number = None
         self.arguments = None
+        # if given they are sent as binary frame instead of the arguments
+        self.binary_arguments = None
+        # how many entries it takes in the command queue of the arduino - one for every motor of a move
+        self.queue_entries = 0
         if input_line:
             parts = input_line.strip().split(",")
             if len(parts) > 1:
@@ -503,14 +1040,3 @@ class MachineCommand():
             result += ": "
             result += str(self.arguments)
         return result
-
-
-class MachineError(Exception):
-    def __init__(self, msg, additional_info=None):
-        self.msg = msg
-        self.additional_info = additional_info
-
-    def __str__(self):
-        return super(MachineError, self).__str__() + "[" + str(self.additional_info) + "]"
-
-
@@ -0,0 +1,123 @@
+# coding=utf-8
+"""
+How the commands look on the wire: the binary moves & the frames which carry binary arguments through CmdMessenger.
+"""
+import struct
+
+__author__ = 'marcus'
+
+# the payload of a binary move: number of motors & for every motor: motor, target, type, speed, acceleration, bow
+# frames are length | payload | checksum - COBS encoded & escaped for CmdMessenger
+_binary_move_header = struct.Struct('<B')
+_binary_move_motor = struct.Struct('<BiBffi')
+_cmd_messenger_escape = '/'
+
+
+def encode_binary_move(move_arguments):
+    # the arguments of the ascii move command - 6 for each motor
+    motor_count = len(move_arguments) / 6
+    payload = [_binary_move_header.pack(motor_count)]
+    for motor_number in range(motor_count):
+        payload.append(_binary_move_motor.pack(*move_arguments[motor_number * 6:(motor_number + 1) * 6]))
+    return "".join(payload)
+
+
+def decode_binary_move(binary_arguments):
+    # the arguments of the ascii move command
+    motor_count = _binary_move_header.unpack_from(binary_arguments)[0]
+    if len(binary_arguments) != _binary_move_header.size + motor_count * _binary_move_motor.size:
+        raise MachineError("Move with %s motors has the wrong length %s" % (motor_count, len(binary_arguments)))
+    arguments = []
+    for motor_number in range(motor_count):
+        arguments.extend(_binary_move_motor.unpack_from(binary_arguments,
+                                                        _binary_move_header.size
+                                                        + motor_number * _binary_move_motor.size))
+    return arguments
+
+
+def encode_binary_arguments(binary_arguments):
+    return _escape(_cobs_encode(_frame(binary_arguments)))
+
+
+def decode_binary_arguments(encoded):
+    return _unframe(_cobs_decode(_unescape(encoded)))
+
+
+def _frame(payload):
+    # length | payload | checksum
+    if len(payload) > 255:
+        raise MachineError("Payload of %s bytes is too long for a frame" % len(payload))
+    frame = chr(len(payload)) + payload
+    return frame + chr(sum(bytearray(frame)) & 0xFF)
+
+
+def _unframe(frame):
+    frame = bytearray(frame)
+    if len(frame) < 2 or frame[0] != len(frame) - 2:
+        raise MachineError("Frame has the wrong length")
+    if sum(frame[:-1]) & 0xFF != frame[-1]:
+        raise MachineError("Frame has the wrong checksum")
+    return str(frame[1:-1])
+
+
+def _cobs_encode(data):
+    # consistent overhead byte stuffing - afterwards there is no 0 in the data
+    encoded = bytearray()
+    block = bytearray()
+    for byte in bytearray(data):
+        if byte == 0:
+            encoded.append(len(block) + 1)
+            encoded.extend(block)
+            block = bytearray()
+        else:
+            block.append(byte)
+            if len(block) == 254:
+                encoded.append(255)
+                encoded.extend(block)
+                block = bytearray()
+    encoded.append(len(block) + 1)
+    encoded.extend(block)
+    return str(encoded)
+
+
+def _cobs_decode(data):
+    data = bytearray(data)
+    decoded = bytearray()
+    index = 0
+    while index < len(data):
+        code = data[index]
+        if code == 0 or index + code > len(data):
+            raise MachineError("Broken COBS encoding")
+        decoded.extend(data[index + 1:index + code])
+        index += code
+        if code != 0xFF and index < len(data):
+            decoded.append(0)
+    return str(decoded)
+
+
+def _escape(data):
+    # CmdMessenger must not see any unescaped separator
+    return data.replace(_cmd_messenger_escape, _cmd_messenger_escape * 2) \
+        .replace(',', _cmd_messenger_escape + ',') \
+        .replace(';', _cmd_messenger_escape + ';')
+
+
+def _unescape(data):
+    unescaped = []
+    escaped = False
+    for character in data:
+        if character == _cmd_messenger_escape and not escaped:
+            escaped = True
+            continue
+        unescaped.append(character)
+        escaped = False
+    return "".join(unescaped)
+
+
+class MachineError(Exception):
+    def __init__(self, msg, additional_info=None):
+        self.msg = msg
+        self.additional_info = additional_info
+
+    def __str__(self):
+        return super(MachineError, self).__str__() + "[" + str(self.additional_info) + "]"
@@ -0,0 +1,193 @@
+from bisect import bisect_left
+from collections import deque
+import threading
+import time
+
+__author__ = 'marcus'
+
+# latencies from a microsecond to half a minute - every bucket twice as big as the one before
+LATENCY_BUCKETS = tuple(0.000001 * 2 ** exponent for exponent in range(25))
+# how full a buffer is - 0 to 1
+FILL_BUCKETS = tuple(step / 10.0 for step in range(11))
+# how often the gauges are written down - and how many samples are kept (5 minutes)
+_DEFAULT_SAMPLE_INTERVAL = 0.5
+_DEFAULT_SAMPLE_COUNT = 600
+_PERCENTILES = (50, 90, 99)
+
+
+class Counter(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def increment(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def reset(self):
+        with self._lock:
+            self.value = 0
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    """
+    The current value of something - e.g. a queue length. Every change is a chance for the registry to write down the
+    values of all gauges.
+    """
+
+    def __init__(self, registry):
+        self._registry = registry
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+        self._registry.sample_gauges()
+
+    def reset(self):
+        self.value = 0
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    Counts the observed values in buckets - a value goes to the first bucket it is not bigger than, the last bucket
+    takes everything bigger than the largest bound.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def observe(self, value):
+        bucket = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += value
+            if self.max is None or value > self.max:
+                self.max = value
+            if self.min is None or value < self.min:
+                self.min = value
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.min = None
+            self.max = None
+
+    def percentile(self, percent):
+        """
+        The upper bound of the bucket the percentile falls into - or the maximum if it is in the last bucket.
+        """
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                if bucket < len(self.bounds):
+                    return min(self.bounds[bucket], self.max)
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                'count': self.count,
+                'sum': self.sum,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                # only the buckets with something in it - as upper bound & count, None is the overflow bucket
+                'buckets': [(self.bounds[bucket] if bucket < len(self.bounds) else None, count)
+                            for bucket, count in enumerate(self.counts) if count]
+            }
+            for percent in _PERCENTILES:
+                snapshot['p%s' % percent] = self.percentile(percent)
+        return snapshot
+
+
+class Metrics(object):
+    """
+    Counters, gauges & histograms of the print pipeline. The instruments are created once when the modules are loaded,
+    the code measuring something checks enabled first - so that disabled metrics cost nothing but that check.
+    The values of all gauges are written down every sample_interval seconds (if any of them changes).
+    """
+
+    def __init__(self, sample_interval=_DEFAULT_SAMPLE_INTERVAL, sample_count=_DEFAULT_SAMPLE_COUNT):
+        self.enabled = True
+        self.sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        # (time, {gauge: value}) of the last sample_count samples
+        self.samples = deque(maxlen=sample_count)
+        self._next_sample = 0
+        self.started = time.time()
+
+    def counter(self, name):
+        with self._lock:
+            if name not in self._counters:
+                self._counters[name] = Counter()
+            return self._counters[name]
+
+    def gauge(self, name):
+        with self._lock:
+            if name not in self._gauges:
+                self._gauges[name] = Gauge(self)
+            return self._gauges[name]
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(bounds)
+            return self._histograms[name]
+
+    def sample_gauges(self, now=None):
+        if now is None:
+            now = time.time()
+        if now < self._next_sample:
+            return
+        with self._lock:
+            if now < self._next_sample:
+                return
+            self._next_sample = now + self.sample_interval
+            self.samples.append((now, dict((name, gauge.value) for name, gauge in self._gauges.iteritems())))
+
+    def reset(self):
+        with self._lock:
+            for instrument in self._counters.values() + self._gauges.values() + self._histograms.values():
+                instrument.reset()
+            self.samples.clear()
+            self._next_sample = 0
+            self.started = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = dict(self._histograms)
+            samples = list(self.samples)
+        return {
+            'enabled': self.enabled,
+            'time': time.time(),
+            'started': self.started,
+            'counters': dict((name, counter.snapshot()) for name, counter in counters.iteritems()),
+            'gauges': dict((name, gauge.snapshot()) for name, gauge in gauges.iteritems()),
+            'histograms': dict((name, histogram.snapshot()) for name, histogram in histograms.iteritems()),
+            'samples': [{'time': sample_time, 'gauges': values} for sample_time, values in samples]
+        }
+
+
+# THE metrics of the print server
+metrics = Metrics()
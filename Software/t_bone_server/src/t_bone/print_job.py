@@ -0,0 +1,176 @@
+# coding=utf-8
+from bisect import bisect_right
+import logging
+import os
+import struct
+
+from gcode_tokenizer import tokenize_gcode_line, GCodeRecord, Z_WORD
+
+__author__ = 'marcus'
+_logger = logging.getLogger(__name__)
+
+# a print job is the g code compiled to fixed width binary records:
+# header | records … | code table | layer index | footer
+JOB_FILE_EXTENSION = '.tbone'
+_job_magic = 'TBJ\x01'
+_job_footer_magic = 'TBJE'
+# magic, source size & source modification time - so we know if the job is still current
+_header = struct.Struct('<4sQd')
+# code index, present bits, x, y, z, e, f, s
+_record = struct.Struct('<HH4d2f')
+# offset of the first record of the layer, z height
+_layer = struct.Struct('<Qd')
+_count = struct.Struct('<I')
+# code table offset, layer index offset, magic
+_footer = struct.Struct('<QQ4s')
+_records_per_read = 4096
+_write_buffer_size = 1024 * 1024
+
+
+def job_file_name(gcode_file):
+    return gcode_file + JOB_FILE_EXTENSION
+
+
+def _source_signature(gcode_file):
+    stat = os.stat(gcode_file)
+    return stat.st_size, stat.st_mtime
+
+
+def current_job(gcode_file):
+    # the compiled job - if there is one and it belongs to the current version of the g code
+    job_file = job_file_name(gcode_file)
+    if not os.path.isfile(job_file):
+        return None
+    try:
+        reader = PrintJobReader(job_file)
+    except PrintJobError as e:
+        _logger.warn("Ignoring broken print job %s: %s", job_file, e)
+        return None
+    if reader.source_signature != _source_signature(gcode_file):
+        _logger.info("Print job %s is outdated", job_file)
+        return None
+    return reader
+
+
+def compile_gcode(gcode_file, job_file=None):
+    if not job_file:
+        job_file = job_file_name(gcode_file)
+    source_size, source_mtime = _source_signature(gcode_file)
+    # we write to a temporary file so that nobody reads a half done job
+    temporary_file = job_file + '.tmp'
+    code_numbers = {}
+    codes = []
+    layers = []
+    last_z = None
+    record_count = 0
+    with open(gcode_file, 'r', _write_buffer_size) as gcode_input, \
+            open(temporary_file, 'wb', _write_buffer_size) as job_output:
+        job_output.write(_header.pack(_job_magic, source_size, source_mtime))
+        offset = _header.size
+        for line in gcode_input:
+            gcode = tokenize_gcode_line(line)
+            if not gcode:
+                continue
+            code = gcode.code
+            code_number = code_numbers.get(code)
+            if code_number is None:
+                code_number = len(codes)
+                code_numbers[code] = code_number
+                codes.append(code)
+            if gcode.present & Z_WORD and (code == "G1" or code == "G0") and gcode.z != last_z:
+                last_z = gcode.z
+                layers.append((offset, last_z))
+            job_output.write(_record.pack(code_number, gcode.present,
+                                          gcode.x, gcode.y, gcode.z, gcode.e, gcode.f, gcode.s))
+            offset += _record.size
+            record_count += 1
+        code_table_offset = offset
+        job_output.write(_count.pack(len(codes)))
+        for code in codes:
+            job_output.write(chr(len(code)))
+            job_output.write(code)
+        layer_index_offset = job_output.tell()
+        job_output.write(_count.pack(len(layers)))
+        for layer in layers:
+            job_output.write(_layer.pack(*layer))
+        job_output.write(_footer.pack(code_table_offset, layer_index_offset, _job_footer_magic))
+    os.rename(temporary_file, job_file)
+    _logger.info("Compiled %s to %s: %s records in %s layers", gcode_file, job_file, record_count, len(layers))
+    return job_file
+
+
+class PrintJobReader(object):
+    def __init__(self, job_file):
+        self.job_file = job_file
+        self.size = os.path.getsize(job_file)
+        if self.size < _header.size + _footer.size:
+            raise PrintJobError("Print job too short")
+        with open(job_file, 'rb') as job_input:
+            magic, source_size, source_mtime = _header.unpack(job_input.read(_header.size))
+            if magic != _job_magic:
+                raise PrintJobError("Not a print job")
+            self.source_signature = (source_size, source_mtime)
+            job_input.seek(self.size - _footer.size)
+            code_table_offset, layer_index_offset, footer_magic = _footer.unpack(job_input.read(_footer.size))
+            if footer_magic != _job_footer_magic:
+                raise PrintJobError("Print job is incomplete")
+            self.records_end = code_table_offset
+            job_input.seek(code_table_offset)
+            self.codes = []
+            for code_number in xrange(_count.unpack(job_input.read(_count.size))[0]):
+                code_length = ord(job_input.read(1))
+                self.codes.append(job_input.read(code_length))
+            job_input.seek(layer_index_offset)
+            self.layers = []
+            for layer_number in xrange(_count.unpack(job_input.read(_count.size))[0]):
+                self.layers.append(_layer.unpack(job_input.read(_layer.size)))
+        self._layer_offsets = [offset for offset, z in self.layers]
+
+    @property
+    def record_count(self):
+        return (self.records_end - _header.size) / _record.size
+
+    @property
+    def record_size(self):
+        return _record.size
+
+    def layer_at(self, bytes_printed):
+        # 0 is everything before the first layer
+        return bisect_right(self._layer_offsets, _header.size + bytes_printed)
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self, start_offset=None):
+        codes = self.codes
+        unpack_from = _record.unpack_from
+        record_size = _record.size
+        if start_offset is None:
+            start_offset = _header.size
+        with open(self.job_file, 'rb') as job_input:
+            job_input.seek(start_offset)
+            remaining = self.records_end - start_offset
+            while remaining > 0:
+                chunk = job_input.read(min(remaining, _records_per_read * record_size))
+                if not chunk:
+                    raise PrintJobError("Print job ended unexpectedly")
+                remaining -= len(chunk)
+                for offset in xrange(0, len(chunk), record_size):
+                    code_number, present, x, y, z, e, f, s = unpack_from(chunk, offset)
+                    gcode = GCodeRecord(codes[code_number])
+                    gcode.present = present
+                    gcode.x = x
+                    gcode.y = y
+                    gcode.z = z
+                    gcode.e = e
+                    gcode.f = f
+                    gcode.s = s
+                    yield gcode
+
+
+class PrintJobError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
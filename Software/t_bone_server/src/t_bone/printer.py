@@ -1,6 +1,7 @@
 # coding=utf-8
 from Adafruit_BBIO import PWM
-from Queue import Queue, Empty
+from Queue import Queue, Empty, Full
+from collections import namedtuple, deque
 from copy import deepcopy
 import logging
 from math import copysign, sqrt
@@ -12,9 +13,12 @@ import beagle_bone_pins
 from heater import PwmHeater, Thermometer, PID, OnOffHeater
 
 from machine import Machine, MAXIMUM_FREQUENCY_ACCELERATION, MAXIMUM_FREQUENCY_BOW
-from helpers import convert_mm_to_steps, find_shortest_vector, calculate_relative_vector, \
-    convert_velocity_clock_ref_to_realtime_ref, convert_acceleration_clock_ref_to_realtime_ref
+from helpers import convert_mm_to_steps, convert_velocity_clock_ref_to_realtime_ref, \
+    convert_acceleration_clock_ref_to_realtime_ref
 from LEDS import LedManager
+from metrics import metrics
+from queue_sizing import QueueSizer
+from starvation import StarvationDetector
 
 __author__ = 'marcus'
 _logger = logging.getLogger(__name__)
@@ -27,6 +31,21 @@ _axis_config = {
 }
 # order of the axis
 _axis_names = ('x', 'y', 'z')
+# maps the print queue config entries to the arguments of the queue sizer
+_queue_sizer_config = {
+    'smallest-length': 'smallest_window',
+    'largest-length': 'largest_window',
+    'buffer-time': 'buffer_time',
+}
+_planning_time = metrics.histogram('planner_recalculation_seconds')
+_execution_queue_wait_time = metrics.histogram('planner_execution_queue_wait_seconds')
+_planning_queue_length = metrics.gauge('planning_queue_length')
+_execution_queue_length = metrics.gauge('execution_queue_length')
+_move_config_time = metrics.histogram('move_config_seconds')
+_move_send_time = metrics.histogram('move_send_seconds')
+_moves_planned = metrics.counter('moves_planned')
+_moves_executed = metrics.counter('moves_executed')
+_planning_window_length = metrics.gauge('planning_window_length')
 
 
 class Printer(Thread):
@@ -49,6 +68,8 @@ class Printer(Thread):
         self._print_queue = None
         self.print_queue_min_length = print_queue_min_length
         self.print_queue_max_length = print_queue_max_length
+        # sizes the planning window while printing - if the config asks for it
+        self.queue_sizer = None
         self._default_homing_retraction = None
         self._x_step_conversion = None
         self._y_step_conversion = None
@@ -64,6 +85,10 @@ class Printer(Thread):
 
         # finally create the machine
         self.machine = Machine(serial_port=serial_port, reset_pin=reset_pin)
+        # tells us when the arduino runs dry during a print - & why
+        self.starvation_detector = StarvationDetector(self._host_queue_lengths)
+        self.machine.queue_listeners.append(self.starvation_detector.queue_reported)
+        self.machine.queue_listeners.append(self._queue_reported)
         self.running = True
         self.start()
 
@@ -72,6 +97,10 @@ class Printer(Thread):
             self.running = False
         if self.isAlive():
             self.join()
+        # the heater threads would keep the heaters on - and the process running
+        for heater in (self.extruder_heater, self.heated_bed):
+            if heater:
+                heater.stop()
         self.machine.disconnect()
 
     def axis_names(self):
@@ -87,10 +116,26 @@ class Printer(Thread):
         print_queue_config = printer_config["print-queue"]
         self.print_queue_min_length = print_queue_config['min-length']
         self.print_queue_max_length = print_queue_config['max-length']
+        if 'starved-queue-length' in print_queue_config:
+            self.starvation_detector.starved_queue_length = print_queue_config['starved-queue-length']
+        if print_queue_config.get('adaptive'):
+            sizer_config = {}
+            for config_name, argument in _queue_sizer_config.iteritems():
+                if config_name in print_queue_config:
+                    sizer_config[argument] = print_queue_config[config_name]
+            # min-length is just where every print starts
+            self.queue_sizer = QueueSizer(self.print_queue_min_length, **sizer_config)
+        else:
+            self.queue_sizer = None
         self._homing_timeout = printer_config['homing-timeout']
         self._default_homing_retraction = printer_config['home-retract']
         self.default_speed = printer_config['default-speed']
 
+        if 'serial' in printer_config:
+            self.machine.configure_serial(printer_config['serial'])
+        # the metrics are cheap - but not for free
+        metrics.enabled = bool(printer_config.get('metrics', True))
+
         # todo this is the fan and should be configured
         PWM.start(self._FAN_OUTPUT, printer_config['fan-duty-cycle'], printer_config['fan-frequency'], 0)
 
@@ -110,25 +155,49 @@ class Printer(Thread):
             self._configure_axis(axis, config[config_name])
         self._postconfig()
 
-    def connect(self):
+    def connect(self, soft_connect=True):
         _logger.debug("Connecting printer")
-        self.machine.connect()
+        self.machine.connect(soft_connect=soft_connect)
 
 
     def start_print(self):
+        if self.queue_sizer:
+            self.queue_sizer.start(self.print_queue_min_length)
         self._print_queue = PrintQueue(axis_config=self.axis, min_length=self.print_queue_min_length,
-                                       max_length=self.print_queue_max_length, default_target_speed=self.default_speed)
+                                       max_length=self.print_queue_max_length, default_target_speed=self.default_speed,
+                                       queue_sizer=self.queue_sizer)
         self.machine.start_motion()
+        self.starvation_detector.start()
         self.printing = True
         self.led_manager.light(1, True)
 
 
     def finish_print(self):
+        # the g code has ended - from now on the arduino is expected to run dry
+        self.starvation_detector.finish()
         self._print_queue.finish()
         self.machine.finish_motion()
         self.printing = False
         self.led_manager.light(1, False)
 
+    def _queue_reported(self, queue_length, max_queue_length):
+        queue_sizer = self.queue_sizer
+        print_queue = self._print_queue
+        if not queue_sizer or not self.printing or not print_queue:
+            return
+        moves_accepted, queue_entries_accepted = self.machine.moves_accepted()
+        window_length = queue_sizer.queue_reported(queue_length, moves_accepted, queue_entries_accepted)
+        if window_length:
+            print_queue.resize(window_length)
+            if metrics.enabled:
+                _planning_window_length.set(window_length)
+
+    def _host_queue_lengths(self):
+        print_queue = self._print_queue
+        if not print_queue:
+            return 0, 0, self.machine.commands_in_flight
+        return len(print_queue.planning_list), print_queue.queue.qsize(), self.machine.commands_in_flight
+
     def read_motor_positons(self):
         positions = {}
         for axis_name in self.axis:
@@ -139,12 +208,15 @@ class Printer(Thread):
         return positions
 
     def read_axis_status(self):
+        # one question for all motors
+        motors = [self.axis[axis_name]['motor'] for axis_name in self.axis if self.axis[axis_name]['motor']]
+        motor_status = self.machine.read_axes_status(motors)
         status = {}
         for axis_name in self.axis:
             axis_config = self.axis[axis_name]
             motor = axis_config['motor']
             if motor:
-                internal_status = self.machine.read_axis_status(motor)
+                internal_status = motor_status[motor]
                 position = internal_status['position']
                 position = position / axis_config['steps_per_mm']
                 encoder_pos = internal_status['encoder_pos']
@@ -254,17 +326,25 @@ class Printer(Thread):
             self.finish_print()
 
     def execute_movement(self, movement):
-        if movement['type'] == 'move':
+        if movement.type == 'move':
+            measured = metrics.enabled
+            if measured:
+                start = time.time()
             step_pos, step_speed_vector = self._add_movement_calculations(movement)
             x_move_config, y_move_config, z_move_config, e_move_config = self._generate_move_config(movement,
                                                                                                     step_pos,
                                                                                                     step_speed_vector)
+            if measured:
+                configured = time.time()
+                _move_config_time.observe(configured - start)
             self._move(movement, step_pos, x_move_config, y_move_config, z_move_config, e_move_config)
-        elif movement['type'] == 'set_position':
+            if measured:
+                _move_send_time.observe(time.time() - configured)
+                _moves_executed.increment()
+        elif movement.type == 'set_position':
             for axis_name in self.axis:
-                set_pos_name = "s%s" % axis_name
-                if set_pos_name in movement:
-                    position = movement[set_pos_name]
+                if axis_name in movement.set_positions:
+                    position = movement.set_positions[axis_name]
                     axis = self.axis[axis_name]
                     step_position = convert_mm_to_steps(position, axis['steps_per_mm'])
                     if 'motor' in axis and axis['motor']:
@@ -290,7 +370,10 @@ class Printer(Thread):
                 try:
                     # get the next movement from stack
                     movement = self._print_queue.next_movement(self._print_queue_wait_time)
-                    self.execute_movement(movement)
+                    try:
+                        self.execute_movement(movement)
+                    finally:
+                        self._print_queue.movement_done()
                 except Empty:
                     _logger.debug("Print Queue did not return a value - this can be pretty normal")
             else:
@@ -515,18 +598,18 @@ class Printer(Thread):
 
     def _add_movement_calculations(self, movement):
         step_pos = {
-            'x': convert_mm_to_steps(movement['x'], self.axis['x']['steps_per_mm']),
-            'y': convert_mm_to_steps(movement['y'], self.axis['y']['steps_per_mm']),
-            'z': convert_mm_to_steps(movement['z'], self.axis['z']['steps_per_mm']),
-            'e': convert_mm_to_steps(movement['e'], self.axis['e']['steps_per_mm'])
+            'x': convert_mm_to_steps(movement.x, self.axis['x']['steps_per_mm']),
+            'y': convert_mm_to_steps(movement.y, self.axis['y']['steps_per_mm']),
+            'z': convert_mm_to_steps(movement.z, self.axis['z']['steps_per_mm']),
+            'e': convert_mm_to_steps(movement.e, self.axis['e']['steps_per_mm'])
         }
-        relative_move_vector = movement['relative_move_vector']
-        z_speed = min(abs(relative_move_vector['v'] * relative_move_vector['z']), self.axis['z']['max_speed'])
-        e_speed = min(abs(relative_move_vector['v'] * relative_move_vector['e']), self.axis['e']['max_speed'])
+        relative_move_vector = movement.relative_move_vector
+        z_speed = min(abs(relative_move_vector.v * relative_move_vector.z), self.axis['z']['max_speed'])
+        e_speed = min(abs(relative_move_vector.v * relative_move_vector.e), self.axis['e']['max_speed'])
         step_speed_vector = {
             # todo - this can be clock signal referenced - convert acc. to  axis['clock-referenced']
-            'x': max(convert_mm_to_steps(abs(movement['speed']['x']), self.axis['x']['steps_per_mm']), 1),
-            'y': max(convert_mm_to_steps(abs(movement['speed']['y']), self.axis['y']['steps_per_mm']), 1),
+            'x': max(convert_mm_to_steps(abs(movement.speed.x), self.axis['x']['steps_per_mm']), 1),
+            'y': max(convert_mm_to_steps(abs(movement.speed.y), self.axis['y']['steps_per_mm']), 1),
             'z': max(convert_mm_to_steps(z_speed, self.axis['z']['steps_per_mm']), 1),
             'e': max(convert_mm_to_steps(e_speed, self.axis['e']['steps_per_mm']), 1)
         }
@@ -540,29 +623,29 @@ class Printer(Thread):
                 'startBow': axis['bow_step'],
             }
 
-        if movement['delta_x']:
+        if movement.delta_x:
             x_move_config = _axis_movement_template(self.axis['x'])
             x_move_config['target'] = step_pos['x']
             x_move_config['speed'] = abs(step_speed_vector['x'])
-            if 'x_stop' in movement:
+            if movement.x_stop:
                 x_move_config['type'] = 'stop'
             else:
                 x_move_config['type'] = 'way'
         else:
             x_move_config = None
 
-        if movement['delta_y']:
+        if movement.delta_y:
             y_move_config = _axis_movement_template(self.axis['y'])
             y_move_config['target'] = step_pos['y']
             y_move_config['speed'] = abs(step_speed_vector['y'])
-            if 'y_stop' in movement:
+            if movement.y_stop:
                 y_move_config['type'] = 'stop'
             else:
                 y_move_config['type'] = 'way'
         else:
             y_move_config = None
 
-        if movement['delta_z']:
+        if movement.delta_z:
             z_move_config = [
                 {
                     'motor': self.axis['z']['motors'][0],
@@ -584,11 +667,11 @@ class Printer(Thread):
         else:
             z_move_config = None
 
-        if movement['delta_e']:
+        if movement.delta_e:
             e_move_config = _axis_movement_template(self.axis['e'])
             e_move_config['target'] = step_pos['e']
             e_move_config['speed'] = abs(step_speed_vector['e'])
-            if movement['e_stop']:
+            if movement.e_stop:
                 e_move_config['type'] = 'stop'
             else:
                 e_move_config['type'] = 'way'
@@ -598,7 +681,7 @@ class Printer(Thread):
         return x_move_config, y_move_config, z_move_config, e_move_config
 
     def _move(self, movement, step_pos, x_move_config, y_move_config, z_move_config, e_move_config):
-        move_vector = movement['relative_move_vector']
+        move_vector = movement.relative_move_vector
         move_commands = []
         if x_move_config and not y_move_config:  # silly, but simpler to understand
             # move x motor
@@ -617,8 +700,8 @@ class Printer(Thread):
             ]
         elif x_move_config and y_move_config:
             # ok we have to see which axis has bigger movement
-            if abs(movement['delta_x']) > abs(movement['delta_y']):
-                y_factor = abs(move_vector['y'] / move_vector['x'] * self._y_step_conversion)
+            if abs(movement.delta_x) > abs(movement.delta_y):
+                y_factor = abs(move_vector.y / move_vector.x * self._y_step_conversion)
                 _logger.debug(
                     "Moving X axis to %s gearing Y by %s to %s"
                     , step_pos['x'], y_factor, step_pos['y'])
@@ -634,7 +717,7 @@ class Printer(Thread):
                     y_move_config
                 ]
             else:
-                x_factor = abs(move_vector['x'] / move_vector['y'] * self._x_step_conversion)
+                x_factor = abs(move_vector.x / move_vector.y * self._x_step_conversion)
                 _logger.debug(
                     "Moving Y axis to %s gearing X by %s  to %s"
                     , step_pos['x'], x_factor, step_pos['y'])
@@ -650,14 +733,14 @@ class Printer(Thread):
                     x_move_config
                 ]
         if e_move_config:
-            if x_move_config and not (y_move_config and abs(move_vector['x']) < abs(move_vector['y'])):
-                factor = abs(move_vector['e'] / move_vector['x'] * self._e_x_step_conversion)
+            if x_move_config and not (y_move_config and abs(move_vector.x) < abs(move_vector.y)):
+                factor = abs(move_vector.e / move_vector.x * self._e_x_step_conversion)
                 e_move_config['speed'] = factor * x_move_config['speed']
                 e_move_config['acceleration'] = factor * x_move_config[
                     'acceleration']
                 e_move_config['startBow'] = factor * x_move_config['startBow']
             elif y_move_config:
-                factor = abs(move_vector['e'] / move_vector['y'] * self._e_y_step_conversion)
+                factor = abs(move_vector.e / move_vector.y * self._e_y_step_conversion)
                 e_move_config['speed'] = factor * y_move_config['speed']
                 e_move_config['acceleration'] = factor * y_move_config[
                     'acceleration']
@@ -669,72 +752,197 @@ class Printer(Thread):
             move_commands.extend(z_move_config)
 
         # we update our position
-        # todo isn't there a speedier way
-        for axis_name in self.axis:
-            self.axis_position[axis_name] = movement[axis_name]
+        self.axis_position['x'] = movement.x
+        self.axis_position['y'] = movement.y
+        self.axis_position['z'] = movement.z
+        self.axis_position['e'] = movement.e
 
         if move_commands:
             # we move only if there is something to move …
             self.machine.move_to(move_commands)
 
 
+# the speed of the x & y axis in a move
+SpeedVector = namedtuple('SpeedVector', ('x', 'y'))
+
+
+class MoveVector(object):
+    """
+    The normalized direction of a move, its length l and the factor v to get the speed along an axis.
+    """
+    __slots__ = ('x', 'y', 'z', 'e', 'l', 'v')
+
+    def __init__(self, x=0.0, y=0.0, z=0.0, e=0.0, l=0.0, v=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.e = e
+        self.l = l
+        self.v = v
+
+
+class Move(object):
+    """
+    A planned movement - the absolute target, the deltas from the previous move and the planned speed.
+    x_stop, y_stop & e_stop mark that the axis has to stop at the end of the move.
+    """
+    __slots__ = ('type', 'x', 'y', 'z', 'e', 'delta_x', 'delta_y', 'delta_z', 'delta_e', 'target_speed',
+                 'relative_move_vector', 'max_achievable_speed_vector', 'speed', 'x_stop', 'y_stop', 'e_stop',
+                 'set_positions')
+
+    def __init__(self, type, x, y, z, e):
+        self.type = type
+        self.x = x
+        self.y = y
+        self.z = z
+        self.e = e
+        self.delta_x = 0
+        self.delta_y = 0
+        self.delta_z = 0
+        self.delta_e = 0
+        self.target_speed = 0
+        self.relative_move_vector = None
+        self.max_achievable_speed_vector = None
+        self.speed = None
+        self.x_stop = False
+        self.y_stop = False
+        self.e_stop = False
+        self.set_positions = None
+
+    def __repr__(self):
+        return "%s to X:%s, Y:%s, Z:%s, E:%s at %s" % (self.type, self.x, self.y, self.z, self.e, self.speed)
+
+
 class PrintQueue():
-    def __init__(self, axis_config, min_length, max_length, default_target_speed=None, led_manager=None):
+    def __init__(self, axis_config, min_length, max_length, default_target_speed=None, led_manager=None,
+                 queue_sizer=None):
         self.axis = axis_config
-        self.planning_list = list()
+        # the planning window is at most queue_size + 1 moves long, we append on the right and take from the left
+        self.planning_list = deque()
         self.queue_size = min_length - 1  # since we got one extra
         self.queue = Queue(maxsize=(max_length - min_length))
+        # if the planning window is resized the execution queue grows & shrinks with it
+        self._execution_queue_ratio = float(max_length - min_length) / min_length
         self.previous_movement = None
         # we will use the last_movement as special case since it may not fully configured
         self.default_target_speed = default_target_speed
         self.led_manager = led_manager
+        # gets the planning time of every move
+        self.queue_sizer = queue_sizer
+
+    def resize(self, window_length):
+        """
+        Changes how many moves are planned ahead. If the window gets shorter the moves beyond it are given to the
+        execution queue with the next move.
+        """
+        window_length = max(int(window_length), 2)
+        queue = self.queue
+        with queue.not_full:
+            queue.maxsize = max(int(round(window_length * self._execution_queue_ratio)), 1)
+            # somebody may wait for a place in a longer queue
+            queue.not_full.notify_all()
+        self.queue_size = window_length - 1
 
     def add_movement(self, target_position, timeout=None):
+        sized = self.queue_sizer is not None
+        if sized:
+            start = time.time()
         # calculate the target
         move = self._extract_movement_values(target_position)
         # and see how fast we can allowable go
         # TODO currently the maximum achievable speed only considers x & y movements
         maximum_achievable_speed = self._maximum_achievable_speed(move)
-        move['max_achievable_speed_vector'] = maximum_achievable_speed
+        move.max_achievable_speed_vector = maximum_achievable_speed
         # and since we do not know it better the first guess is that the final speed is the max speed
-        move['speed'] = maximum_achievable_speed
+        move.speed = maximum_achievable_speed
         # now we can push the previous move to the queue and recalculate the whole queue
         if self.previous_movement:
             self.planning_list.append(self.previous_movement)
             # if the list is long enough we can give it to the queue so that readers can get it
-        if len(self.planning_list) > self.queue_size:
-            self._push_from_planning_to_execution(timeout)
+        measured = metrics.enabled
+        # waiting for the execution queue is no planning
+        waited = 0.0
+        pushed = False
+        # after the window got shorter there may be more than one move to push
+        while len(self.planning_list) > self.queue_size:
+            pushed = True
+            if measured or sized:
+                wait_start = time.time()
+                self._push_from_planning_to_execution(timeout)
+                waited += time.time() - wait_start
+            else:
+                self._push_from_planning_to_execution(timeout)
+        if measured and pushed:
+            _execution_queue_wait_time.observe(waited)
         self.previous_movement = move
         # and recalculate the maximum allowed speed
-        self._recalculate_move_speeds()
+        if measured:
+            recalculation_start = time.time()
+            self._recalculate_move_speeds()
+            _planning_time.observe(time.time() - recalculation_start)
+            _moves_planned.increment()
+            _planning_queue_length.set(len(self.planning_list))
+            _execution_queue_length.set(self.queue.qsize())
+        else:
+            self._recalculate_move_speeds()
+        if sized:
+            self.queue_sizer.move_planned(time.time() - start - waited)
 
     def next_movement(self, timeout=None):
         return self.queue.get(timeout=timeout)
 
+    def movement_done(self):
+        # every movement taken by next_movement has to be reported as done after it was executed
+        self.queue.task_done()
+
     def finish(self, timeout=None):
         if self.previous_movement:
-            self.previous_movement['x_stop'] = True
-            self.previous_movement['y_stop'] = True
-            self.previous_movement['e_stop'] = True
+            self.previous_movement.x_stop = True
+            self.previous_movement.y_stop = True
+            self.previous_movement.e_stop = True
             self.planning_list.append(self.previous_movement)
             self.previous_movement = None
         while len(self.planning_list) > 0:
-            self._push_from_planning_to_execution(timeout)
-        while not self.queue.empty():
-            pass
+            # the move only leaves the planning list once the queue took it, so a later finish can retry
+            try:
+                self.queue.put(self.planning_list[0], timeout=timeout)
+            except Full:
+                _logger.warn("%s movements could not be queued for execution within %ss", len(self.planning_list),
+                             timeout)
+                return False
+            self.planning_list.popleft()
+        return self._wait_for_execution(timeout)
+
+    def _wait_for_execution(self, timeout):
+        # like Queue.join() - but with a timeout, returns False if the movements were not executed in time
+        all_tasks_done = self.queue.all_tasks_done
+        with all_tasks_done:
+            if timeout is None:
+                while self.queue.unfinished_tasks:
+                    all_tasks_done.wait()
+            else:
+                end_time = time.time() + timeout
+                while self.queue.unfinished_tasks:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        _logger.warn("%s movements still not executed after %ss", self.queue.unfinished_tasks,
+                                     timeout)
+                        return False
+                    all_tasks_done.wait(remaining)
+        return True
 
     def _push_from_planning_to_execution(self, timeout):
-        executed_move = self.planning_list.pop(0)
+        executed_move = self.planning_list.popleft()
         self.queue.put(executed_move, timeout=timeout)
         _logger.debug("adding to execution queue, now at %s/%s entries", len(self.planning_list), self.queue.qsize())
 
     def _extract_movement_values(self, target_position):
-        move = {}
-        if self.previous_movement:
-            last_x = self.previous_movement['x']
-            last_y = self.previous_movement['y']
-            last_z = self.previous_movement['z']
-            last_e = self.previous_movement['e']
+        previous_movement = self.previous_movement
+        if previous_movement:
+            last_x = previous_movement.x
+            last_y = previous_movement.y
+            last_z = previous_movement.z
+            last_e = previous_movement.e
         else:
             last_x = 0
             last_y = 0
@@ -742,173 +950,132 @@ class PrintQueue():
             last_e = 0
 
         if target_position['type'] == 'move':
-            move['type'] = 'move'
-            # extract values
-            # todo this can be for loop over axis_names
-            if 'x' in target_position:
-                move['x'] = target_position['x']
-            else:
-                if self.previous_movement:
-                    move['x'] = self.previous_movement['x']
-                else:
-                    move['x'] = 0
-            if 'y' in target_position:
-                move['y'] = target_position['y']
-            else:
-                if self.previous_movement:
-                    move['y'] = self.previous_movement['y']
-                else:
-                    move['y'] = 0
-            if 'z' in target_position:
-                move['z'] = target_position['z']
-            else:
-                if self.previous_movement:
-                    move['z'] = self.previous_movement['z']
-                else:
-                    move['z'] = 0
-            if 'e' in target_position:
-                move['e'] = target_position['e']
-            else:
-                if self.previous_movement:
-                    move['e'] = self.previous_movement['e']
-                else:
-                    move['e'] = 0
+            # extract values - what is not given stays where it was
+            move = Move('move',
+                        target_position.get('x', last_x),
+                        target_position.get('y', last_y),
+                        target_position.get('z', last_z),
+                        target_position.get('e', last_e))
             if 'target_speed' in target_position:
-                move['target_speed'] = target_position['target_speed']
-            elif self.previous_movement:
-                move['target_speed'] = self.previous_movement['target_speed']
+                move.target_speed = target_position['target_speed']
+            elif previous_movement:
+                move.target_speed = previous_movement.target_speed
             elif self.default_target_speed:
-                move['target_speed'] = self.default_target_speed
+                move.target_speed = self.default_target_speed
             else:
                 raise PrinterError("movement w/o a set speed and no default speed is set!")
-            _logger.debug("moving to: X:%s, Y:%s, Z:%s", move['x'], move['z'], move['z'])
 
-            move['delta_x'] = move['x'] - last_x
-            move['delta_y'] = move['y'] - last_y
-            move['delta_z'] = move['z'] - last_z
-            move['delta_e'] = move['e'] - last_e
-            move_vector = calculate_relative_vector(move['delta_x'], move['delta_y'], move['delta_z'], move['delta_e'])
-            try:
-                move_vector['v'] = move['target_speed'] / move_vector['l']
-            except ZeroDivisionError:
-                move_vector['v'] = 0
+            move.delta_x = move.x - last_x
+            move.delta_y = move.y - last_y
+            move.delta_z = move.z - last_z
+            move.delta_e = move.e - last_e
+            length = sqrt(move.delta_x ** 2 + move.delta_y ** 2 + move.delta_z ** 2 + move.delta_e ** 2)
+            if length == 0:
+                move_vector = MoveVector()
+            else:
+                move_vector = MoveVector(float(move.delta_x) / length,
+                                         float(move.delta_y) / length,
+                                         float(move.delta_z) / length,
+                                         float(move.delta_e) / length,
+                                         length,
+                                         move.target_speed / length)
             # save the move vector for later use ...
-            move['relative_move_vector'] = move_vector
+            move.relative_move_vector = move_vector
         elif target_position['type'] == 'set_position':
             # a set position also means that we do not move it …
-            move['x'] = last_x
-            move['y'] = last_y
-            move['z'] = last_z
-            move['e'] = last_e
-            move['delta_x'] = 0
-            move['delta_y'] = 0
-            move['delta_z'] = 0
-            move['delta_e'] = 0
-            move['relative_move_vector'] = {
-                'x': 0.0,
-                'z': 0.0,
-                'y': 0.0,
-                'e': 0.0,
-                'l': 0.0,
-            }
-            move['target_speed'] = 0
-            move['type'] = 'set_position'
-            for axis, value in target_position.iteritems():
-                if not axis == 'type':
-                    move['s%s' % axis] = value
-                    move[axis] = value
+            move = Move('set_position', last_x, last_y, last_z, last_e)
+            move.relative_move_vector = MoveVector()
+            # the feedrate is kept for the next move
+            if 'target_speed' in target_position:
+                move.target_speed = target_position['target_speed']
+            elif previous_movement:
+                move.target_speed = previous_movement.target_speed
+            move.set_positions = {}
+            for axis in _axis_config:
+                if axis in target_position:
+                    value = target_position[axis]
+                    move.set_positions[axis] = value
+                    setattr(move, axis, value)
+        else:
+            raise PrinterError("Unknown movement type " + target_position['type'])
 
         return move
 
     def _maximum_achievable_speed(self, current_movement):
-        if self.previous_movement and self.previous_movement['type'] == 'move':
-            last_x_speed = self.previous_movement['speed']['x']
-            last_y_speed = self.previous_movement['speed']['y']
+        previous_movement = self.previous_movement
+        if previous_movement and previous_movement.type == 'move':
+            last_x_speed = previous_movement.speed.x
+            last_y_speed = previous_movement.speed.y
         else:
             last_x_speed = 0
             last_y_speed = 0
-        delta_x = current_movement['delta_x']
-        delta_y = current_movement['delta_y']
-        delta_e = current_movement['delta_e']
-        normalized_move_vector = current_movement['relative_move_vector']
+        delta_x = current_movement.delta_x
+        delta_y = current_movement.delta_y
+        delta_e = current_movement.delta_e
+        normalized_move_vector = current_movement.relative_move_vector
         # derive the various speed vectors from the movement … for desired head and maximum axis speed
         speed_vectors = [
-            {
-                # add the desired speed vector as initial value
-                'x': current_movement['target_speed'] * normalized_move_vector['x'],
-                'y': current_movement['target_speed'] * normalized_move_vector['y']
-            }
+            # add the desired speed vector as initial value
+            SpeedVector(current_movement.target_speed * normalized_move_vector.x,
+                        current_movement.target_speed * normalized_move_vector.y)
         ]
         if delta_x != 0:
-            scaled_y = normalized_move_vector['y'] / normalized_move_vector['x']
-            speed_vectors.append({
-                # what would the speed vector for max x speed look like
-                'x': copysign(self.axis['x']['max_speed'], normalized_move_vector['x']),
-                'y': copysign(self.axis['x']['max_speed'], normalized_move_vector['y']) * scaled_y
-            })
-            if not self.previous_movement or sign(delta_x) == sign(self.previous_movement['delta_x']):
+            scaled_y = normalized_move_vector.y / normalized_move_vector.x
+            # what would the speed vector for max x speed look like
+            speed_vectors.append(SpeedVector(copysign(self.axis['x']['max_speed'], normalized_move_vector.x),
+                                             copysign(self.axis['x']['max_speed'], normalized_move_vector.y)
+                                             * scaled_y))
+            if not previous_movement or sign(delta_x) == sign(previous_movement.delta_x):
                 # ww can accelerate further
                 start_velocity = last_x_speed
             else:
                 # we HAVE to turn around!
-                if self.previous_movement:
-                    self.previous_movement['x_stop'] = True
+                if previous_movement:
+                    previous_movement.x_stop = True
                 start_velocity = 0
             max_speed_x = get_target_velocity(start_velocity=start_velocity,
                                               length=delta_x,
                                               max_acceleration=self.axis['x']['max_acceleration'],
                                               jerk=self.axis['x']['bow'])
-            speed_vectors.append({
-                # how fast can we accelerate in X direction anyway
-                'x': max_speed_x,
-                'y': max_speed_x * scaled_y
-            })
+            # how fast can we accelerate in X direction anyway
+            speed_vectors.append(SpeedVector(max_speed_x, max_speed_x * scaled_y))
         else:
             # we HAVE to turn around!
-            if self.previous_movement:
-                self.previous_movement['x_stop'] = True
+            if previous_movement:
+                previous_movement.x_stop = True
 
         if delta_y != 0:
-            scaled_x = normalized_move_vector['x'] / normalized_move_vector['y']
-            speed_vectors.append({
-                # what would the maximum speed vector for y movement look like
-                'x': copysign(self.axis['y']['max_speed'], normalized_move_vector['x']) * scaled_x,
-                'y': copysign(self.axis['y']['max_speed'], normalized_move_vector['y'])
-            })
-            if not self.previous_movement or sign(delta_y) == sign(self.previous_movement['delta_y']):
+            scaled_x = normalized_move_vector.x / normalized_move_vector.y
+            # what would the maximum speed vector for y movement look like
+            speed_vectors.append(SpeedVector(copysign(self.axis['y']['max_speed'], normalized_move_vector.x)
+                                             * scaled_x,
+                                             copysign(self.axis['y']['max_speed'], normalized_move_vector.y)))
+            if not previous_movement or sign(delta_y) == sign(previous_movement.delta_y):
                 # ww can accelerate further
                 start_velocity = last_y_speed
             else:
                 # we HAVE to turn around!
-                if self.previous_movement:
-                    self.previous_movement['y_stop'] = True
+                if previous_movement:
+                    previous_movement.y_stop = True
                 start_velocity = 0
             max_speed_y = get_target_velocity(start_velocity=start_velocity,
                                               length=delta_y,
                                               max_acceleration=self.axis['y']['max_acceleration'],
                                               jerk=self.axis['y']['bow'])
-            speed_vectors.append({
-                # how fast can we accelerate in X direction anyway
-                'x': max_speed_y * scaled_x,
-                'y': max_speed_y
-            })
+            # how fast can we accelerate in X direction anyway
+            speed_vectors.append(SpeedVector(max_speed_y * scaled_x, max_speed_y))
         else:
             # we HAVE to turn around!
-            if self.previous_movement:
-                self.previous_movement['y_stop'] = True
-        if self.previous_movement:
-            if delta_e != 0 and sign(delta_e) == sign(self.previous_movement['delta_e']):
-                e_stop = ('x_stop' in self.previous_movement and self.previous_movement['x_stop']) \
-                         and \
-                         ('y_stop' in self.previous_movement and self.previous_movement['y_stop'])
-                self.previous_movement['e_stop'] = e_stop
+            if previous_movement:
+                previous_movement.y_stop = True
+        if previous_movement:
+            if delta_e != 0 and sign(delta_e) == sign(previous_movement.delta_e):
+                previous_movement.e_stop = previous_movement.x_stop and previous_movement.y_stop
             else:
-                self.previous_movement['e_stop'] = True
+                previous_movement.e_stop = True
 
-        max_local_speed_vector = find_shortest_vector(speed_vectors)
         # the minimum achievable speed is the minimum of all those local vectors
-
-        return max_local_speed_vector
+        return _find_shortest_speed_vector(speed_vectors)
 
 
     def _recalculate_move_speeds(self):
@@ -923,69 +1090,83 @@ class PrintQueue():
         next_move = self.previous_movement
         # we go back in the list and ensure that we can achieve the target speed with acceleration
         # and deceleration over the distance
+        # only the speed of the new move and the stop flags of the move before it are new - so as soon as an older
+        # move keeps its speed every move before it is still planned optimal and we can stop
+        is_last_planned_move = True
         for current_move in reversed(self.planning_list):
             # if the next move is no move we ensure that we got a stop - hence most values are ignored
-            if not next_move['type'] == 'move':
-                current_move['x_stop'] = True
-                current_move['y_stop'] = True
-            next_target_speed = next_move['speed']
+            if not next_move.type == 'move':
+                current_move.x_stop = True
+                current_move.y_stop = True
+            next_target_speed = next_move.speed
             # the movement we have calculated as achievable has to be considered anyway
+            previous_speed = current_move.speed
             speed_vectors = [
-                current_move['speed']
+                previous_speed
             ]
-            current_move_vector = current_move['relative_move_vector']
-            if current_move_vector['x'] != 0:
-                if 'x_stop' in current_move and current_move['x_stop']:
+            current_move_vector = current_move.relative_move_vector
+            if current_move_vector.x != 0:
+                if current_move.x_stop:
                     # we must be able to stop in this move
                     start_velocity = 0.0
-                    length = current_move['delta_x']
-                elif 'x_stop' in next_move and next_move['x_stop']:
+                    length = current_move.delta_x
+                elif next_move.x_stop:
                     # we must be abel to stop in the next move
                     start_velocity = 0.0
-                    length = next_move['delta_x']
+                    length = next_move.delta_x
                 else:
                     # we have to achieve the target speed of the next move in the next move
-                    start_velocity = next_target_speed['x']
-                    length = next_move['delta_x']
+                    start_velocity = next_target_speed.x
+                    length = next_move.delta_x
                 max_speed_x = get_target_velocity(start_velocity=start_velocity,
                                                   length=length,
                                                   max_acceleration=x_max_acceleration,
                                                   jerk=x_bow_)
-                speed_vectors.append({
-                    # what would the speed vector for max x speed look like
-                    'x': max_speed_x,
-                    'y': max_speed_x * current_move_vector['y'] / current_move_vector['x']
-                })
-            if current_move_vector['y'] != 0:
-                if 'y_stop' in current_move and current_move['y_stop']:
+                # what would the speed vector for max x speed look like
+                speed_vectors.append(SpeedVector(max_speed_x,
+                                                 max_speed_x * current_move_vector.y / current_move_vector.x))
+            if current_move_vector.y != 0:
+                if current_move.y_stop:
                     # we must be able to stop in this move
                     start_velocity = 0.0
-                    length = current_move['delta_y']
-                elif 'y_stop' in next_move and next_move['y_stop']:
+                    length = current_move.delta_y
+                elif next_move.y_stop:
                     # we must be abel to stop in the next move
                     start_velocity = 0.0
-                    length = next_move['delta_y']
+                    length = next_move.delta_y
                 else:
                     # we have to achieve the target speed of the next move in the next move
-                    start_velocity = next_target_speed['y']
-                    length = next_move['delta_y']
+                    start_velocity = next_target_speed.y
+                    length = next_move.delta_y
                 max_speed_y = get_target_velocity(start_velocity=start_velocity,
                                                   length=length,
                                                   max_acceleration=y_max_acceleration,
                                                   jerk=y_bow_)
-                speed_vectors.append({
-                    # what would the speed vector for max x speed look like
-                    'x': max_speed_y * current_move_vector['x'] / current_move_vector['y'],
-                    'y': max_speed_y
-                })
-            current_move['speed'] = find_shortest_vector(speed_vectors)
-            # todo in theory we can stop if we did not change the speed vector ...
+                # what would the speed vector for max x speed look like
+                speed_vectors.append(SpeedVector(max_speed_y * current_move_vector.x / current_move_vector.y,
+                                                 max_speed_y))
+            current_move.speed = _find_shortest_speed_vector(speed_vectors)
+            if not is_last_planned_move and current_move.speed == previous_speed:
+                break
+            is_last_planned_move = False
             next_move = current_move
 
         if self.led_manager:
             self.led_manager.light(2, False)
 
 
+def _find_shortest_speed_vector(speed_vectors):
+    # the first of the shortest vectors
+    shortest_vector = speed_vectors[0]
+    shortest_length = shortest_vector.x ** 2 + shortest_vector.y ** 2
+    for vector in speed_vectors:
+        length = vector.x ** 2 + vector.y ** 2
+        if length < shortest_length:
+            shortest_vector = vector
+            shortest_length = length
+    return shortest_vector
+
+
 def get_target_velocity(start_velocity, length, max_acceleration, jerk):
     # the simple case is simple
     if not length or length == 0:
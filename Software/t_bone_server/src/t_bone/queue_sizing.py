@@ -0,0 +1,125 @@
+from collections import deque
+import logging
+import threading
+import time
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+# how many seconds of moves the planning window should hold
+_DEFAULT_BUFFER_TIME = 2.0
+_DEFAULT_SMALLEST_WINDOW = 10
+_DEFAULT_LARGEST_WINDOW = 500
+# how far back the execution rate is measured
+_DEFAULT_RATE_WINDOW = 2.0
+# how often the window is adjusted
+_ADJUST_INTERVAL = 0.5
+# if the host cannot plan this much faster than the machine moves a longer window is not worth its planning time
+_PLANNING_HEADROOM = 2.0
+# how much of the way to the wanted length is done in one step - and which changes are not worth it
+_ADJUST_FACTOR = 0.5
+_MIN_CHANGE = 0.1
+# how much the planning time of the latest move counts
+_PLANNING_TIME_WEIGHT = 0.05
+
+
+class QueueSizer(object):
+    """
+    Sizes the planning window by how fast the machine executes the moves - so that it holds about buffer_time seconds
+    of moves: short segments get a long window, long moves a short one (which stops sooner).
+    The execution rate is measured by the queue length the arduino reports & the moves it has accepted, the planning
+    rate by the time the host needs per planned move. If the host can hardly keep up the window does not grow.
+    """
+
+    def __init__(self, window_length, smallest_window=_DEFAULT_SMALLEST_WINDOW,
+                 largest_window=_DEFAULT_LARGEST_WINDOW, buffer_time=_DEFAULT_BUFFER_TIME,
+                 rate_window=_DEFAULT_RATE_WINDOW):
+        self.smallest_window = smallest_window
+        self.largest_window = largest_window
+        self.buffer_time = buffer_time
+        self.rate_window = rate_window
+        self.window_length = window_length
+        self._lock = threading.Lock()
+        # (time, moves accepted, queue entries accepted, queue length)
+        self._samples = deque()
+        self._next_adjustment = 0
+        # seconds the host needs to plan one move
+        self.planning_time = None
+
+    def start(self, window_length):
+        with self._lock:
+            self.window_length = window_length
+            self._samples.clear()
+            self._next_adjustment = time.time() + _ADJUST_INTERVAL
+            self.planning_time = None
+
+    def move_planned(self, planning_time):
+        # just a rough average - one slow move does not change much
+        if self.planning_time is None:
+            self.planning_time = planning_time
+        else:
+            self.planning_time += (planning_time - self.planning_time) * _PLANNING_TIME_WEIGHT
+
+    def execution_rate(self):
+        """
+        The moves per second the machine has executed during the last rate_window seconds - or None if there is not
+        enough to tell.
+        """
+        with self._lock:
+            return self._execution_rate()
+
+    def planning_rate(self):
+        planning_time = self.planning_time
+        if not planning_time:
+            return None
+        return 1.0 / planning_time
+
+    def queue_reported(self, queue_length, moves_accepted, queue_entries_accepted, now=None):
+        """
+        Takes the queue length the arduino reported & returns the new window length - or None if it stays as it is.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            samples = self._samples
+            samples.append((now, moves_accepted, queue_entries_accepted, queue_length))
+            # one sample older than the window is enough to compare with
+            while len(samples) > 2 and samples[1][0] <= now - self.rate_window:
+                samples.popleft()
+            if now < self._next_adjustment:
+                return None
+            self._next_adjustment = now + _ADJUST_INTERVAL
+            return self._adjust()
+
+    def _execution_rate(self):
+        if len(self._samples) < 2:
+            return None
+        start_time, start_moves, start_entries, start_queue_length = self._samples[0]
+        end_time, end_moves, end_entries, end_queue_length = self._samples[-1]
+        duration = end_time - start_time
+        moves = end_moves - start_moves
+        # too short to tell anything
+        if duration < self.rate_window / 2.0 or moves <= 0:
+            return None
+        # whatever was added & is not in the queue anymore has been executed
+        entries_per_move = float(end_entries - start_entries) / moves
+        executed_entries = (end_entries - start_entries) - (end_queue_length - start_queue_length)
+        return max(executed_entries / entries_per_move, 0.0) / duration
+
+    def _adjust(self):
+        execution_rate = self._execution_rate()
+        if execution_rate is None:
+            return None
+        wanted_length = execution_rate * self.buffer_time
+        planning_rate = self.planning_rate()
+        if planning_rate is not None and planning_rate < execution_rate * _PLANNING_HEADROOM:
+            # the host would need the time for a longer window to keep up
+            wanted_length = min(wanted_length, self.window_length)
+        wanted_length = min(max(wanted_length, self.smallest_window), self.largest_window)
+        new_length = int(round(self.window_length + (wanted_length - self.window_length) * _ADJUST_FACTOR))
+        if abs(new_length - self.window_length) < max(self.window_length * _MIN_CHANGE, 1):
+            return None
+        _logger.debug("Executing %0.1f moves/s, planning %s moves/s - window length %s -> %s", execution_rate,
+                      planning_rate, self.window_length, new_length)
+        self.window_length = new_length
+        return new_length
@@ -2,49 +2,67 @@
 #thermistor table taken from current marlin software
 #see https:  #raw.github.com/ErikZalm/Marlin/Marlin_v1/Marlin/thermistortables.h
 #TODO is'nt it a good idea to also use https://github.com/ErikZalm/Marlin/blob/Marlin_v1/Marlin/createTemperatureLookupMarlin.py
+from bisect import bisect_right
 import logging
-from numpy import NaN
+import numpy
 
 __author__ = 'marcus'
 
 _logger = logging.getLogger(__name__)
 
-def convert_ramps_reading(thermistor, thermistor_table, value):
-    # the tables are from 1024er based arduino
-    comparable_value = value * 1024.0
-    #find upper value
-    upper_index = int(comparable_value)
-    upper_temperature = None
-    while upper_index >= 0:
-        if upper_index in thermistor_table:
-            upper_temperature = thermistor_table[upper_index]
-            break
-        upper_index -= 1
-    lower_index = int(comparable_value)
-    lower_temperature = None
-    while lower_index <= 1024:
-        if lower_index in thermistor_table:
-            lower_temperature = thermistor_table[lower_index]
-            break
-        lower_index += 1
+# the tables are from 1024er based arduino
+ADC_RANGE = 1024
+_adc_values = numpy.arange(ADC_RANGE + 1, dtype=float)
 
-    #now decode it
-    if upper_temperature and lower_temperature:
-        value_difference = float(upper_index - lower_index)
-        if value_difference == 0.0:
-            return upper_temperature
+
+def compile_ramps_table(thermistor_table):
+    # the temperature for every adc value - linear interpolated between the values of the table
+    table_values = sorted(thermistor_table)
+    if not table_values:
+        raise ValueError("Empty thermistor table")
+    temperatures = []
+    for adc_value in xrange(ADC_RANGE + 1):
+        upper_entry = bisect_right(table_values, adc_value)
+        if upper_entry == 0:
+            temperature = thermistor_table[table_values[0]]
+        elif upper_entry == len(table_values):
+            temperature = thermistor_table[table_values[-1]]
         else:
-            temperature_difference = float(upper_temperature - lower_temperature)
-            return float(lower_temperature) \
-                   + temperature_difference / value_difference * (comparable_value - lower_index)
+            lower_value = table_values[upper_entry - 1]
+            upper_value = table_values[upper_entry]
+            lower_temperature = float(thermistor_table[lower_value])
+            upper_temperature = float(thermistor_table[upper_value])
+            temperature = lower_temperature + (upper_temperature - lower_temperature) \
+                                              * (adc_value - lower_value) / (upper_value - lower_value)
+        temperatures.append(float(temperature))
+    return temperatures
+
+
+class RampsThermistor(object):
+    """
+    Converts readings by a precompiled lookup table over the whole adc range.
+    """
+
+    def __init__(self, name, thermistor_table):
+        self.name = name
+        self._temperatures = compile_ramps_table(thermistor_table)
+        self._temperature_array = numpy.array(self._temperatures)
+
+    def convert(self, value):
+        # value is the adc reading from 0 to 1
+        comparable_value = value * ADC_RANGE
+        if comparable_value <= 0:
+            return self._temperatures[0]
+        if comparable_value >= ADC_RANGE:
+            return self._temperatures[ADC_RANGE]
+        index = int(comparable_value)
+        lower_temperature = self._temperatures[index]
+        return lower_temperature + (self._temperatures[index + 1] - lower_temperature) * (comparable_value - index)
 
-    elif lower_temperature is not None:
-        return lower_temperature
-    elif upper_temperature is not None:
-        return upper_temperature
-    else:
-        _logger.error("Unable to convert value %s for thermistor %s", value, thermistor)
-        return NaN
+    def convert_all(self, values):
+        # a whole bunch of readings at once, e.g. for oversampling
+        comparable_values = numpy.asarray(values, dtype=float) * ADC_RANGE
+        return numpy.interp(comparable_values, _adc_values, self._temperature_array)
 
 
 #100k bed thermistor
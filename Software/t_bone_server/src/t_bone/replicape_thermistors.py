@@ -1,4 +1,5 @@
 __author__ = 'marcus'
+from bisect import bisect_left
 import numpy as np
 
 # taken from https://bitbucket.org/intelligentagent/redeem/src/e8f467317baa740d389479a45ce4be400edaa574/software/Thermistor.py?at=master
@@ -7,17 +8,57 @@ def convert_reading(temp_table, reading):
     return resistance_to_degrees(temp_table=temp_table, resistor_val=resistance)
 
 
-def resistance_to_degrees(temp_table, resistor_val):
-    idx = (abs(temp_table[1] - resistor_val)).argmin()
+def convert_readings(temp_table, readings):
+    resistances = voltages_to_resistances(np.asarray(readings, dtype=float) * 1.8)
+    return resistance_to_degrees(temp_table=temp_table, resistor_val=resistances)
+
 
-    return temp_table[0][idx]
+def resistance_to_degrees(temp_table, resistor_val):
+    # the table is sorted by resistance - so we can search it and interpolate between the neighbours
+    temperatures, resistances = temp_table
+    upper_index = np.clip(np.searchsorted(resistances, resistor_val), 1, len(resistances) - 1)
+    lower_index = upper_index - 1
+    lower_resistance = resistances[lower_index]
+    fraction = np.clip((resistor_val - lower_resistance) / (resistances[upper_index] - lower_resistance), 0.0, 1.0)
+    lower_temperature = temperatures[lower_index]
+    return lower_temperature + (temperatures[upper_index] - lower_temperature) * fraction
 
 
 def voltage_to_resistance(v_sense):
     if v_sense == 0:
         return 10000000.0
+    if v_sense >= 1.8:
+        # an open sensor
+        return float('inf')
     return 4700.0 / ((1.8 / v_sense) - 1.0)
 
+
+def voltages_to_resistances(v_senses):
+    with np.errstate(divide='ignore'):
+        resistances = 4700.0 / ((1.8 / v_senses) - 1.0)
+    return np.where(v_senses == 0, 10000000.0, resistances)
+
+
+class ReplicapeThermistor(object):
+    def __init__(self, name):
+        self.name = name
+        self._temp_table = temp_table[name]
+        # numpy is slow for single values - a single reading is searched in plain lists
+        self._temperatures = [float(temperature) for temperature in self._temp_table[0]]
+        self._resistances = [float(resistance) for resistance in self._temp_table[1]]
+
+    def convert(self, value):
+        resistance = voltage_to_resistance(value * 1.8)
+        resistances = self._resistances
+        upper_index = min(max(bisect_left(resistances, resistance), 1), len(resistances) - 1)
+        lower_resistance = resistances[upper_index - 1]
+        fraction = min(max((resistance - lower_resistance) / (resistances[upper_index] - lower_resistance), 0.0), 1.0)
+        lower_temperature = self._temperatures[upper_index - 1]
+        return lower_temperature + (self._temperatures[upper_index] - lower_temperature) * fraction
+
+    def convert_all(self, values):
+        return convert_readings(self._temp_table, values)
+
 # Charts for different thermistors.
 temp_chart = {}
 # This conversion table has been found in the datasheet for B57560G104F and is the one sold for MakerBot Plastruder MK4
@@ -889,7 +930,7 @@ temp_chart["B57561G0103F000"] = [
     [260, 56.8533190304]
 ]
 
-#rearrange
-temp_table= {}
+# rearrange to temperatures & resistances - sorted by resistance for the binary search
+temp_table = {}
 for name, table in temp_chart.iteritems():
-    temp_table[name]=np.array(table).transpose()
\ No newline at end of file
+    temp_table[name] = np.array(sorted(table, key=lambda entry: entry[1]), dtype=float).transpose()
@@ -0,0 +1,183 @@
+import logging
+import sys
+import threading
+import time
+import types
+
+import thermistors
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+# what a heater does at full power & how fast it looses its heat - roughly a hot end
+_DEFAULT_HEATING_RATE = 8.0
+_DEFAULT_COOLING_RATE = 0.03
+_DEFAULT_AMBIENT_TEMPERATURE = 22.0
+# unconnected analog inputs float somewhere in the middle
+_FLOATING_ANALOG_INPUT = 0.5
+# the analog reading of a temperature is found by bisection - this is good enough for any thermistor table
+_READING_PRECISION = 0.0001
+
+HIGH = 1
+LOW = 0
+OUT = 0
+IN = 1
+
+
+class SimulatedHeater(object):
+    """
+    A heater with a thermistor - it heats proportional to the power & cools down proportional to the temperature
+    difference to the ambient temperature.
+    """
+
+    def __init__(self, thermistor_type, heating_rate=_DEFAULT_HEATING_RATE, cooling_rate=_DEFAULT_COOLING_RATE,
+                 ambient_temperature=_DEFAULT_AMBIENT_TEMPERATURE):
+        self._thermistor = thermistors.get_thermistor(thermistor_type)
+        self.heating_rate = heating_rate
+        self.cooling_rate = cooling_rate
+        self.ambient_temperature = ambient_temperature
+        self.temperature = ambient_temperature
+        # 0 to 1
+        self.power = 0.0
+        self._last_update = time.time()
+
+    def update(self, now=None):
+        if now is None:
+            now = time.time()
+        duration = now - self._last_update
+        self._last_update = now
+        if duration > 0:
+            self.temperature += duration * (self.power * self.heating_rate
+                                            - self.cooling_rate * (self.temperature - self.ambient_temperature))
+        return self.temperature
+
+    def reading(self):
+        return reading_for_temperature(self._thermistor, self.update())
+
+
+class SimulatedHardware(object):
+    """
+    The pins of the beagle bone as the Adafruit_BBIO modules see them. Heaters connect an output pin with an analog
+    input & callbacks can be registered for pins going high (e.g. the reset pin of the arduino).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.gpio = {}
+        self.pwm = {}
+        # output pin -> heater
+        self.heaters = {}
+        # analog input -> heater
+        self._thermometers = {}
+        # pin -> function called when the pin goes from low to high
+        self._rising_edge_handlers = {}
+
+    def add_heater(self, output, analog_input, heater):
+        with self._lock:
+            self.heaters[output] = heater
+            self._thermometers[analog_input] = heater
+        return heater
+
+    def on_rising_edge(self, pin, handler):
+        with self._lock:
+            self._rising_edge_handlers[pin] = handler
+
+    def gpio_setup(self, pin, direction, *args, **kwargs):
+        with self._lock:
+            self.gpio.setdefault(pin, LOW)
+
+    def gpio_output(self, pin, value):
+        with self._lock:
+            old_value = self.gpio.get(pin, LOW)
+            self.gpio[pin] = value
+            heater = self.heaters.get(pin)
+            if heater:
+                heater.update()
+                heater.power = 1.0 if value == HIGH else 0.0
+            handler = self._rising_edge_handlers.get(pin)
+        if handler and value == HIGH and old_value == LOW:
+            handler()
+
+    def gpio_input(self, pin):
+        with self._lock:
+            return self.gpio.get(pin, LOW)
+
+    def pwm_start(self, pin, duty_cycle=0.0, frequency=2000, polarity=0):
+        self.pwm_set_duty_cycle(pin, duty_cycle)
+
+    def pwm_set_duty_cycle(self, pin, duty_cycle):
+        with self._lock:
+            self.pwm[pin] = float(duty_cycle)
+            heater = self.heaters.get(pin)
+            if heater:
+                heater.update()
+                heater.power = min(max(float(duty_cycle) / 100.0, 0.0), 1.0)
+
+    def pwm_stop(self, pin):
+        self.pwm_set_duty_cycle(pin, 0.0)
+
+    def adc_read(self, pin):
+        with self._lock:
+            heater = self._thermometers.get(pin)
+            if not heater:
+                return _FLOATING_ANALOG_INPUT
+            return heater.reading()
+
+
+def reading_for_temperature(thermistor, temperature):
+    # the inverse of thermistor.convert - the tables can be rising or falling
+    low = _READING_PRECISION
+    high = 1.0 - _READING_PRECISION
+    rising = thermistor.convert(high) > thermistor.convert(low)
+    while high - low > _READING_PRECISION:
+        middle = (low + high) / 2.0
+        if (thermistor.convert(middle) < temperature) == rising:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2.0
+
+
+# THE simulated beagle bone - the shims talk to it
+hardware = SimulatedHardware()
+
+
+def install_hardware_shims():
+    """
+    Registers Adafruit_BBIO, Adafruit_BBIO.GPIO, .ADC & .PWM modules talking to the simulated hardware.
+    It has to be called before anything imports Adafruit_BBIO - modules keep what they have imported.
+    """
+    package = types.ModuleType('Adafruit_BBIO')
+    package.__path__ = []
+
+    gpio = types.ModuleType('Adafruit_BBIO.GPIO')
+    gpio.HIGH = HIGH
+    gpio.LOW = LOW
+    gpio.OUT = OUT
+    gpio.IN = IN
+    gpio.setup = lambda pin, direction, *args, **kwargs: hardware.gpio_setup(pin, direction)
+    gpio.output = lambda pin, value: hardware.gpio_output(pin, value)
+    gpio.input = lambda pin: hardware.gpio_input(pin)
+    gpio.cleanup = lambda: None
+
+    adc = types.ModuleType('Adafruit_BBIO.ADC')
+    adc.setup = lambda: None
+    adc.read = lambda pin: hardware.adc_read(pin)
+
+    pwm = types.ModuleType('Adafruit_BBIO.PWM')
+    pwm.start = lambda pin, duty_cycle=0.0, frequency=2000, polarity=0: hardware.pwm_start(pin, duty_cycle,
+                                                                                            frequency, polarity)
+    pwm.set_duty_cycle = lambda pin, duty_cycle: hardware.pwm_set_duty_cycle(pin, duty_cycle)
+    pwm.stop = lambda pin: hardware.pwm_stop(pin)
+    pwm.cleanup = lambda: None
+
+    package.GPIO = gpio
+    package.ADC = adc
+    package.PWM = pwm
+    sys.modules['Adafruit_BBIO'] = package
+    sys.modules['Adafruit_BBIO.GPIO'] = gpio
+    sys.modules['Adafruit_BBIO.ADC'] = adc
+    sys.modules['Adafruit_BBIO.PWM'] = pwm
+    _logger.info("Using the simulated beagle bone hardware")
+    return hardware
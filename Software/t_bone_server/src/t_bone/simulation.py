@@ -0,0 +1,564 @@
+"""A simulated T-Bone: an arduino speaking the CmdMessenger protocol & a beagle bone without any real pins.
+
+usage: python simulation.py config_file [--time-scale factor] [--http-port port]
+
+The simulated arduino is reached via a pseudo terminal - so the print server talks to it just as to the real serial
+port. Moves take as long as they would take on the machine (times the time scale).
+"""
+from collections import deque
+import logging
+import os
+import pty
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+import beagle_bone_pins
+from machine_protocol import decode_binary_arguments, decode_binary_move, MachineError
+from simulated_hardware import hardware, install_hardware_shims, SimulatedHeater
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+# like the firmware
+COMMAND_QUEUE_LENGTH = 40
+_default_motor_count = 5
+_default_baud_rate = 38400
+_keep_alive_interval = 1.0
+_queue_status_interval = 0.02
+_baud_rate_confirmation_time = 3.0
+_cmd_messenger_escape = '/'
+_move_argument_count = 6
+
+_no_motion = 0
+_in_motion = 1
+_finishing_motion = 2
+
+# 8N1 - every byte takes 10 bits on the line
+_bits_per_byte = 10
+# how much the pseudo terminal pump reads at once
+_pty_chunk_size = 4096
+_pty_read_timeout = 0.1
+
+
+class SimulatedFirmware(object):
+    """
+    Behaves like the arduino firmware: it answers every command, executes the moves from a finite command queue as
+    long as the motion is running & sends keep alive pings. A move takes as long as its slowest motor needs to reach
+    its target at its speed, times the time_scale.
+    """
+
+    def __init__(self, queue_length=COMMAND_QUEUE_LENGTH, motor_count=_default_motor_count, time_scale=1.0,
+                 keep_alive_interval=_keep_alive_interval, binary_moves=True, status_all=True):
+        self.queue_length = queue_length
+        self.motor_count = motor_count
+        self.default_buffer_depth = motor_count
+        self.time_scale = time_scale
+        self.keep_alive_interval = keep_alive_interval
+        self.binary_moves = binary_moves
+        self.status_all = status_all
+        self._condition = threading.Condition()
+        self._handlers = {
+            1: self._on_ok,
+            2: self._on_ok,
+            3: self._on_ok,
+            4: self._on_ok,
+            9: self._on_init,
+            10: self._on_move,
+            11: self._on_movement,
+            12: self._on_home,
+            13: self._on_set_position,
+            14: self._on_binary_move,
+            15: self._on_baud_rate,
+            30: self._on_position,
+            31: self._on_commands,
+            32: self._on_status,
+            33: self._on_status_all,
+            41: self._on_current_reading,
+            44: self._on_ok,
+        }
+        # statistics for load tests
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.commands_received = 0
+        self.moves_received = 0
+        self.moves_executed = 0
+        # how often the queue ran empty while moving & for how long
+        self.underruns = 0
+        self.starved_time = 0.0
+        self.active = False
+        self._thread = None
+        self.reset()
+
+    def reset(self):
+        with self._condition:
+            self._input = ""
+            self._output = ""
+            self.positions = dict((motor, 0) for motor in range(1, self.motor_count + 1))
+            self.motion_state = _no_motion
+            self.min_buffer_depth = self.default_buffer_depth
+            self._queue = deque()
+            self.queue_count = 0
+            self._reported_queue_count = 0
+            # (start time, duration, start positions, motors) of the executing move
+            self._current_move = None
+            self._starved_since = None
+            self.baud_rate = _default_baud_rate
+            self._baud_rate_deadline = None
+            # the first keep alive tells everybody that we are there
+            self._last_keep_alive = 0
+            self._advance(time.time())
+            self._condition.notify_all()
+
+    def start(self):
+        self.active = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self.active = False
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        with self._condition:
+            while self.active:
+                self._condition.wait(self._advance(time.time()))
+
+    def receive(self, data):
+        with self._condition:
+            self.bytes_received += len(data)
+            self._input += data
+            for line in self._split_commands():
+                self._execute(line)
+            self._advance(time.time())
+            self._condition.notify_all()
+
+    def read(self, size, timeout=None):
+        with self._condition:
+            if not self._output and timeout:
+                self._condition.wait(timeout)
+            data = self._output[:size]
+            self._output = self._output[len(data):]
+            return data
+
+    @property
+    def output_waiting(self):
+        return len(self._output)
+
+    def discard_output(self):
+        with self._condition:
+            self._output = ""
+
+    def _send(self, *arguments):
+        data = ",".join(str(argument) for argument in arguments) + ";\r\n"
+        self.bytes_sent += len(data)
+        self._output += data
+        self._condition.notify_all()
+
+    def _split_commands(self):
+        # separators escaped with '/' are part of the argument
+        commands = []
+        start = 0
+        escaped = False
+        for index, character in enumerate(self._input):
+            if escaped:
+                escaped = False
+            elif character == _cmd_messenger_escape:
+                escaped = True
+            elif character == ';':
+                commands.append(self._input[start:index])
+                start = index + 1
+        self._input = self._input[start:]
+        return commands
+
+    def _execute(self, line):
+        # binary arguments may end with anything - only the line break of the last command is cut off
+        arguments = _split_arguments(line.lstrip())
+        try:
+            command_number = int(arguments[0])
+        except ValueError:
+            _logger.warn("Unable to decode %s", line)
+            return
+        self.commands_received += 1
+        _logger.debug("Received %s", line.strip())
+        handler = self._handlers.get(command_number)
+        if not handler:
+            self._send(-9, "U", command_number)
+            return
+        try:
+            handler(arguments[1:])
+        except (ValueError, IndexError, MachineError) as e:
+            _logger.warn("Unable to execute %s: %s", line, e)
+            self._send(-9, -1)
+
+    def _advance(self, now):
+        """
+        Executes everything due until now & returns how long it is until something has to be done next.
+        """
+        if self._current_move and self._current_move[0] + self._current_move[1] <= now:
+            start, duration, start_positions, motors = self._current_move
+            for motor, target, speed in motors:
+                self.positions[motor] = target
+            self._current_move = None
+            self.moves_executed += 1
+            # the next move starts where the last one ended
+            self._start_next_move(start + duration, now, moving=True)
+        elif not self._current_move:
+            self._start_next_move(now, now, moving=False)
+        if self.motion_state == _finishing_motion and not self._current_move and not self._queue:
+            self.motion_state = _no_motion
+        if self._baud_rate_deadline and now > self._baud_rate_deadline:
+            _logger.info("Baud rate %s not confirmed, back to %s", self.baud_rate, _default_baud_rate)
+            self.baud_rate = _default_baud_rate
+            self._baud_rate_deadline = None
+        if self.queue_count > self._reported_queue_count:
+            self._reported_queue_count = self.queue_count
+        since_keep_alive = now - self._last_keep_alive
+        if since_keep_alive > self.keep_alive_interval or (
+                        self.queue_count < self._reported_queue_count and since_keep_alive > _queue_status_interval):
+            self._send(-128, self.queue_count, self.queue_length)
+            self._last_keep_alive = now
+            self._reported_queue_count = self.queue_count
+        next_event = self._last_keep_alive + self.keep_alive_interval
+        if self.queue_count < self._reported_queue_count:
+            # the shorter queue has to be pushed even if nothing else happens
+            next_event = min(next_event, self._last_keep_alive + _queue_status_interval)
+        if self._current_move:
+            next_event = min(next_event, self._current_move[0] + self._current_move[1])
+        if self._baud_rate_deadline:
+            next_event = min(next_event, self._baud_rate_deadline)
+        return max(next_event - now, 0.001)
+
+    def _start_next_move(self, start, now, moving):
+        while self._current_move is None and self._queue and self.motion_state != _no_motion and (
+                        self.queue_count > self.min_buffer_depth or self.motion_state == _finishing_motion):
+            if self.min_buffer_depth > self.default_buffer_depth:
+                # the initial buffer is full - from now on we just keep the default depth
+                self.min_buffer_depth = self.default_buffer_depth
+            motors = self._queue.popleft()
+            self.queue_count -= len(motors)
+            if self._starved_since is not None:
+                self.starved_time += start - self._starved_since
+                self._starved_since = None
+            duration = self._move_duration(motors)
+            if start + duration <= now:
+                # it has already been executed
+                for motor, target, speed in motors:
+                    self.positions[motor] = target
+                self.moves_executed += 1
+                start += duration
+                moving = True
+            else:
+                self._current_move = (start, duration, dict(self.positions), motors)
+        if moving and self._current_move is None and self.motion_state == _in_motion:
+            # the queue ran dry while the machine was moving
+            self.underruns += 1
+            self._starved_since = start
+
+    def _move_duration(self, motors):
+        duration = 0.0
+        for motor, target, speed in motors:
+            if speed:
+                duration = max(duration, abs(target - self.positions.get(motor, 0)) / speed)
+        return duration * self.time_scale
+
+    def position(self, motor, now=None):
+        if now is None:
+            now = time.time()
+        with self._condition:
+            if self._current_move:
+                start, duration, start_positions, motors = self._current_move
+                for moving_motor, target, speed in motors:
+                    if moving_motor == motor and duration > 0:
+                        fraction = min(max((now - start) / duration, 0.0), 1.0)
+                        return int(start_positions[motor] + (target - start_positions[motor]) * fraction)
+            return self.positions.get(motor, 0)
+
+    def _queue_move(self, arguments):
+        motors = []
+        for index in range(0, len(arguments) - _move_argument_count + 1, _move_argument_count):
+            motor = int(arguments[index])
+            if motor < 1 or motor > self.motor_count:
+                self._send(-9, -1)
+                return
+            motors.append((motor, int(float(arguments[index + 1])), abs(float(arguments[index + 3]))))
+        if not motors:
+            self._send(-9, -1)
+            return
+        if self.queue_count + len(motors) > self.queue_length:
+            self._send(-9, -100)
+            return
+        self._queue.append(motors)
+        self.queue_count += len(motors)
+        self.moves_received += 1
+        self._send(0, self.queue_count, self.queue_length, 1 if self.motion_state == _in_motion else -1)
+
+    def _on_ok(self, arguments):
+        self._send(0, 0)
+
+    def _on_init(self, arguments):
+        self.motion_state = _no_motion
+        self._queue.clear()
+        self.queue_count = 0
+        self._current_move = None
+        self._starved_since = None
+        if self.binary_moves and arguments and arguments[0] == '1':
+            self._send(0, 1)
+        else:
+            self._send(0, 0)
+
+    def _on_move(self, arguments):
+        self._queue_move(arguments)
+
+    def _on_binary_move(self, arguments):
+        if not self.binary_moves:
+            self._send(-9, "U", 14)
+            return
+        self._queue_move(decode_binary_move(decode_binary_arguments(arguments[0])))
+
+    def _on_movement(self, arguments):
+        movement = int(arguments[0])
+        if movement == 0:
+            self._send(11, {_in_motion: 1, _finishing_motion: 2}.get(self.motion_state, -1))
+        elif movement < 0:
+            if self.motion_state == _no_motion:
+                self._send(-9, -1)
+            else:
+                self._send(0, 0)
+                self.motion_state = _finishing_motion
+                self.min_buffer_depth = 0
+        elif self.motion_state != _no_motion:
+            self._send(-9, -1)
+        else:
+            self._send(0, 0)
+            initial_buffer_depth = int(arguments[1]) if len(arguments) > 1 else 0
+            self.min_buffer_depth = max(initial_buffer_depth, self.default_buffer_depth)
+            self.motion_state = _in_motion
+            self._starved_since = None
+
+    def _on_home(self, arguments):
+        # homing is instant - the motor is at its left end stop afterwards
+        self.positions[int(arguments[0])] = 0
+        self._send(0, 0)
+
+    def _on_set_position(self, arguments):
+        motor = int(arguments[0])
+        self._queue.append([(motor, int(arguments[1]), None)])
+        self.queue_count += 1
+        self._send(0, self.queue_count, self.queue_length)
+
+    def _on_baud_rate(self, arguments):
+        baud_rate = int(arguments[0])
+        if baud_rate == 0:
+            self._baud_rate_deadline = None
+            self._send(0, 0)
+        elif baud_rate < _default_baud_rate:
+            self._send(-9, -1)
+        else:
+            self._send(0, baud_rate)
+            self.baud_rate = baud_rate
+            self._baud_rate_deadline = time.time() + _baud_rate_confirmation_time
+
+    def _on_position(self, arguments):
+        motor = int(arguments[0])
+        self._send(30, self.position(motor))
+
+    def _on_commands(self, arguments):
+        self._send(31, self.queue_count, self.queue_length)
+
+    def _on_status(self, arguments):
+        motor = int(arguments[0])
+        position = self.position(motor)
+        # status register, position, left & right end stop, encoder
+        self._send(32, 0, position, 1 if position <= 0 else -1, -1, position)
+
+    def _on_status_all(self, arguments):
+        if not self.status_all:
+            self._send(-9, "U", 33)
+            return
+        motors = [int(argument) for argument in arguments if argument and int(argument)]
+        if not motors:
+            motors = range(1, self.motor_count + 1)
+        status = [33]
+        for motor in motors:
+            position = self.position(motor)
+            status.extend((motor, position, position, 1 if position <= 0 else -1, -1))
+        self._send(*status)
+
+    def _on_current_reading(self, arguments):
+        self._send(41, int(arguments[0]), 0)
+
+
+def _split_arguments(line):
+    arguments = []
+    argument = ""
+    escaped = False
+    for character in line:
+        if escaped:
+            # the escaped characters stay as they are - binary arguments unescape them themselves
+            argument += _cmd_messenger_escape + character
+            escaped = False
+        elif character == _cmd_messenger_escape:
+            escaped = True
+        elif character == ',':
+            arguments.append(argument)
+            argument = ""
+        else:
+            argument += character
+    arguments.append(argument)
+    return arguments
+
+
+class SimulatedSerialPort(object):
+    """
+    Stands in for serial.Serial connected to the simulated firmware. With line_speed writing takes as long as it
+    would take at the baud rate.
+    """
+
+    def __init__(self, firmware, baudrate=_default_baud_rate, timeout=None, line_speed=False):
+        self.firmware = firmware
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.line_speed = line_speed
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    @property
+    def in_waiting(self):
+        return self.firmware.output_waiting
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        data = self.firmware.read(size, self.timeout)
+        self.bytes_read += len(data)
+        return data
+
+    def write(self, data):
+        if self.line_speed:
+            time.sleep(float(len(data) * _bits_per_byte) / self.baudrate)
+        self.bytes_written += len(data)
+        self.firmware.receive(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        self.firmware.discard_output()
+
+    def close(self):
+        pass
+
+
+class SimulatedPty(object):
+    """
+    Connects the simulated firmware to a pseudo terminal - port is the device to open with pyserial.
+    """
+
+    def __init__(self, firmware):
+        self.firmware = firmware
+        self._master, self._slave = pty.openpty()
+        # no echo, no line editing - just bytes
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.active = True
+        self._reading_thread = threading.Thread(target=self._read_from_pty)
+        self._reading_thread.daemon = True
+        self._writing_thread = threading.Thread(target=self._write_to_pty)
+        self._writing_thread.daemon = True
+        self._reading_thread.start()
+        self._writing_thread.start()
+
+    def _read_from_pty(self):
+        while self.active:
+            try:
+                data = os.read(self._master, _pty_chunk_size)
+            except OSError:
+                break
+            if data:
+                self.firmware.receive(data)
+
+    def _write_to_pty(self):
+        while self.active:
+            data = self.firmware.read(_pty_chunk_size, _pty_read_timeout)
+            if data:
+                try:
+                    os.write(self._master, data)
+                except OSError:
+                    break
+
+    def close(self):
+        self.active = False
+        self._writing_thread.join()
+        os.close(self._slave)
+        os.close(self._master)
+
+
+def _add_heater(heater_config):
+    pins = beagle_bone_pins.pwm_config[heater_config['output'] - 1]
+    return hardware.add_heater(pins['out'], pins['temp'], SimulatedHeater(heater_config['sensor-type']))
+
+
+def _simulate_heaters(config):
+    _add_heater(config['extruder']['heater'])
+    if 'heated-bed' in config['printer']:
+        _add_heater(config['printer']['heated-bed'])
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    arguments = argv[1:]
+    if not arguments:
+        print __doc__
+        return 1
+    config_file = arguments[0]
+    time_scale = 1.0
+    http_port = 8080
+    if '--time-scale' in arguments:
+        time_scale = float(arguments[arguments.index('--time-scale') + 1])
+    if '--http-port' in arguments:
+        http_port = int(arguments[arguments.index('--http-port') + 1])
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # the print server must only see the simulated pins
+    install_hardware_shims()
+
+    firmware = SimulatedFirmware(time_scale=time_scale)
+    firmware.start()
+    simulated_pty = SimulatedPty(firmware)
+    _logger.info("Simulated arduino at %s", simulated_pty.port)
+
+    import beaglebone_helpers
+    import t_bone_server
+    from t_bone import json_config_file
+
+    # resetting the arduino resets the simulated one
+    hardware.on_rising_edge(beaglebone_helpers._reset_pin, firmware.reset)
+    beaglebone_helpers._default_serial_port = simulated_pty.port
+    json_config_file._config_file = config_file
+    t_bone_server.UPLOAD_FOLDER = tempfile.mkdtemp(prefix="t_bone_uploads")
+    t_bone_server.app.config['UPLOAD_FOLDER'] = t_bone_server.UPLOAD_FOLDER
+    t_bone_server.app.config['MAX_CONTENT_LENGTH'] = t_bone_server.MAX_CONTENT_LENGTH
+    try:
+        _simulate_heaters(json_config_file.read())
+        t_bone_server.create_printer()
+        t_bone_server.app.run(host='0.0.0.0', port=http_port, use_reloader=False, threaded=True)
+    finally:
+        if t_bone_server._printer:
+            t_bone_server._printer.stop()
+        simulated_pty.close()
+        firmware.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
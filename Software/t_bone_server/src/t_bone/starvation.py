@@ -0,0 +1,178 @@
+from collections import namedtuple, deque
+import logging
+import threading
+import time
+
+from machine import FIRMWARE_MIN_BUFFER_DEPTH
+from metrics import metrics
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+# what the host spent its time on before the arduino ran dry - the stage with the most time was the slow one
+_STAGE_HISTOGRAMS = (
+    ('parsing', 'gcode_parse_seconds'),
+    ('planning', 'planner_recalculation_seconds'),
+    ('move config', 'move_config_seconds'),
+    ('serial', 'serial_round_trip_seconds'),
+)
+# how far back the stage times are compared
+_DEFAULT_STAGE_WINDOW = 1.0
+# a print with a lot of trouble must not eat up the memory
+_MAX_RECORDED_STARVATIONS = 100
+
+# print_time is the time since the print has started, duration is None until the arduino has got enough again
+Starvation = namedtuple('Starvation', ['time', 'print_time', 'queue_length', 'planning_queue_length',
+                                       'execution_queue_length', 'commands_in_flight', 'slow_stage',
+                                       'stage_times', 'duration'])
+
+
+class StarvationDetector(object):
+    """
+    Watches the queue length the arduino reports while printing. If it drops to starved_queue_length or below the
+    arduino does not start the next move - it runs dry as soon as the current one is done. Every time that happens is
+    written down with the host queue lengths & the stage the host spent the most time in just before.
+    The queue only counts once it has been filled - so that the start of a print is no starvation.
+    read_host_queues has to return the length of the planning queue, the execution queue & how many commands are
+    sent but not answered.
+    """
+
+    def __init__(self, read_host_queues, starved_queue_length=FIRMWARE_MIN_BUFFER_DEPTH,
+                 stage_window=_DEFAULT_STAGE_WINDOW):
+        self._read_host_queues = read_host_queues
+        self.starved_queue_length = starved_queue_length
+        self.stage_window = stage_window
+        self._stage_histograms = [(stage, metrics.histogram(name)) for stage, name in _STAGE_HISTOGRAMS]
+        self._lock = threading.Lock()
+        self.watching = False
+        self.armed = False
+        self.print_start = None
+        self.print_end = None
+        self.starvation_count = 0
+        self.starvations = []
+        self._current_starvation = None
+        self._current_start = None
+        self.starved_time = 0.0
+        self.longest_starvation = 0.0
+        self.slow_stages = {}
+        # (time, {stage: seconds spent so far})
+        self._stage_samples = deque()
+
+    def start(self):
+        with self._lock:
+            self.watching = True
+            self.armed = False
+            self.print_start = time.time()
+            self.print_end = None
+            self.starvation_count = 0
+            self.starvations = []
+            self._current_starvation = None
+            self._current_start = None
+            self.starved_time = 0.0
+            self.longest_starvation = 0.0
+            self.slow_stages = {}
+            self._stage_samples.clear()
+
+    def finish(self):
+        """
+        Stops watching - the arduino drains its queue at the end of the print - & returns the summary of the print.
+        """
+        with self._lock:
+            if self.watching:
+                self._end_starvation(time.time())
+                self.watching = False
+                self.print_end = time.time()
+        summary = self.summary()
+        if summary['starvations']:
+            _logger.warn("The arduino ran dry %s times during the print for %0.1fs, slow stages: %s",
+                         summary['starvations'], summary['starved_time'], summary['slow_stages'])
+        else:
+            _logger.info("The arduino never ran dry during the print")
+        return summary
+
+    def queue_reported(self, queue_length, max_queue_length=None):
+        if not self.watching:
+            return
+        now = time.time()
+        with self._lock:
+            if not self.watching:
+                return
+            self._sample_stages(now)
+            if queue_length > self.starved_queue_length:
+                self.armed = True
+                self._end_starvation(now)
+            elif self.armed and not self._current_starvation:
+                self._start_starvation(now, queue_length)
+
+    def summary(self):
+        with self._lock:
+            if self.print_start is None:
+                return None
+            end = self.print_end or time.time()
+            starved_time = self.starved_time
+            if self._current_starvation:
+                starved_time += end - self._current_start
+            print_time = end - self.print_start
+            return {
+                'printing': self.watching,
+                'print_time': print_time,
+                'starvations': self.starvation_count,
+                'starved_time': starved_time,
+                'starved_percentage': starved_time / print_time * 100.0 if print_time > 0 else 0.0,
+                'longest_starvation': self.longest_starvation,
+                'slow_stages': dict(self.slow_stages),
+                'events': [starvation._asdict() for starvation in self.starvations]
+            }
+
+    def _start_starvation(self, now, queue_length):
+        try:
+            planning_queue_length, execution_queue_length, commands_in_flight = self._read_host_queues()
+        except Exception as e:
+            _logger.warn("Unable to read the host queues: %s", e)
+            planning_queue_length, execution_queue_length, commands_in_flight = None, None, None
+        stage_times = self._stage_times()
+        slow_stage = None
+        if stage_times and max(stage_times.values()) > 0:
+            slow_stage = max(stage_times, key=stage_times.get)
+        self._current_starvation = Starvation(time=now, print_time=now - self.print_start, queue_length=queue_length,
+                                              planning_queue_length=planning_queue_length,
+                                              execution_queue_length=execution_queue_length,
+                                              commands_in_flight=commands_in_flight, slow_stage=slow_stage,
+                                              stage_times=stage_times, duration=None)
+        self._current_start = now
+        self.starvation_count += 1
+        self.slow_stages[slow_stage] = self.slow_stages.get(slow_stage, 0) + 1
+        _logger.info("Arduino queue at %s, host queues at %s/%s, %s commands in flight, slow stage: %s",
+                     queue_length, planning_queue_length, execution_queue_length, commands_in_flight, slow_stage)
+
+    def _end_starvation(self, now):
+        if not self._current_starvation:
+            return
+        duration = now - self._current_start
+        self.starved_time += duration
+        self.longest_starvation = max(self.longest_starvation, duration)
+        if len(self.starvations) < _MAX_RECORDED_STARVATIONS:
+            self.starvations.append(self._current_starvation._replace(duration=duration))
+        self._current_starvation = None
+        self._current_start = None
+
+    def _sample_stages(self, now):
+        if not metrics.enabled:
+            return
+        samples = self._stage_samples
+        stage_sums = dict((stage, histogram.sum) for stage, histogram in self._stage_histograms)
+        # the metrics have been reset - the sums before are of no use anymore
+        if samples and any(stage_sums[stage] < samples[-1][1][stage] for stage in stage_sums):
+            samples.clear()
+        samples.append((now, stage_sums))
+        # one sample older than the window is enough to compare with
+        while len(samples) > 2 and samples[1][0] <= now - self.stage_window:
+            samples.popleft()
+
+    def _stage_times(self):
+        if len(self._stage_samples) < 2:
+            return None
+        start_sums = self._stage_samples[0][1]
+        end_sums = self._stage_samples[-1][1]
+        # a reset while the sums were read may still make a difference negative
+        return dict((stage, max(end_sums[stage] - start_sums[stage], 0.0)) for stage in end_sums)
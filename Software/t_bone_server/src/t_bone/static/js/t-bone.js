@@ -24,8 +24,48 @@ function update_status() {
     })
 }
 
+//the server pushes the changes of the status - we only poll if the browser cannot do server sent events
+function merge_status(status, changes) {
+    var key;
+    for (key in changes) {
+        if (changes[key] !== null && typeof changes[key] == "object"
+            && status[key] !== null && typeof status[key] == "object") {
+            merge_status(status[key], changes[key]);
+        } else if (changes[key] === null) {
+            delete status[key];
+        } else {
+            status[key] = changes[key];
+        }
+    }
+    return status;
+}
+
+function stream_status() {
+    var status_source = new EventSource("/status/stream");
+    //the whole status - after connecting or if the server has restarted
+    status_source.addEventListener("status", function (event) {
+        last_status = JSON.parse(event.data);
+        trigger_status_update();
+    });
+    status_source.onmessage = function (event) {
+        last_status = merge_status(last_status || {}, JSON.parse(event.data));
+        trigger_status_update();
+    };
+}
+
+function trigger_status_update() {
+    $("body").trigger({
+        type: "status_update",
+        status_data: last_status
+    });
+}
+
 $().ready(function () {
-    setInterval("update_status()", 1000);
+    if (window.EventSource) {
+        stream_status();
+    } else {
+        setInterval("update_status()", 1000);
+    }
 })
 
 //update the status bar
@@ -0,0 +1,266 @@
+from collections import namedtuple, deque
+from copy import deepcopy
+import logging
+from threading import Thread
+import threading
+import time
+import uuid
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+# how often the axis status is read from the machine
+_DEFAULT_SAMPLE_INTERVAL = 1.0
+# keep alive pings can come every few milliseconds - the queue length is not published more often than that
+_DEFAULT_QUEUE_SAMPLE_INTERVAL = 0.25
+# how often the sampling thread checks if it should stop
+_STOP_CHECK_INTERVAL = 1.0
+# how many changes a status stream remembers - clients which are further behind get the whole status
+_DEFAULT_STREAM_HISTORY = 100
+# not everything in the status comes from the sampler - so the stream looks for changes at least that often
+_DEFAULT_STREAM_INTERVAL = 1.0
+
+# everything the web pages show about the printer - it is never changed, just replaced by a newer one
+StatusSnapshot = namedtuple('StatusSnapshot', ['time', 'printing', 'queue_length', 'max_queue_length',
+                                               'axis_status', 'axis_status_time', 'extruder_temperature',
+                                               'extruder_set_temperature', 'bed_temperature', 'bed_set_temperature'])
+
+
+class StatusSampler(Thread):
+    """
+    Samples the printer status in the background - so that the serial load does not depend on how many browsers ask
+    for it. The queue length is updated with the keep alive pings of the machine, but at most every
+    queue_sample_interval seconds, the axis status is read every sample_interval seconds.
+    """
+
+    def __init__(self, printer, sample_interval=None, queue_sample_interval=None):
+        super(StatusSampler, self).__init__()
+        self.daemon = True
+        self._printer = printer
+        if sample_interval:
+            self.sample_interval = sample_interval
+        else:
+            self.sample_interval = _DEFAULT_SAMPLE_INTERVAL
+        if queue_sample_interval is not None:
+            self.queue_sample_interval = queue_sample_interval
+        else:
+            self.queue_sample_interval = _DEFAULT_QUEUE_SAMPLE_INTERVAL
+        self.active = False
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        # notified for every new snapshot
+        self.updated = threading.Condition()
+
+    def stop(self):
+        self.active = False
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if not snapshot:
+            # nobody has sampled yet
+            with self._snapshot_lock:
+                if not self._snapshot:
+                    self._sample()
+                snapshot = self._snapshot
+        return snapshot
+
+    def wait_for_update(self, timeout):
+        with self.updated:
+            self.updated.wait(timeout)
+
+    def _publish(self, snapshot):
+        self._snapshot = snapshot
+        with self.updated:
+            self.updated.notify_all()
+
+    def age(self, snapshot=None):
+        if not snapshot:
+            snapshot = self.snapshot()
+        return time.time() - snapshot.time
+
+    def run(self):
+        self.active = True
+        next_sample = time.time()
+        if self._snapshot:
+            next_sample += self.sample_interval
+        while self.active:
+            now = time.time()
+            if now >= next_sample:
+                with self._snapshot_lock:
+                    self._sample()
+                next_sample = now + self.sample_interval
+            elif not self._wait_for_keep_alive(min(next_sample - now, _STOP_CHECK_INTERVAL)):
+                continue
+            elif self._snapshot:
+                # a ping shortly after the last snapshot is not published right away - but neither lost
+                wait_time = self._snapshot.time + self.queue_sample_interval - time.time()
+                if wait_time > 0:
+                    time.sleep(min(wait_time, _STOP_CHECK_INTERVAL))
+                with self._snapshot_lock:
+                    self._sample_queue()
+
+    def _wait_for_keep_alive(self, timeout):
+        connection = self._printer.machine.machine_connection
+        if connection:
+            return connection.wait_for_keep_alive(timeout)
+        time.sleep(timeout)
+        return False
+
+    def _sample(self):
+        printer = self._printer
+        axis_status = None
+        axis_status_time = None
+        if self._snapshot:
+            axis_status = self._snapshot.axis_status
+            axis_status_time = self._snapshot.axis_status_time
+        if printer.machine.machine_connection:
+            try:
+                axis_status = printer.read_axis_status()
+                axis_status_time = time.time()
+            except Exception as e:
+                _logger.warn("Unable to read the axis status: %s", e)
+        bed_temperature = None
+        bed_set_temperature = None
+        if printer.heated_bed:
+            bed_temperature = printer.heated_bed.temperature
+            bed_set_temperature = printer.heated_bed.get_set_temperature()
+        queue_length, max_queue_length = self._queue_length()
+        self._publish(StatusSnapshot(time=time.time(), printing=printer.printing, queue_length=queue_length,
+                                     max_queue_length=max_queue_length, axis_status=axis_status,
+                                     axis_status_time=axis_status_time,
+                                     extruder_temperature=printer.extruder_heater.temperature,
+                                     extruder_set_temperature=printer.extruder_heater.get_set_temperature(),
+                                     bed_temperature=bed_temperature, bed_set_temperature=bed_set_temperature))
+
+    def _sample_queue(self):
+        # the keep alive ping has brought a new queue length - the rest stays as it is
+        queue_length, max_queue_length = self._queue_length()
+        self._publish(self._snapshot._replace(time=time.time(), printing=self._printer.printing,
+                                              queue_length=queue_length, max_queue_length=max_queue_length))
+
+    def _queue_length(self):
+        connection = self._printer.machine.machine_connection
+        if not connection:
+            return 0, 1
+        return int(connection.internal_queue_length), int(connection.internal_queue_max_length)
+
+
+class StatusStream(Thread):
+    """
+    Turns the status into a stream of changes. The changes are computed once - no matter how many clients listen.
+    read_status has to return the status as dict.
+    Every stream counts its changes from 1 - so the event ids carry the id of the stream they belong to.
+    """
+
+    def __init__(self, sampler, read_status, history_length=_DEFAULT_STREAM_HISTORY,
+                 stream_interval=_DEFAULT_STREAM_INTERVAL):
+        super(StatusStream, self).__init__()
+        self.daemon = True
+        self._sampler = sampler
+        self._read_status = read_status
+        self.stream_interval = stream_interval
+        self.active = False
+        self.status = None
+        self.sequence = 0
+        self.stream_id = uuid.uuid4().hex[:8]
+        # (sequence, changes) for the last changes
+        self._changes = deque(maxlen=history_length)
+        self.changed = threading.Condition()
+
+    def stop(self):
+        self.active = False
+        with self.changed:
+            self.changed.notify_all()
+
+    def run(self):
+        self.active = True
+        while self.active:
+            try:
+                self.update(self._read_status())
+            except Exception as e:
+                _logger.warn("Unable to read the status: %s", e)
+            self._sampler.wait_for_update(self.stream_interval)
+
+    def update(self, status):
+        with self.changed:
+            changes = status_changes(self.status, status)
+            if changes:
+                self.sequence += 1
+                self.status = status
+                self._changes.append((self.sequence, changes))
+                self.changed.notify_all()
+
+    def event_id(self, sequence):
+        return "%s-%s" % (self.stream_id, sequence)
+
+    def sequence_of(self, event_id):
+        """
+        The sequence of an event id of this stream - or None if the event id is from another stream.
+        """
+        if not event_id:
+            return None
+        stream_id, separator, sequence = event_id.rpartition('-')
+        if stream_id != self.stream_id or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def changes_since(self, sequence):
+        """
+        Returns the current sequence, what has changed since the given sequence & if that is the whole status - which
+        it is if the sequence is unknown. The changes are None if nothing has changed.
+        """
+        with self.changed:
+            if sequence == self.sequence:
+                return sequence, None, False
+            if sequence is None or not self._changes or sequence < self._changes[0][0] - 1 \
+                    or sequence > self.sequence:
+                return self.sequence, self.status, True
+            changes = {}
+            for change_sequence, change in self._changes:
+                if change_sequence > sequence:
+                    _merge_changes(changes, change)
+            return self.sequence, changes, False
+
+    def events(self, sequence=None, timeout=None):
+        """
+        Yields (sequence, changes, whole status) as soon as something changes, starting with the whole status if the
+        sequence is not known. Yields (sequence, None, False) if nothing has changed for timeout seconds.
+        """
+        while self.active:
+            with self.changed:
+                if sequence == self.sequence:
+                    self.changed.wait(timeout)
+                sequence, changes, complete = self.changes_since(sequence)
+            yield sequence, changes, complete
+
+
+def status_changes(old_status, new_status):
+    """
+    What is different in the new status - nested dicts are compared key by key, removed entries are None.
+    """
+    if old_status is None:
+        return new_status
+    changes = {}
+    for key, value in new_status.iteritems():
+        old_value = old_status.get(key)
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            value_changes = status_changes(old_value, value)
+            if value_changes:
+                changes[key] = value_changes
+        elif key not in old_status or old_value != value:
+            changes[key] = value
+    for key in old_status:
+        if key not in new_status:
+            changes[key] = None
+    return changes
+
+
+def _merge_changes(changes, newer_changes):
+    for key, value in newer_changes.iteritems():
+        if isinstance(value, dict) and isinstance(changes.get(key), dict):
+            _merge_changes(changes[key], value)
+        elif isinstance(value, dict):
+            # the changes in the history must stay as they are
+            changes[key] = deepcopy(value)
+        else:
+            changes[key] = value
@@ -5,12 +5,17 @@ import json
 import logging
 import os
 import threading
+import time
 
 from flask import Flask, render_template, request, redirect
 import flask
 from werkzeug.utils import secure_filename
 import beaglebone_helpers
 from gcode_interpreter import GCodePrintThread
+from gcode_index import index_gcode, get_index
+from metrics import metrics
+from print_job import compile_gcode
+from status_sampler import StatusSampler, StatusStream
 from t_bone import json_config_file
 
 T_BONE_LOG_FILE = '/var/log/t_bone.log'
@@ -18,6 +23,10 @@ T_BONE_LOG_FILE = '/var/log/t_bone.log'
 _logger = logging.getLogger(__name__)
 # this is THE printer - just a dictionary with anything
 _printer = None
+_status_sampler = None
+_status_stream = None
+# send something every now and then - so that we notice if the client is gone
+_STATUS_STREAM_KEEP_ALIVE = 15
 _print_thread = None
 _printer_busy = False
 _printer_busy_lock = threading.RLock()
@@ -68,6 +77,7 @@ def start_page():
 def print_page():
     if not _printer:
         return "there is no printer", 400
+    print_error = None
     if request.method == 'POST':
         if request.files and 'uploadfile' in request.files:
             file = request.files['uploadfile']
@@ -77,19 +87,26 @@ def print_page():
                 try:
                     _logger.info("Saving file %s to %s", filename, upload_path)
                     file.save(upload_path)
+                    # so that the print does not have to parse the text
+                    prepare_thread = threading.Thread(target=_prepare_print_file, args=(upload_path,))
+                    prepare_thread.daemon = True
+                    prepare_thread.start()
                 except:
                     _logger.warn("unable to save file %s to %s", filename, upload_path)
         elif 'printfile' in request.form:
             filename = request.form['printfile']
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             if isfile(file_path) and beaglebone_helpers.allowed_file(filename):
-                _printer.prepared_file = file_path
-                _logger.info("Printing %s", _printer.prepared_file)
-                global _print_thread
-                _print_thread = GCodePrintThread(_printer.prepared_file, _printer, None)
-                _print_thread.start()
+                start_layer, print_error = _read_start_layer(file_path)
+                if not print_error:
+                    _printer.prepared_file = file_path
+                    _logger.info("Printing %s from layer %s", _printer.prepared_file, start_layer)
+                    global _print_thread
+                    _print_thread = GCodePrintThread(_printer.prepared_file, _printer, None, start_layer=start_layer)
+                    _print_thread.start()
 
     template_dictionary = templating_defaults()
+    template_dictionary['print_error'] = print_error
     files = [f for f in listdir(app.config['UPLOAD_FOLDER'])
              if isfile(app.config['UPLOAD_FOLDER'] + "/" + f) and fnmatch.fnmatch(f, '*.gcode')]
     #todo would like to http://stackoverflow.com/questions/6591931/getting-file-size-in-python
@@ -101,6 +118,30 @@ def print_page():
     return render_template("print.html", **template_dictionary)
 
 
+def _read_start_layer(file_path):
+    # the form only allows sensible numbers - but not every request comes from the form
+    start_layer = request.form.get('startlayer', '').strip()
+    if not start_layer:
+        return None, None
+    try:
+        start_layer = int(start_layer)
+    except ValueError:
+        return None, "The start layer '%s' is not a number" % start_layer
+    layers = len(get_index(file_path).layers)
+    if start_layer < 1 or start_layer > layers:
+        return None, "There is no layer %s - the file has %s layers" % (start_layer, layers)
+    return start_layer, None
+
+
+def _prepare_print_file(upload_path):
+    # index and compile the upload in one go - printing gets faster and can start at any layer
+    try:
+        index_gcode(upload_path)
+        compile_gcode(upload_path)
+    except Exception as e:
+        _logger.error("Unable to prepare %s for printing: %s", upload_path, e)
+
+
 @app.route('/control', methods=['GET', 'POST'])
 def control():
     if request.method == 'POST':
@@ -182,19 +223,20 @@ def templating_defaults():
             templating_dictionary['print_status'] = 'Printing'
         else:
             templating_dictionary['print_status'] = 'Idle'
+        # the status comes from the sampler - asking the machine for every page would disturb the printing
+        snapshot = _status_sampler.snapshot()
         if _printer.machine.machine_connection:
-            connection = _printer.machine.machine_connection
-            templating_dictionary['queue_length'] = connection.internal_queue_length
-            templating_dictionary['max_queue_length'] = connection.internal_queue_max_length
+            templating_dictionary['queue_length'] = snapshot.queue_length
+            templating_dictionary['max_queue_length'] = snapshot.max_queue_length
             templating_dictionary['queue_percentage'] = int(
-                float(connection.internal_queue_length) / float(connection.internal_queue_max_length) * 10.0)
-            templating_dictionary['axis_status'] = _printer.read_axis_status()
-        templating_dictionary['extruder_temperature'] = "%0.1f" % _printer.extruder_heater.temperature
-        templating_dictionary['extruder_set_temperature'] = "%0.1f" % _printer.extruder_heater.get_set_temperature()
+                float(snapshot.queue_length) / float(snapshot.max_queue_length) * 10.0)
+            templating_dictionary['axis_status'] = snapshot.axis_status
+        templating_dictionary['extruder_temperature'] = "%0.1f" % snapshot.extruder_temperature
+        templating_dictionary['extruder_set_temperature'] = "%0.1f" % snapshot.extruder_set_temperature
         if _printer.heated_bed:
             templating_dictionary['heated_bed'] = True
-            templating_dictionary['bed_temperature'] = "%0.1f" % _printer.heated_bed.temperature
-            templating_dictionary['bed_set_temperature'] = "%0.1f" % _printer.heated_bed.get_set_temperature()
+            templating_dictionary['bed_temperature'] = "%0.1f" % snapshot.bed_temperature
+            templating_dictionary['bed_set_temperature'] = "%0.1f" % snapshot.bed_set_temperature
         else:
             templating_dictionary['heated_bed'] = False
     return templating_dictionary
@@ -202,44 +244,107 @@ def templating_defaults():
 
 @app.route('/status')
 def status():
-    connection = _printer.machine.machine_connection
+    return flask.jsonify(
+        _status_dict()
+    )
+
+
+@app.route('/status/stream')
+def status_stream():
+    """
+    The status as server sent events - the first event is the whole status, after that only the changes are sent.
+    The whole status is a 'status' event, which replaces what the browser knows, the changes are plain messages.
+    """
+    status_stream = _status_stream
+    # an id from before a restart belongs to another stream - the browser gets the whole status again
+    sequence = status_stream.sequence_of(request.headers.get('Last-Event-ID'))
+
+    def events():
+        for event_sequence, changes, complete in status_stream.events(sequence, _STATUS_STREAM_KEEP_ALIVE):
+            if changes is None:
+                yield ":\n\n"
+            else:
+                event_type = "event: status\n" if complete else ""
+                yield "%sid: %s\ndata: %s\n\n" % (event_type, status_stream.event_id(event_sequence),
+                                                   json.dumps(changes))
+
+    return flask.Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/metrics')
+def metrics_page():
+    """
+    Counters, latency histograms & the queue lengths over time of the print pipeline.
+    """
+    return flask.jsonify(metrics.snapshot())
+
+
+@app.route('/metrics/reset', methods=['POST'])
+def reset_metrics():
+    """
+    Starts the metrics over - the response has them as they were before.
+    """
+    snapshot = metrics.snapshot()
+    metrics.reset()
+    return flask.jsonify(snapshot)
+
+
+@app.route('/metrics/starvation')
+def starvation_page():
+    """
+    When the arduino ran dry during the current (or last) print - & which stage of the host was slow at that time.
+    """
+    return flask.jsonify(_printer.starvation_detector.summary() or {})
+
+
+def _status_dict(with_age=True):
+    snapshot = _status_sampler.snapshot()
     base_status = {'printing': _printer.printing,
                    'busy': (_printer_busy | _printer.printing),
-                   'queue_length': connection.internal_queue_length,
-                   'max_queue_length': connection.internal_queue_max_length,
+                   'queue_length': snapshot.queue_length,
+                   'max_queue_length': snapshot.max_queue_length,
                    'queue_percentage': int(
-                       float(connection.internal_queue_length) / float(connection.internal_queue_max_length) * 100.0),
-                   'extruder_temperature': "%0.1f" % _printer.extruder_heater.temperature,
-                   'extruder_set_temperature': "%0.1f" % _printer.extruder_heater.get_set_temperature(),
-                   'axis_status': _printer.read_axis_status()
+                       float(snapshot.queue_length) / float(snapshot.max_queue_length) * 100.0),
+                   'extruder_temperature': "%0.1f" % snapshot.extruder_temperature,
+                   'extruder_set_temperature': "%0.1f" % snapshot.extruder_set_temperature,
+                   'axis_status': snapshot.axis_status
     }
-    if _printer.heated_bed:
-        base_status['bed_temperature'] = "%0.1f" % _printer.heated_bed.temperature
-        base_status['bed_set_temperature'] = "%0.1f" % _printer.heated_bed.get_set_temperature()
+    if with_age:
+        base_status['status_age'] = _status_sampler.age(snapshot)
+        if snapshot.axis_status_time:
+            base_status['axis_status_age'] = time.time() - snapshot.axis_status_time
+    if snapshot.bed_temperature is not None:
+        base_status['bed_temperature'] = "%0.1f" % snapshot.bed_temperature
+        base_status['bed_set_temperature'] = "%0.1f" % snapshot.bed_set_temperature
     if _printer.printing:
         base_status['print_status'] = 'Printing'
     else:
         base_status['print_status'] = 'Idle'
 
-    if _printer.heated_bed:
-        base_status['bed-temperature'] = "%0.1f" % _printer.heated_bed.temperature
-        base_status['bed-set-temperature'] = "%0.1f" % _printer.heated_bed.get_set_temperature()
+    if snapshot.bed_temperature is not None:
+        base_status['bed-temperature'] = "%0.1f" % snapshot.bed_temperature
+        base_status['bed-set-temperature'] = "%0.1f" % snapshot.bed_set_temperature
 
 
     global _print_thread
     if _print_thread and _print_thread.printing:
         base_status['lines_to_print'] = _print_thread.lines_to_print
         base_status['lines_printed'] = _print_thread.lines_printed
-        base_status['lines_printed_percent'] = float(_print_thread.lines_printed) / float(
-            _print_thread.lines_to_print) * 100
-    return flask.jsonify(
-        base_status
-    )
-    pass
+        base_status['lines_printed_percent'] = _print_thread.percent_printed
+        base_status['bytes_to_print'] = _print_thread.bytes_to_print
+        base_status['bytes_printed'] = _print_thread.bytes_printed
+        if _print_thread.layers is not None:
+            base_status['layer'] = _print_thread.layer
+            base_status['layers'] = _print_thread.layers
+    return base_status
 
 
 @app.route('/restart')
 def restart_printer():
+    if _status_stream:
+        _status_stream.stop()
+    if _status_sampler:
+        _status_sampler.stop()
     if _printer:
         _printer.stop()
     create_printer()
@@ -247,13 +352,19 @@ def restart_printer():
 
 
 def create_printer():
-    global _printer, config
+    global _printer, _status_sampler, _status_stream, config
     _printer = beaglebone_helpers.create_printer()
     _printer.prepared_file = None
 
     config = json_config_file.read()
     _printer.connect()
     _printer.configure(config)
+    _status_sampler = StatusSampler(_printer, config['printer'].get('status-interval'),
+                                    config['printer'].get('status-queue-interval'))
+    _status_sampler.start()
+    # the age is no change - the stream is always up to date
+    _status_stream = StatusStream(_status_sampler, lambda: _status_dict(with_age=False))
+    _status_stream.start()
 
 
 if __name__ == '__main__':
@@ -275,7 +386,9 @@ if __name__ == '__main__':
             host='0.0.0.0',
 	    port=80,
             debug=True,
-            use_reloader=False
+            use_reloader=False,
+            # the status streams keep their connections open
+            threaded=True
         )
     except KeyboardInterrupt:
         _printer.stop()
@@ -5,39 +5,41 @@ from t_bone import replicape_thermistors
 
 _logger = logging.getLogger(__name__)
 
+_ramps_tables = {
+    "100k": ramps_thermistors.bed_thermistor_100k,
+    "200k": ramps_thermistors.bed_thermistor_200k,
+    "mendel-parts": ramps_thermistors.mendel_parts_thermistor,
+    "10k": ramps_thermistors.thermistor_10k,
+    "parcan-100k": ramps_thermistors.thermistor_parcan_100k,
+    "epcos-100k": ramps_thermistors.thermistor_epcos_100k,
+    "epcos-B57560G104F": ramps_thermistors.thermistor_epcos_B57560G104F,
+    "j-head": ramps_thermistors.j_head_thermistor,
+    "honeywell-100k": ramps_thermistors.thermistor_honeywell_100k,
+    "honeywell-135_104_LAF_J01": ramps_thermistors.thermistor_honeywell_135_104_LAF_J01,
+    "vishay-NTCS0603E3104FXT": ramps_thermistors.thermistor_vishay_NTCS0603E3104FXT,
+    "ge-sensing": ramps_thermistors.thermistor_ge_sensing,
+    "rs-198961": ramps_thermistors.thermistor_rs_198961,
+}
+# every thermistor is compiled once - the first time it is used
+_thermistors = {}
+
+
+def get_thermistor(thermistor):
+    converter = _thermistors.get(thermistor)
+    if converter is None:
+        if thermistor in _ramps_tables:
+            converter = ramps_thermistors.RampsThermistor(thermistor, _ramps_tables[thermistor])
+        elif thermistor in replicape_thermistors.temp_table:
+            converter = replicape_thermistors.ReplicapeThermistor(thermistor)
+        else:
+            raise Exception("Unknown Thermistor %s" % thermistor)
+        _thermistors[thermistor] = converter
+    return converter
 
 
 def get_thermistor_reading(thermistor, value):
-    #find the thermistor
-    thermistor_table = None
-    if thermistor == "100k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.bed_thermistor_100k, value)
-    elif thermistor == "200k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.bed_thermistor_200k, value)
-    elif thermistor == "mendel-parts":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.mendel_parts_thermistor, value)
-    elif thermistor == "10k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_10k, value)
-    elif thermistor == "parcan-100k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_parcan_100k, value)
-    elif thermistor == "epcos-100k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_epcos_100k, value)
-    elif thermistor == "epcos-B57560G104F":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_epcos_B57560G104F, value)
-    elif thermistor == "j-head":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.j_head_thermistor, value)
-    elif thermistor == "honeywell-100k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_honeywell_100k, value)
-    elif thermistor == "honeywell-135_104_LAF_J01":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_honeywell_135_104_LAF_J01, value)
-    elif thermistor == "vishay-NTCS0603E3104FXT":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_vishay_NTCS0603E3104FXT, value)
-    elif thermistor == "ge-sensing":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_ge_sensing, value)
-    elif thermistor == "rs-198961":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_rs_198961, value)
-    elif thermistor == "B57560G104F":
-        return replicape_thermistors.convert_reading(replicape_thermistors.temp_table["B57560G104F"], value)
-    if not thermistor:
-        raise Exception("Unknown Thermistor" + thermistor)
+    return get_thermistor(thermistor).convert(value)
+
 
+def get_thermistor_readings(thermistor, values):
+    return get_thermistor(thermistor).convert_all(values)
@@ -0,0 +1,4 @@
+#!/bin/sh
+# the whole print server with a simulated arduino & beagle bone - e.g. on a x86 linux box
+export PYTHONPATH=$(dirname $0)/src/
+python $PYTHONPATH/t_bone/simulation.py $(dirname $0)/simulated_printer_config.json "$@"
@@ -0,0 +1,584 @@
+"""Benchmarks for the hot paths of the print server - and for a whole print against the simulated machine.
+
+usage: python benchmarks.py [benchmark] [--save-baseline] [--check] [gcode files ...]
+
+Without any g code files a synthetic Slic3r like file is used. --save-baseline stores the results as baseline,
+--check compares them with the stored baseline & fails if something got slower. The baselines are only comparable on
+the same box and for the synthetic file. The print measures the peak memory of its process, so it gets a fresh
+interpreter if other benchmarks run too.
+"""
+import json
+import logging
+from math import sin, cos, pi
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# the whole print runs against the simulated machine - without any beagle bone pins
+from t_bone.simulated_hardware import install_hardware_shims
+install_hardware_shims()
+from t_bone.simulation import SimulatedFirmware, SimulatedSerialPort
+from t_bone import gcode_interpreter
+from t_bone.gcode_interpreter import decode_gcode_line, decode_text_and_number, read_gcode_to_printer
+from t_bone.gcode_tokenizer import tokenize_gcode_line
+from t_bone.print_job import compile_gcode, PrintJobReader
+from t_bone.machine import Machine, move_command, binary_move_command, _encode_command, _CommandReader, \
+    MachineCommand
+from t_bone.printer import Printer, PrintQueue, Move, MoveVector
+from t_bone import replicape_thermistors
+from t_bone.thermistors import get_thermistor
+
+__author__ = 'marcus'
+
+_default_repetitions = 3
+_planner_axis_config = {
+    'x': {
+        'max_acceleration': 150,
+        'max_speed': 300,
+        'bow': 20.0,
+        'steps_per_mm': 1420.8984
+    },
+    'y': {
+        'max_acceleration': 150,
+        'max_speed': 300,
+        'bow': 20.0,
+        'steps_per_mm': 1420.8984
+    },
+    'z': {
+        'steps_per_mm': 1
+    },
+    'e': {
+        'steps_per_mm': 1
+    }
+}
+_planner_queue_lengths = (10, 50, 100, 200, 500)
+# how many planned moves are measured for their memory
+_move_memory_queue_length = 500
+_thermistor_readings = 10000
+_thermistor_batch_size = 16
+_serial_moves = 2000
+# 8N1 - every byte takes 10 bits on the line
+_serial_baud_rate = 38400
+_serial_bits_per_byte = 10
+_reply_stream_commands = 20000
+# how much the serial port has collected when we come around to read it
+_reply_chunk_sizes = (16, 64, 256)
+_print_config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                  "simulated_printer_config.json")
+# heating up is no part of the benchmark
+_temperature_waits = ("M109", "M190")
+_baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baselines.json")
+# how much worse than the baseline is still ok - benchmarks are noisy
+_regression_tolerance = 0.25
+
+
+def synthetic_gcode(layers=20, segments_per_layer=500):
+    # circles with lots of short segments - the worst case for the interpreter
+    lines = [
+        "; generated for benchmarking\n",
+        "G21 ; set units to millimeters\n",
+        "M104 S200 ; set temperature\n",
+        "G28 ; home all axes\n",
+        "G90 ; use absolute coordinates\n",
+        "G92 E0\n",
+        "M82 ; use absolute distances for extrusion\n",
+    ]
+    extruded = 0.0
+    for layer in range(layers):
+        lines.append("G1 Z%0.3f F7800.000\n" % (0.3 + layer * 0.2))
+        for segment in range(segments_per_layer):
+            angle = 2 * pi * segment / segments_per_layer
+            extruded += 0.01234
+            lines.append("G1 X%0.3f Y%0.3f E%0.5f\n" % (100 + 30 * cos(angle), 100 + 30 * sin(angle), extruded))
+        lines.append("G1 F1800.000 E%0.5f\n" % (extruded - 1))
+    return lines
+
+
+def read_gcode_files(file_names):
+    if not file_names:
+        return synthetic_gcode()
+    lines = []
+    for file_name in file_names:
+        with open(file_name) as gcode_file:
+            lines.extend(gcode_file.readlines())
+    return lines
+
+
+def best_rate(function, items, repetitions=_default_repetitions):
+    # items per second of the fastest run
+    best = None
+    for repetition in range(repetitions):
+        start = time.time()
+        function(items)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return len(items) / best
+
+
+def _old_parser(lines):
+    for line in lines:
+        gcode = decode_gcode_line(line)
+        if gcode and gcode.options:
+            for option in gcode.options:
+                decode_text_and_number(option)
+
+
+def _tokenizer(lines):
+    for line in lines:
+        gcode = tokenize_gcode_line(line)
+        if gcode:
+            gcode.positions()
+
+
+def benchmark_gcode_parsing(file_names):
+    lines = read_gcode_files(file_names)
+    old_rate = best_rate(_old_parser, lines)
+    new_rate = best_rate(_tokenizer, lines)
+    print "g code parsing of %s lines" % len(lines)
+    print "  decode_gcode_line + decode_text_and_number: %10.0f lines/s" % old_rate
+    print "  tokenize_gcode_line:                        %10.0f lines/s (%0.1fx)" % (new_rate, new_rate / old_rate)
+    return {'tokenizer lines/s': new_rate}
+
+
+def benchmark_print_job(file_names):
+    lines = read_gcode_files(file_names)
+    directory = tempfile.mkdtemp()
+    try:
+        gcode_file = os.path.join(directory, "benchmark.gcode")
+        with open(gcode_file, 'w') as gcode_output:
+            gcode_output.writelines(lines)
+        start = time.time()
+        job = PrintJobReader(compile_gcode(gcode_file))
+        compile_duration = time.time() - start
+        records = range(job.record_count)
+        text_rate = best_rate(_tokenizer, lines)
+        job_rate = best_rate(lambda items: [gcode.positions() for gcode in job], records)
+        print "print job of %s lines, %s records, %s layers" % (len(lines), job.record_count, len(job.layers))
+        print "  compiling:               %10.0f lines/s" % (len(lines) / compile_duration)
+        print "  tokenizing the text:     %10.0f lines/s" % text_rate
+        print "  replaying the print job: %10.0f records/s (%0.1fx)" % (job_rate, job_rate / text_rate)
+        return {'replay records/s': job_rate}
+    finally:
+        shutil.rmtree(directory)
+
+
+def read_movements(file_names):
+    movements = []
+    for line in read_gcode_files(file_names):
+        gcode = tokenize_gcode_line(line)
+        if gcode and gcode.code in ("G0", "G1"):
+            movements.append(gcode.positions())
+    return movements
+
+
+def _plan(movements, queue_length):
+    queue = PrintQueue(axis_config=_planner_axis_config, min_length=queue_length, max_length=queue_length + 10,
+                       default_target_speed=50)
+    for movement in movements:
+        movement = dict(movement)
+        movement['type'] = 'move'
+        queue.add_movement(movement)
+        # throw away what would be executed
+        while not queue.queue.empty():
+            queue.next_movement()
+
+
+def benchmark_planner(file_names):
+    movements = read_movements(file_names)
+    print "planning of %s moves" % len(movements)
+    results = {}
+    for queue_length in _planner_queue_lengths:
+        rate = best_rate(lambda items: _plan(items, queue_length), movements)
+        print "  queue length %4s: %8.1f us/move %10.0f moves/s" % (queue_length, 1000000.0 / rate, rate)
+        results['queue length %s moves/s' % queue_length] = rate
+    return results
+
+
+def _nearest_sample(temp_table, reading):
+    # how the replicape charts were read before: the nearest sample by scanning the whole chart
+    resistance = replicape_thermistors.voltage_to_resistance(reading * 1.8)
+    return temp_table[0][abs(temp_table[1] - resistance).argmin()]
+
+
+def _batches(readings, batch_size):
+    return [readings[start:start + batch_size] for start in range(0, len(readings), batch_size)]
+
+
+def benchmark_thermistors(file_names):
+    readings = [random.uniform(0.01, 0.99) for reading in range(_thermistor_readings)]
+    print "thermistor conversion of %s readings, batches of %s" % (len(readings), _thermistor_batch_size)
+    results = {}
+    for name in ("epcos-100k", "B57560G104F"):
+        thermistor = get_thermistor(name)
+        single_rate = best_rate(lambda items: [thermistor.convert(reading) for reading in items], readings)
+        batch_rate = best_rate(lambda items: [thermistor.convert_all(batch)
+                                              for batch in _batches(items, _thermistor_batch_size)], readings)
+        print "  %-20s %8.2f us/read, batched %8.2f us/read" % (name, 1000000.0 / single_rate,
+                                                                 1000000.0 / batch_rate)
+        results['%s reads/s' % name] = single_rate
+        results['%s batched reads/s' % name] = batch_rate
+    temp_table = replicape_thermistors.temp_table["B57560G104F"]
+    nearest_rate = best_rate(lambda items: [_nearest_sample(temp_table, reading) for reading in items], readings)
+    print "  %-20s %8.2f us/read" % ("nearest sample scan", 1000000.0 / nearest_rate)
+    return results
+
+
+def _serial_moves_for(motor_count, count):
+    moves = []
+    for move in range(count):
+        motors = []
+        for motor in range(motor_count):
+            motors.append({
+                'motor': motor + 1,
+                'target': random.randint(-2000000, 2000000),
+                'type': random.choice(('stop', 'way')),
+                'speed': random.uniform(0, 100000),
+                'acceleration': random.uniform(0, 4000000),
+                'startBow': random.randint(0, 16000000)
+            })
+        moves.append(motors)
+    return moves
+
+
+def benchmark_serial(file_names):
+    print "move commands, line limit at %s baud" % _serial_baud_rate
+    results = {}
+    for motor_count in (1, 2, 4):
+        moves = _serial_moves_for(motor_count, _serial_moves)
+        for name, command_factory in (("ascii", move_command), ("binary", binary_move_command)):
+            encoded_bytes = sum(len(_encode_command(command_factory(motors))) for motors in moves)
+            bytes_per_move = float(encoded_bytes) / len(moves)
+            rate = best_rate(lambda items: [_encode_command(command_factory(motors)) for motors in items], moves)
+            line_rate = _serial_baud_rate / _serial_bits_per_byte / bytes_per_move
+            print "  %s motors %-6s %6.1f bytes/move %8.0f encoded moves/s %6.0f moves/s on the line" % (
+                motor_count, name, bytes_per_move, rate, line_rate)
+            results['%s motors %s encoded moves/s' % (motor_count, name)] = rate
+    return results
+
+
+def captured_reply_stream(count=_reply_stream_commands):
+    # what the arduino says while printing: move acknowledgements with a keep alive ping now and then
+    replies = []
+    queue_length = 0
+    for reply in range(count):
+        if reply % 50 == 0:
+            replies.append("-128,%s,40;\r\n" % queue_length)
+        else:
+            queue_length = (queue_length + random.choice((-1, 0, 1))) % 40
+            replies.append("0,%s,40,1;\r\n" % queue_length)
+    return "".join(replies)
+
+
+class _ReplayedSerial(object):
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.position = 0
+        self.available = 0
+
+    @property
+    def in_waiting(self):
+        if not self.available:
+            self.available = min(self.chunk_size, len(self.data) - self.position)
+        return self.available
+
+    def read(self, size=1):
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        self.available = max(self.available - len(data), 0)
+        return data
+
+
+_end_matcher = re.compile(";")
+
+
+def _byte_by_byte_reader(serial_port):
+    # how the replies were read before: byte by byte & searching the whole buffer after every byte
+    commands = []
+    remaining_buffer = ""
+    while serial_port.position < len(serial_port.data):
+        buff = remaining_buffer + serial_port.read()
+        while serial_port.position < len(serial_port.data) and not _end_matcher.search(buff):
+            buff += serial_port.read()
+        if _end_matcher.search(buff):
+            line, remaining_buffer = buff.split(';', 1)
+            commands.append(MachineCommand(line.strip()))
+    return commands
+
+
+def _chunked_reader(serial_port):
+    commands = []
+    reader = _CommandReader(serial_port)
+    while reader.fill():
+        line = reader.next_line()
+        while line is not None:
+            commands.append(MachineCommand(line.strip()))
+            line = reader.next_line()
+    return commands
+
+
+def benchmark_replies(file_names):
+    stream = captured_reply_stream()
+    command_count = stream.count(";")
+    print "reading %s replies, %s bytes" % (command_count, len(stream))
+    old_rate = best_rate(lambda items: _byte_by_byte_reader(_ReplayedSerial(stream, 1)), range(command_count))
+    print "  byte by byte:               %10.0f replies/s" % old_rate
+    results = {}
+    for chunk_size in _reply_chunk_sizes:
+        rate = best_rate(lambda items: _chunked_reader(_ReplayedSerial(stream, chunk_size)), range(command_count))
+        print "  chunks of up to %4s bytes: %10.0f replies/s (%0.1fx)" % (chunk_size, rate, rate / old_rate)
+        results['chunks of %s replies/s' % chunk_size] = rate
+    return results
+
+
+class _StageTimes(object):
+    """
+    Measures how long the functions of each stage take - by wrapping them until restore is called.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._wrapped = []
+
+    def measure(self, owner, name, stage):
+        # the function as it is defined - not bound to anything
+        original = vars(owner)[name]
+        self.times.setdefault(stage, 0.0)
+        self.calls.setdefault(stage, 0)
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                duration = time.time() - start
+                with self._lock:
+                    self.times[stage] += duration
+                    self.calls[stage] += 1
+
+        setattr(owner, name, timed)
+        self._wrapped.append((owner, name, original))
+
+    def restore(self):
+        for owner, name, original in reversed(self._wrapped):
+            setattr(owner, name, original)
+        self._wrapped = []
+
+
+def _simulated_printer():
+    # the moves are executed right away - so that we see how fast the host is
+    firmware = SimulatedFirmware(time_scale=0)
+    firmware.start()
+    serial_port = SimulatedSerialPort(firmware, timeout=0.1)
+    printer = Printer(serial_port="simulated", reset_pin="P9_12")
+    printer.machine._open_serial = lambda: serial_port
+    printer.connect()
+    with open(_print_config_file) as config_file:
+        printer.configure(json.load(config_file))
+    return firmware, serial_port, printer
+
+
+def _print(lines, printer):
+    printer.start_print()
+    for line in lines:
+        read_gcode_to_printer(line, printer)
+    printer.finish_print()
+
+
+def benchmark_print(file_names):
+    lines = [line for line in read_gcode_files(file_names) if not line.startswith(_temperature_waits)]
+    firmware, serial_port, printer = _simulated_printer()
+    stages = _StageTimes()
+    stages.measure(gcode_interpreter, 'tokenize_gcode_line', 'parsing')
+    for name in ('_extract_movement_values', '_maximum_achievable_speed', '_recalculate_move_speeds'):
+        stages.measure(PrintQueue, name, 'planning')
+    stages.measure(PrintQueue, '_push_from_planning_to_execution', 'waiting for the printer thread')
+    stages.measure(Printer, '_add_movement_calculations', 'move config')
+    stages.measure(Printer, '_generate_move_config', 'move config')
+    stages.measure(Machine, 'move_to', 'sending moves')
+    try:
+        bytes_before = serial_port.bytes_written
+        start = time.time()
+        _print(lines, printer)
+        duration = time.time() - start
+    finally:
+        stages.restore()
+        printer.stop()
+        firmware.stop()
+    moves = firmware.moves_received
+    bytes_per_move = float(serial_port.bytes_written - bytes_before) / max(moves, 1)
+    # kilobytes on linux - for the whole process, which is why the print runs in its own one next to the others
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print "print of %s lines, %s moves against the simulated machine" % (len(lines), moves)
+    print "  %10.0f lines/s %10.0f moves/s %6.1f bytes/move %6.0f moves/s on the line, process peak RSS %0.1f MB" % (
+        len(lines) / duration, moves / duration, bytes_per_move,
+        _serial_baud_rate / _serial_bits_per_byte / bytes_per_move, peak_rss)
+    # the stages of the reading & the printer thread overlap
+    for stage in sorted(stages.times):
+        stage_time = stages.times[stage]
+        print "  %-30s %8.3f s %5.1f%% %8.1f us/call" % (stage, stage_time, stage_time / duration * 100.0,
+                                                       stage_time / max(stages.calls[stage], 1) * 1000000.0)
+    return {
+        'print lines/s': len(lines) / duration,
+        'print moves/s': moves / duration,
+        'print bytes/move': bytes_per_move,
+        'print peak RSS MB': peak_rss
+    }
+
+
+def read_baselines():
+    if not os.path.exists(_baseline_file):
+        return {}
+    with open(_baseline_file) as baseline_input:
+        return json.load(baseline_input)
+
+
+def save_baselines(results):
+    baselines = read_baselines()
+    baselines.update(results)
+    with open(_baseline_file, 'w') as baseline_output:
+        json.dump(baselines, baseline_output, indent=4, sort_keys=True, separators=(',', ': '))
+        baseline_output.write("\n")
+
+
+def regressions(results, baselines, tolerance=_regression_tolerance):
+    """
+    Everything that got worse than the baseline by more than the tolerance - rates (per second) have to stay up,
+    everything else down.
+    """
+    found = []
+    for name, metrics in results.iteritems():
+        for metric, value in metrics.iteritems():
+            baseline = baselines.get(name, {}).get(metric)
+            if baseline is None or value is None:
+                continue
+            if metric.endswith("/s"):
+                worse = value < baseline * (1.0 - tolerance)
+            else:
+                worse = value > baseline * (1.0 + tolerance)
+            if worse:
+                found.append((name, metric, baseline, value))
+    return found
+
+
+def _deep_size(value):
+    # the memory of a value with everything it references - small ints, bools & strings are shared, they do not count
+    if value is None or isinstance(value, (bool, int, long, str)):
+        return 0
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        children = value.values()
+    elif isinstance(value, (tuple, list)):
+        children = value
+    else:
+        children = [getattr(value, slot, None) for slot in getattr(type(value), '__slots__', ())]
+    return size + sum(_deep_size(child) for child in children)
+
+
+def _as_dict(move):
+    # a planned move in the dict of dicts the print queue used before the Move records
+    move_dict = dict((slot, getattr(move, slot)) for slot in Move.__slots__ if slot != 'set_positions')
+    vector = move.relative_move_vector
+    move_dict['relative_move_vector'] = dict((slot, getattr(vector, slot)) for slot in MoveVector.__slots__)
+    for name in ('speed', 'max_achievable_speed_vector'):
+        move_dict[name] = dict(getattr(move, name)._asdict())
+    return move_dict
+
+
+def benchmark_move_memory(file_names):
+    movements = read_movements(file_names)[:_move_memory_queue_length + 1]
+    queue = PrintQueue(axis_config=_planner_axis_config, min_length=_move_memory_queue_length,
+                       max_length=_move_memory_queue_length + 10, default_target_speed=50)
+    for movement in movements:
+        movement = dict(movement)
+        movement['type'] = 'move'
+        queue.add_movement(movement)
+    moves = list(queue.planning_list)
+    record_size = float(sum(_deep_size(move) for move in moves)) / len(moves)
+    dict_size = float(sum(_deep_size(_as_dict(move)) for move in moves)) / len(moves)
+    print "memory of %s planned moves" % len(moves)
+    print "  as dicts:       %6.0f bytes/move" % dict_size
+    print "  as Move record: %6.0f bytes/move (%0.1fx smaller)" % (record_size, dict_size / record_size)
+    return {'Move record bytes/move': record_size}
+
+
+benchmarks = {
+    'gcode': benchmark_gcode_parsing,
+    'job': benchmark_print_job,
+    'moves': benchmark_move_memory,
+    'planner': benchmark_planner,
+    'print': benchmark_print,
+    'replies': benchmark_replies,
+    'serial': benchmark_serial,
+    'thermistors': benchmark_thermistors,
+}
+
+# they measure something for the whole process
+_own_process_benchmarks = ('print',)
+
+
+def run_in_own_process(name, arguments):
+    results_directory = tempfile.mkdtemp()
+    try:
+        results_file = os.path.join(results_directory, 'results.json')
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), name, '--results=' + results_file]
+                              + arguments)
+        with open(results_file) as results_input:
+            return json.load(results_input)[name]
+    finally:
+        shutil.rmtree(results_directory)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    arguments = argv[1:]
+    save_baseline = '--save-baseline' in arguments
+    check = '--check' in arguments
+    results_file = None
+    for argument in arguments:
+        if argument.startswith('--results='):
+            results_file = argument[len('--results='):]
+    arguments = [argument for argument in arguments if argument not in ('--save-baseline', '--check')
+                 and not argument.startswith('--results=')]
+    # the print logs its warnings (e.g. when the arduino ran dry) - the numbers are printed anyway
+    logging.basicConfig(level=logging.WARN, format='%(name)s - %(levelname)s - %(message)s')
+    if arguments and arguments[0] in benchmarks:
+        selected = [arguments[0]]
+        arguments = arguments[1:]
+    else:
+        selected = sorted(benchmarks)
+    results = {}
+    for name in selected:
+        if name in _own_process_benchmarks and len(selected) > 1:
+            results[name] = run_in_own_process(name, arguments)
+        else:
+            results[name] = benchmarks[name](arguments)
+    if results_file:
+        with open(results_file, 'w') as results_output:
+            json.dump(results, results_output)
+    if save_baseline:
+        save_baselines(results)
+        print "baseline saved to %s" % _baseline_file
+    if check:
+        found = regressions(results, read_baselines())
+        for name, metric, baseline, value in found:
+            print "REGRESSION %s %s: %0.1f, baseline %0.1f" % (name, metric, value, baseline)
+        if found:
+            return 1
+        print "no regressions against %s" % _baseline_file
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,16 @@
-from t_bone.gcode_interpreter import decode_gcode_line, decode_text_and_number
+from t_bone.simulated_hardware import install_hardware_shims
+install_hardware_shims()
+from t_bone.gcode_interpreter import decode_gcode_line, decode_text_and_number, read_gcode_to_printer, \
+    GCodePrintThread
+from t_bone.gcode_tokenizer import tokenize_gcode_line, X_WORD, Y_WORD, Z_WORD, E_WORD, F_WORD, S_WORD
+from t_bone.print_job import compile_gcode, current_job
+from t_bone.gcode_index import index_gcode, current_index, MappedGCode
 from hamcrest import *
 
 __author__ = 'marcus'
+import os
+import shutil
+import tempfile
 import unittest
 
 class GCodeTest(unittest.TestCase):
@@ -63,6 +72,207 @@ class GCodeTest(unittest.TestCase):
         assert_that(result[0], equal_to("Y"))
         assert_that(result[0], 4.157)
 
+    def testTokenizer(self):
+        line = "G1 X94.100 \tY84.157  E1.44607 ; move\n"
+        result = tokenize_gcode_line(line)
+        assert_that(result.code, equal_to("G1"))
+        assert_that(result.present, equal_to(X_WORD | Y_WORD | E_WORD))
+        assert_that(result.x, close_to(94.1, 0.00001))
+        assert_that(result.y, close_to(84.157, 0.00001))
+        assert_that(result.e, close_to(1.44607, 0.00001))
+        assert_that(result.positions(), equal_to({'x': result.x, 'y': result.y, 'e': result.e}))
+
+        line = "G1 Z0.300 F7800.000"
+        result = tokenize_gcode_line(line)
+        assert_that(result.present, equal_to(Z_WORD | F_WORD))
+        assert_that(result.positions()['target_speed'], close_to(130.0, 0.00001))
+
+        line = "M104 S200 T0"
+        result = tokenize_gcode_line(line)
+        assert_that(result.code, equal_to("M104"))
+        assert_that(result.present, equal_to(S_WORD))
+        assert_that(result.s, equal_to(200.0))
+
+        line = " ; generated by Slic3r 0.9.10b on 2013-11-13 at 13:21:08"
+        assert_that(tokenize_gcode_line(line), none())
+        assert_that(tokenize_gcode_line("\n"), none())
+
+        line = "G1 Xfoo Y2"
+        result = tokenize_gcode_line(line)
+        assert_that(result.present, equal_to(Y_WORD))
+
+    def testTokenizerMatchesDecoder(self):
+        for line in ("G1 X94.100 Y84.157 E1.44607", "G92 E0", "G28 X0 Y0", "G1 X-1.5 Y-0.25 F1800 ;c"):
+            gcode = decode_gcode_line(line)
+            record = tokenize_gcode_line(line)
+            assert_that(record.code, equal_to(gcode.code))
+            for option in gcode.options:
+                letter, value = decode_text_and_number(option)
+                assert_that(record.positions()[letter.lower()], equal_to(value))
+    def testPrintJobRoundTrip(self):
+        lines = ["G21 ; set units to millimeters\n", "M104 S200\n", "G92 E0\n", "G1 Z0.300 F7800.000\n",
+                 "G1 X94.100 Y84.157 E1.44607\n", "; comment\n", "G1 Z0.500\n", "G1 X-1.5 Y2 E2.5 F1800\n"]
+        directory = tempfile.mkdtemp()
+        try:
+            gcode_file = os.path.join(directory, "test.gcode")
+            with open(gcode_file, 'w') as gcode_output:
+                gcode_output.writelines(lines)
+            assert_that(current_job(gcode_file), none())
+            compile_gcode(gcode_file)
+            job = current_job(gcode_file)
+            assert_that(job, not_none())
+            records = list(job)
+            expected = [tokenize_gcode_line(line) for line in lines if tokenize_gcode_line(line)]
+            assert_that(records, has_length(len(expected)))
+            for record, gcode in zip(records, expected):
+                assert_that(record.code, equal_to(gcode.code))
+                assert_that(record.positions(), equal_to(gcode.positions()))
+            assert_that(job.layers, has_length(2))
+            assert_that(job.layers[1][1], equal_to(0.5))
+            # and it belongs to exactly this version of the g code
+            with open(gcode_file, 'a') as gcode_output:
+                gcode_output.write("G1 X2\n")
+            assert_that(current_job(gcode_file), none())
+        finally:
+            shutil.rmtree(directory)
+
+    def testGCodeIndex(self):
+        lines = ["G21\n", "G92 E0\n", "G1 Z0.300 F7800.000\n", "G1 X94.100 Y84.157 E1.44607\n",
+                 "G1 Z0.500\n", "G1 X10 Y2 E2.5\n", "G1 X11 Y3\n", "G1 Z0.700\n", "G1 X12 Y4 E3.5\n"]
+        directory = tempfile.mkdtemp()
+        try:
+            gcode_file = os.path.join(directory, "test.gcode")
+            with open(gcode_file, 'w') as gcode_output:
+                gcode_output.writelines(lines)
+            assert_that(current_index(gcode_file), none())
+            index_gcode(gcode_file, line_interval=4)
+            index = current_index(gcode_file)
+            assert_that(index, not_none())
+            assert_that(index.line_count, equal_to(len(lines)))
+            assert_that(index.lines, equal_to([(0, 0), (4, len("".join(lines[:4]))), (8, len("".join(lines[:8])))]))
+            assert_that(index.layers, has_length(3))
+            assert_that(index.z_changes[1][2], equal_to(0.5))
+            second_layer = index.layer_offset(2)
+            assert_that(second_layer, equal_to(len("".join(lines[:4]))))
+            assert_that(index.layer_at(0), equal_to(0))
+            assert_that(index.layer_at(second_layer), equal_to(2))
+            mapped_gcode = MappedGCode(gcode_file)
+            try:
+                assert_that(list(mapped_gcode.lines(second_layer)), equal_to(lines[4:]))
+            finally:
+                mapped_gcode.close()
+            # the extruder has to continue where the previous layer has stopped
+            assert_that(index.layer_state(2).e, close_to(1.44607, 0.00001))
+            assert_that(index.layer_state(3).e, equal_to(2.5))
+            assert_that(index.layer_state(3).units, equal_to("G21"))
+            assert_that(index.layer_state(1).e, equal_to(0))
+            assert_that(index.layer_state(1).f, none())
+        finally:
+            shutil.rmtree(directory)
+
+    def testGCodeIndexLayerComments(self):
+        header = ["; generated by Slic3r 1.2.9\n", "; layer_height = 0.2\n", ";LAYER_COUNT:3\n", "G21\n"]
+        layers = ["G1 Z0.300 F7800.000\n", "G1 X94.100 Y84.157 E1.44607\n",
+                  "G1 Z0.500\n", "G1 X10 Y2 E2.5\n", "G1 Z0.700\n", "G1 X12 Y4 E3.5\n"]
+        marked_layers = [";LAYER:0\n"] + layers[:2] + [";LAYER_CHANGE\n"] + layers[2:4] + ["; layer 3, Z = 0.7\n"] + \
+            layers[4:]
+        directory = tempfile.mkdtemp()
+        try:
+            gcode_file = os.path.join(directory, "test.gcode")
+            # the header comments are no layers - without any layer marks every new z is a layer
+            with open(gcode_file, 'w') as gcode_output:
+                gcode_output.writelines(header + layers)
+            index = index_gcode(gcode_file)
+            assert_that(index.layer_comments, equal_to([]))
+            assert_that(index.layers, has_length(3))
+            assert_that(index.layer_offset(1), equal_to(len("".join(header))))
+            # with layer marks the marks are the layers
+            with open(gcode_file, 'w') as gcode_output:
+                gcode_output.writelines(header + marked_layers)
+            index = index_gcode(gcode_file)
+            assert_that(index.layers, equal_to([(4, len("".join(header))),
+                                                (7, len("".join(header + marked_layers[:3]))),
+                                                (10, len("".join(header + marked_layers[:6])))]))
+        finally:
+            shutil.rmtree(directory)
+
+    def testResumeRestoresThePreamble(self):
+        lines = ["M140 S60\n", "M104 S200\n", "G28\n", "M190 S60\n", "M109 S200\n", "G21\n", "G90\n", "M82\n",
+                 "G92 E0\n", "G1 Z0.300 F7800.000\n", "G1 X94.100 Y84.157 E1.44607 F1800\n",
+                 "G1 Z0.500\n", "G1 X10 Y2 E2.5\n"]
+        directory = tempfile.mkdtemp()
+        try:
+            gcode_file = os.path.join(directory, "test.gcode")
+            with open(gcode_file, 'w') as gcode_output:
+                gcode_output.writelines(lines)
+            printer = _RecordingPrinter()
+            GCodePrintThread(gcode_file, printer, None, start_layer=2).run()
+            calls = printer.calls
+            # heated up, homed & back where the first layer has ended
+            assert_that(calls[:7], equal_to([('bed', 'set', 60), ('extruder', 'set', 200),
+                                             ('bed', 'set', 60), ('bed', 'wait', 60),
+                                             ('extruder', 'set', 200), ('extruder', 'wait', 200),
+                                             ('home', ['x', 'y', 'z'])]))
+            assert_that(calls[7], equal_to(('set_position', {'e': 1.44607, 'target_speed': 30.0})))
+            assert_that(calls[8], equal_to(('move_to', {'z': 0.3, 'target_speed': 30.0})))
+            assert_that(calls[9], equal_to(('move_to', {'x': 94.1, 'y': 84.157, 'target_speed': 30.0})))
+            # and only then the layer itself
+            assert_that(calls[10:], equal_to([('move_to', {'z': 0.5}), ('move_to', {'x': 10, 'y': 2, 'e': 2.5})]))
+        finally:
+            shutil.rmtree(directory)
+
+
+    def testSwitchingOffHeatersDoesNotWait(self):
+        printer = _RecordingPrinter()
+        read_gcode_to_printer("M109 S0", printer)
+        read_gcode_to_printer("M190 S0", printer)
+        assert_that(printer.calls, equal_to([('extruder', 'set', 0), ('bed', 'set', 0)]))
+
+class _RecordingHeater(object):
+    max_temperature = 300
+
+    def __init__(self, name, calls):
+        self.name = name
+        self.calls = calls
+        self.set_temperature_value = 0
+
+    def set_temperature(self, temperature):
+        self.calls.append((self.name, 'set', temperature))
+        self.set_temperature_value = temperature
+
+    def get_set_temperature(self):
+        return self.set_temperature_value
+
+    def wait_for_temperature(self, temperature, timeout=None):
+        self.calls.append((self.name, 'wait', temperature))
+        return True
+
+
+class _RecordingPrinter(object):
+    def __init__(self):
+        self.calls = []
+        self.homed = False
+        self.axis = {'x': {'homeable': True}, 'y': {'homeable': True}, 'z': {'homeable': True},
+                     'e': {'homeable': False}}
+        self.extruder_heater = _RecordingHeater('extruder', self.calls)
+        self.heated_bed = _RecordingHeater('bed', self.calls)
+
+    def start_print(self):
+        pass
+
+    def finish_print(self):
+        pass
+
+    def home(self, axis):
+        self.calls.append(('home', sorted(axis)))
+
+    def set_position(self, positions):
+        self.calls.append(('set_position', positions))
+
+    def move_to(self, position):
+        self.calls.append(('move_to', position))
+
+
 def suite():
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
@@ -0,0 +1,131 @@
+from threading import Timer
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to, less_than, close_to, calling, raises
+from t_bone.simulated_hardware import install_hardware_shims
+install_hardware_shims()
+from t_bone.heater import Heater, HeaterError
+from t_bone import ramps_thermistors, replicape_thermistors
+from t_bone.thermistors import get_thermistor, get_thermistor_reading, get_thermistor_readings
+
+__author__ = 'marcus'
+
+
+class FakeThermometer(object):
+    def __init__(self, temperature=20.0):
+        self.temperature = temperature
+
+    def read(self):
+        return self.temperature
+
+
+class FakeHeater(Heater):
+    def update_heater(self):
+        pass
+
+
+class HeaterTests(unittest.TestCase):
+    def setUp(self):
+        self.thermometer = FakeThermometer()
+        self.heater = FakeHeater(thermometer=self.thermometer, output=None)
+        self.heater.readout_delay = 0.01
+
+    def tearDown(self):
+        self.heater.stop()
+        self.heater.join()
+
+    def test_wait_for_reached_temperature(self):
+        self.thermometer.temperature = 200.0
+        assert_that(self.heater.wait_for_temperature(201.0, tolerance=2.0, timeout=1.0, settle_time=0.05),
+                    equal_to(True))
+
+    def test_wait_for_temperature_timeout(self):
+        start = time.time()
+        assert_that(self.heater.wait_for_temperature(200.0, tolerance=2.0, timeout=0.1, settle_time=0.0),
+                    equal_to(False))
+        assert_that(time.time() - start, less_than(1.0))
+
+    def test_wait_for_temperature_needs_to_settle(self):
+        self.thermometer.temperature = 200.0
+        # the temperature overshoots before the settle time is over
+        overshoot = Timer(0.05, setattr, (self.thermometer, 'temperature', 210.0))
+        overshoot.start()
+        try:
+            assert_that(self.heater.wait_for_temperature(200.0, tolerance=2.0, timeout=0.3, settle_time=0.2),
+                        equal_to(False))
+        finally:
+            overshoot.join()
+
+    def test_wait_for_set_temperature(self):
+        self.heater.set_temperature(100.0)
+        heating = Timer(0.05, setattr, (self.thermometer, 'temperature', 99.0))
+        heating.start()
+        try:
+            assert_that(self.heater.wait_for_temperature(timeout=1.0, settle_time=0.05), equal_to(True))
+        finally:
+            heating.join()
+
+
+    def test_wait_for_lower_temperature(self):
+        self.thermometer.temperature = 200.0
+        cooling = Timer(0.05, setattr, (self.thermometer, 'temperature', 101.0))
+        cooling.start()
+        try:
+            start = time.time()
+            # cooling down is done once it is there - it does not overshoot
+            assert_that(self.heater.wait_for_temperature(100.0, tolerance=2.0, timeout=1.0, settle_time=10.0),
+                        equal_to(True))
+            assert_that(time.time() - start, less_than(1.0))
+        finally:
+            cooling.join()
+
+    def test_wait_for_temperature_of_stopped_heater(self):
+        self.heater.stop()
+        self.heater.join()
+        assert_that(calling(self.heater.wait_for_temperature).with_args(200.0, timeout=1.0),
+                    raises(HeaterError))
+
+class ThermistorTests(unittest.TestCase):
+    def test_table_values(self):
+        for adc_value, temperature in ramps_thermistors.thermistor_10k.iteritems():
+            assert_that(get_thermistor_reading("10k", adc_value / 1024.0), close_to(temperature, 0.001))
+
+    def test_interpolation(self):
+        # between 1: 430 and 54: 137
+        assert_that(get_thermistor_reading("10k", 27.5 / 1024.0), close_to(283.5, 0.001))
+        # outside of the table we get the last value
+        assert_that(get_thermistor_reading("10k", 0.0), close_to(430, 0.001))
+        assert_that(get_thermistor_reading("100k", 1.0), close_to(0, 0.001))
+
+    def test_batch_conversion(self):
+        values = [index / 100.0 for index in range(101)]
+        temperatures = get_thermistor_readings("epcos-100k", values)
+        assert_that(len(temperatures), equal_to(len(values)))
+        for value, temperature in zip(values, temperatures):
+            assert_that(temperature, close_to(get_thermistor_reading("epcos-100k", value), 0.001))
+
+    def test_replicape_interpolation(self):
+        temperatures, resistances = replicape_thermistors.temp_table["B57560G104F"]
+        for index in (10, 100, 200):
+            # the reading for the resistance of the chart entry
+            reading = resistances[index] / (resistances[index] + 4700.0)
+            assert_that(get_thermistor_reading("B57560G104F", reading), close_to(temperatures[index], 0.001))
+        # half way between two entries
+        resistance = (resistances[100] + resistances[101]) / 2.0
+        reading = resistance / (resistance + 4700.0)
+        assert_that(get_thermistor_reading("B57560G104F", reading),
+                    close_to((temperatures[100] + temperatures[101]) / 2.0, 0.001))
+
+    def test_replicape_batch_conversion(self):
+        values = [index / 100.0 for index in range(101)]
+        temperatures = get_thermistor_readings("B57560G104F", values)
+        for value, temperature in zip(values, temperatures):
+            assert_that(temperature, close_to(get_thermistor_reading("B57560G104F", value), 0.001))
+
+    def test_unknown_thermistor(self):
+        assert_that(calling(get_thermistor).with_args("no-such-thermistor"), raises(Exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
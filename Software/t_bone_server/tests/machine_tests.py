@@ -0,0 +1,483 @@
+from threading import Condition, Timer
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to, has_length, calling, raises, less_than
+from t_bone.simulated_hardware import install_hardware_shims
+install_hardware_shims()
+from t_bone.machine import Machine, MachineCommand, MachineError, _MachineConnection, _CommandReader, move_command, \
+    binary_move_command, decode_binary_arguments, decode_binary_move, _encode_command
+
+__author__ = 'marcus'
+
+
+class FakeArduino(object):
+    """
+    Stands in for the serial port: answers every command like the arduino does and sends keep alive pings.
+    """
+
+    def __init__(self, queue_length=40, keep_alive_interval=0.05, binary_moves=True):
+        self.queue_length = queue_length
+        self.binary_moves = binary_moves
+        self.keep_alive_interval = keep_alive_interval
+        # a silent arduino does not say anything - e.g. it hangs or is still booting
+        self.silent = False
+        self.moves_per_keep_alive = 2
+        self.status_all = True
+        # motors left out of the status of all motors
+        self.unreported_motors = ()
+        # the baud rate of the serial port & of the arduino - if they differ only garbage is read
+        self.baudrate = 38400
+        self.line_baud_rate = 38400
+        self.working_baud_rates = (38400, 115200)
+        self.baud_rate_confirmation_time = 0.2
+        self._baud_rate_deadline = None
+        self._switch_to_baud_rate = None
+        # what was sent before the switch is still sent with the old baud rate
+        self._old_baud_rate_output = 0
+        self.commands_in_queue = 0
+        self.received = []
+        self.hold_replies = False
+        self._held_replies = []
+        self._input = ""
+        self._output = ""
+        self._output_condition = Condition()
+        self._send("-128,0,%s;\r\n" % self.queue_length)
+
+    def _send(self, data):
+        with self._output_condition:
+            self._output += data
+            self._output_condition.notify_all()
+
+    def reply_to(self, command):
+        if command.command_number == 9:
+            if self.binary_moves and command.arguments == ['1']:
+                return "0,1;\r\n"
+            return "0,0;\r\n"
+        elif command.command_number == 14:
+            if not self.binary_moves:
+                return "-9,U,14;\r\n"
+            command.arguments = decode_binary_move(decode_binary_arguments(command.arguments[0]))
+            self.commands_in_queue += len(command.arguments) / 6
+            return "0,%s,%s,1;\r\n" % (self.commands_in_queue, self.queue_length)
+        elif command.command_number == 10:
+            self.commands_in_queue += len(command.arguments) / 6
+            return "0,%s,%s,1;\r\n" % (self.commands_in_queue, self.queue_length)
+        elif command.command_number == 30:
+            # the position is the motor number - so we can tell the replies apart
+            return "30,%s;\r\n" % command.arguments[0]
+        elif command.command_number == 15:
+            baud_rate = int(command.arguments[0])
+            if baud_rate == 0:
+                self._baud_rate_deadline = None
+            else:
+                # the line is switched after the reply is out
+                self._switch_to_baud_rate = baud_rate
+            return "0,%s;\r\n" % baud_rate
+        elif command.command_number == 32:
+            # status register, position, left & right end stop, encoder - the position is 100 * the motor number
+            motor = int(command.arguments[0])
+            return "32,0,%s,1,-1,%s;\r\n" % (motor * 100, motor * 10)
+        elif command.command_number == 33:
+            if not self.status_all:
+                return "-9,U,33;\r\n"
+            motors = [int(argument) for argument in command.arguments or []] or [1, 2, 3, 4, 5]
+            motors = [motor for motor in motors if motor not in self.unreported_motors]
+            return "33,%s;\r\n" % ",".join("%s,%s,%s,1,-1" % (motor, motor * 100, motor * 10) for motor in motors)
+        elif command.command_number == 31:
+            # some moves have been executed since
+            self.commands_in_queue = max(self.commands_in_queue - 2, 0)
+            return "0,%s,%s;\r\n" % (self.commands_in_queue, self.queue_length)
+        return "0,0;\r\n"
+
+    def release(self):
+        self.hold_replies = False
+        for reply in self._held_replies:
+            self._send(reply)
+        self._held_replies = []
+
+    def write(self, data):
+        self._input += data
+        for line in self._split_commands():
+            command = _parse_command(line)
+            self.received.append(command)
+            reply = self.reply_to(command)
+            if self.hold_replies:
+                self._held_replies.append(reply)
+            else:
+                self._send(reply)
+            if self._switch_to_baud_rate:
+                self._old_baud_rate_output = len(self._output)
+                if self._switch_to_baud_rate in self.working_baud_rates:
+                    self.line_baud_rate = self._switch_to_baud_rate
+                else:
+                    # noone will understand a thing
+                    self.line_baud_rate = None
+                self._baud_rate_deadline = time.time() + self.baud_rate_confirmation_time
+                self._switch_to_baud_rate = None
+
+    def _split_commands(self):
+        # like CmdMessenger: separators escaped with '/' are part of the argument
+        commands = []
+        start = 0
+        escaped = False
+        for index, character in enumerate(self._input):
+            if escaped:
+                escaped = False
+            elif character == '/':
+                escaped = True
+            elif character == ';':
+                commands.append(self._input[start:index])
+                start = index + 1
+        self._input = self._input[start:]
+        return commands
+
+    @property
+    def in_waiting(self):
+        if self.silent or self.baudrate != self.line_baud_rate:
+            return 0
+        return len(self._output)
+
+    def read(self, size=1):
+        if self._baud_rate_deadline and time.time() > self._baud_rate_deadline:
+            # not confirmed - back to the default
+            self.line_baud_rate = 38400
+            self._baud_rate_deadline = None
+        if self._old_baud_rate_output:
+            with self._output_condition:
+                data = self._output[:min(size, self._old_baud_rate_output)]
+                self._output = self._output[len(data):]
+                self._old_baud_rate_output -= len(data)
+            return data
+        if self.baudrate != self.line_baud_rate:
+            with self._output_condition:
+                self._output_condition.wait(self.keep_alive_interval)
+                self._output = ""
+            return "\xf0"
+        with self._output_condition:
+            if not self._output:
+                self._output_condition.wait(self.keep_alive_interval)
+            if self.silent:
+                return ""
+            if not self._output:
+                # some moves have been executed since
+                self.commands_in_queue = max(self.commands_in_queue - self.moves_per_keep_alive, 0)
+                self._output = "-128,%s,%s;\r\n" % (self.commands_in_queue, self.queue_length)
+            data = self._output[:size]
+            self._output = self._output[size:]
+        return data
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        with self._output_condition:
+            self._output = ""
+            self._old_baud_rate_output = 0
+
+    def close(self):
+        pass
+
+
+def _parse_command(line):
+    command = MachineCommand()
+    arguments = []
+    argument = ""
+    escaped = False
+    for character in line.strip():
+        if escaped:
+            argument += '/' + character
+            escaped = False
+        elif character == '/':
+            escaped = True
+        elif character == ',':
+            arguments.append(argument)
+            argument = ""
+        else:
+            argument += character
+    arguments.append(argument)
+    command.command_number = int(arguments[0])
+    if len(arguments) > 1:
+        command.arguments = arguments[1:]
+    return command
+
+
+def _move(motor, target):
+    return {
+        'motor': motor,
+        'target': target,
+        'type': 'way',
+        'speed': 100.0,
+        'acceleration': 1000.0,
+        'startBow': 10000
+    }
+
+
+class MachineConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.arduino = FakeArduino()
+        self.connection = _MachineConnection(self.arduino)
+
+    def tearDown(self):
+        self.connection.stop()
+
+    def test_replies_are_matched_in_order(self):
+        self.connection.pipeline_depth = 3
+        pending_commands = []
+        for motor in range(3):
+            command = MachineCommand()
+            command.command_number = 30
+            command.arguments = [motor]
+            pending_commands.append(self.connection.queue_command(command))
+        for motor, pending_command in enumerate(pending_commands):
+            reply = self.connection.wait_for_reply(pending_command, 1)
+            assert_that(reply.command_number, equal_to(30))
+            assert_that(reply.arguments, equal_to([str(motor)]))
+
+    def test_pipeline_depth_is_limited(self):
+        self.connection.pipeline_depth = 2
+        self.arduino.hold_replies = True
+        command = MachineCommand()
+        command.command_number = 31
+        self.connection.queue_command(command, 1)
+        self.connection.queue_command(command, 1)
+        # queueing does not block - the command just is not sent
+        pending_command = self.connection.queue_command(command, 0.1)
+        assert_that(calling(self.connection.wait_for_reply).with_args(pending_command, 1), raises(MachineError))
+        assert_that(self.arduino.received, has_length(2))
+
+
+class ChunkedSerial(object):
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    @property
+    def in_waiting(self):
+        if self.chunks:
+            return len(self.chunks[0])
+        return 0
+
+    def read(self, size=1):
+        if not self.chunks:
+            return ""
+        data = self.chunks[0][:size]
+        self.chunks[0] = self.chunks[0][size:]
+        if not self.chunks[0]:
+            self.chunks.pop(0)
+        return data
+
+
+class CommandReaderTests(unittest.TestCase):
+    def test_commands_are_split_across_chunks(self):
+        reader = _CommandReader(ChunkedSerial(["-128,0,", "40;\r\n0,1,40,1;\r\n30,", "-17;"]))
+        lines = []
+        while reader.fill():
+            line = reader.next_line()
+            while line is not None:
+                lines.append(line.strip())
+                line = reader.next_line()
+        assert_that(lines, equal_to(["-128,0,40", "0,1,40,1", "30,-17"]))
+        assert_that(MachineCommand(lines[2]).arguments, equal_to(["-17"]))
+
+    def test_incomplete_command_is_kept(self):
+        reader = _CommandReader(ChunkedSerial(["0,1"]))
+        reader.fill()
+        assert_that(reader.next_line(), equal_to(None))
+        reader.machine_serial.chunks.append(",2;")
+        reader.fill()
+        assert_that(reader.next_line(), equal_to("0,1,2"))
+
+
+class BinaryMoveTests(unittest.TestCase):
+    def test_binary_move_round_trip(self):
+        motors = [_move(1, 1234567), _move(2, -7), _move(3, 0)]
+        motors[1]['type'] = 'stop'
+        # escape characters, separators & zeros in the values
+        motors[2]['target'] = 0x2C3B2F00
+        ascii_command = move_command(motors)
+        binary_command = binary_move_command(motors)
+        encoded = _encode_command(binary_command)
+        assert_that(encoded.startswith("14,"), equal_to(True))
+        assert_that("\x00" in encoded, equal_to(False))
+        received = _parse_command(encoded[:-2])
+        assert_that(received.arguments, has_length(1))
+        decoded = decode_binary_move(decode_binary_arguments(received.arguments[0]))
+        assert_that(decoded, equal_to(ascii_command.arguments))
+
+    def test_broken_frame_is_detected(self):
+        encoded = _encode_command(binary_move_command([_move(1, 1)]))[3:-2]
+        broken = encoded[:5] + chr(ord(encoded[5]) ^ 0x01) + encoded[6:]
+        assert_that(calling(decode_binary_arguments).with_args(broken), raises(MachineError))
+
+
+class MachineTests(unittest.TestCase):
+    def setUp(self):
+        self.arduino = FakeArduino(queue_length=10)
+        self.machine = Machine(serial_port="none", reset_pin="X")
+        self.machine.machine_connection = _MachineConnection(self.arduino)
+
+    def tearDown(self):
+        self.machine.disconnect()
+
+    def test_batch_moves_respect_the_buffer(self):
+        self.machine.machine_connection.pipeline_depth = 4
+        self.machine.start_motion()
+        for target in range(8):
+            self.machine.move_to([_move(1, target)])
+            assert_that(self.machine._command_buffer_free() >= 0, equal_to(True))
+        self.machine.finish_motion()
+        moves = [command for command in self.arduino.received if command.command_number == 10]
+        assert_that(moves, has_length(8))
+        # the keep alive pings tell us when there is space again
+        assert_that([command for command in self.arduino.received if command.command_number == 31], has_length(0))
+
+    def test_moves_before_the_first_reply_respect_the_buffer(self):
+        self.machine.machine_connection.pipeline_depth = 10
+        self.machine.start_motion()
+        self.arduino.hold_replies = True
+        moves_before_the_first_reply = []
+
+        def release():
+            moves_before_the_first_reply.append(
+                len([command for command in self.arduino.received if command.command_number == 10]))
+            self.arduino.release()
+
+        Timer(0.2, release).start()
+        for target in range(8):
+            self.machine.move_to([_move(1, target)])
+        self.machine.finish_motion()
+        # without any reply we only know the buffer from the keep alive ping - and keep 5 of 10 free
+        assert_that(moves_before_the_first_reply[0], less_than(6))
+
+    def test_lost_connection_while_waiting_for_the_buffer(self):
+        self.arduino.moves_per_keep_alive = 0
+        self.machine.start_motion()
+        self.machine.command_queue_running = True
+        self.machine.command_buffer_length = self.machine.command_max_buffer_length
+        self.machine.machine_connection.run_on = False
+        assert_that(calling(self.machine._wait_for_free_command_buffer), raises(MachineError))
+
+    def test_binary_moves_are_negotiated(self):
+        for binary_moves in (True, False):
+            self.arduino.binary_moves = binary_moves
+            self.machine.machine_connection.pipeline_depth = 1
+            self.machine._init_machine()
+            self.machine.move_to([_move(1, 1)])
+            assert_that(self.arduino.received[-1].command_number, equal_to(14 if binary_moves else 10))
+            assert_that(self.arduino.received[-1].arguments[:2], equal_to([1, 1] if binary_moves else ['1', '1']))
+
+    def test_baud_rate_is_negotiated(self):
+        assert_that(self.machine.set_baud_rate(115200), equal_to(True))
+        assert_that(self.arduino.baudrate, equal_to(115200))
+        assert_that([command.arguments for command in self.arduino.received if command.command_number == 15],
+                    equal_to([['115200'], ['0']]))
+        # and we can still talk
+        assert_that(self.machine.read_positon(3), equal_to(3))
+
+    def test_unusable_baud_rate_falls_back(self):
+        assert_that(self.machine.set_baud_rate(250000), equal_to(False))
+        assert_that(self.arduino.baudrate, equal_to(38400))
+        assert_that(self.machine.read_positon(3), equal_to(3))
+
+    def test_link_throughput(self):
+        self.machine.machine_connection.pipeline_depth = 4
+        result = self.machine.measure_link_throughput(20)
+        assert_that(result['commands-per-second'] > 0, equal_to(True))
+        assert_that([command for command in self.arduino.received if command.command_number == 31], has_length(20))
+
+    def test_async_status_reads(self):
+        self.machine.machine_connection.pipeline_depth = 4
+        self.arduino.hold_replies = True
+        futures = [self.machine.read_positon_async(motor) for motor in range(1, 4)]
+        # nothing has been answered but nobody had to wait
+        assert_that([future.done() for future in futures], equal_to([False] * 3))
+        self.arduino.release()
+        assert_that([future.result(1) for future in futures], equal_to([1, 2, 3]))
+
+    def test_axis_status(self):
+        assert_that(self.machine.read_axis_status(2), equal_to(
+            {'position': 200, 'encoder_pos': 20, 'left_endstop': True, 'right_endstop': False}))
+
+    def test_all_axes_status_at_once(self):
+        status = self.machine.read_axes_status([1, 3])
+        assert_that(status, equal_to({
+            1: {'position': 100, 'encoder_pos': 10, 'left_endstop': True, 'right_endstop': False},
+            3: {'position': 300, 'encoder_pos': 30, 'left_endstop': True, 'right_endstop': False}
+        }))
+        assert_that([command.command_number for command in self.arduino.received], equal_to([33]))
+
+    def test_axes_status_of_older_firmwares(self):
+        self.arduino.status_all = False
+        for repetition in range(2):
+            status = self.machine.read_axes_status([1, 3])
+            assert_that(status, equal_to(dict((motor, self.machine.read_axis_status(motor)) for motor in (1, 3))))
+        # it is only tried once
+        assert_that([command.command_number for command in self.arduino.received].count(33), equal_to(1))
+
+    def test_axes_status_of_unreported_motors(self):
+        self.arduino.unreported_motors = (3,)
+        status = self.machine.read_axes_status([1, 3])
+        assert_that(status, equal_to({
+            1: {'position': 100, 'encoder_pos': 10, 'left_endstop': True, 'right_endstop': False},
+            3: {'position': 300, 'encoder_pos': 30, 'left_endstop': True, 'right_endstop': False}
+        }))
+        assert_that([command.command_number for command in self.arduino.received], equal_to([33, 32]))
+        # the status of all motors still gets used
+        self.machine.read_axes_status([1])
+        assert_that([command.command_number for command in self.arduino.received], equal_to([33, 32, 33]))
+
+    def test_async_move(self):
+        future = self.machine.move_to_async([_move(1, 1)])
+        assert_that(future.result(1).command_number, equal_to(0))
+        self.arduino.reply_to = lambda command: "-9,-100;\r\n"
+        future = self.machine.move_to_async([_move(1, 1)])
+        assert_that(calling(future.result).with_args(1), raises(MachineError))
+
+    def test_failed_move_is_reported(self):
+        self.arduino.reply_to = lambda command: "-9,-100;\r\n"
+        self.machine.batch_mode = True
+
+        def move_and_finish():
+            self.machine.move_to([_move(1, 1)])
+            self.machine.finish_motion()
+
+        assert_that(calling(move_and_finish), raises(MachineError))
+
+
+class ConnectTests(unittest.TestCase):
+    def setUp(self):
+        self.arduino = FakeArduino()
+        self.machine = Machine(serial_port="none", reset_pin="X")
+        self.machine._open_serial = lambda: self.arduino
+        self.resets = 0
+
+    def tearDown(self):
+        self.machine.disconnect()
+
+    def _reset_machine(self):
+        self.resets += 1
+        self.arduino.silent = False
+
+    def test_soft_connect(self):
+        self.machine._reset_machine = self._reset_machine
+        start = time.time()
+        self.machine.connect()
+        assert_that(time.time() - start < 1, equal_to(True))
+        assert_that(self.resets, equal_to(0))
+        assert_that(self.arduino.received[0].command_number, equal_to(9))
+
+    def test_silent_machine_is_reset(self):
+        self.machine._reset_machine = self._reset_machine
+        self.arduino.silent = True
+        self.machine.connect()
+        assert_that(self.resets, equal_to(1))
+        assert_that(self.arduino.received[-1].command_number, equal_to(9))
+
+    def test_hard_connect(self):
+        self.machine._reset_machine = self._reset_machine
+        self.machine.connect(soft_connect=False)
+        assert_that(self.resets, equal_to(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to, greater_than, close_to, has_key
+from t_bone.simulated_hardware import install_hardware_shims
+install_hardware_shims()
+from t_bone.simulation import SimulatedFirmware, SimulatedSerialPort
+from t_bone.machine import Machine
+from t_bone.metrics import Metrics, Histogram, metrics
+
+__author__ = 'marcus'
+
+
+class HistogramTests(unittest.TestCase):
+    def test_buckets(self):
+        histogram = Histogram((1.0, 2.0, 4.0))
+        for value in (0.5, 1.0, 1.5, 3.0, 3.5, 10.0):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        assert_that(snapshot['count'], equal_to(6))
+        assert_that(snapshot['sum'], close_to(19.5, 0.001))
+        assert_that(snapshot['min'], equal_to(0.5))
+        assert_that(snapshot['max'], equal_to(10.0))
+        assert_that(snapshot['buckets'], equal_to([(1.0, 2), (2.0, 1), (4.0, 2), (None, 1)]))
+
+    def test_percentiles(self):
+        histogram = Histogram((1.0, 2.0, 4.0))
+        assert_that(histogram.percentile(50), equal_to(None))
+        for value in range(100):
+            histogram.observe(0.5)
+        histogram.observe(3.0)
+        # it is just known to be in the first bucket
+        assert_that(histogram.percentile(50), equal_to(1.0))
+        assert_that(histogram.percentile(100), equal_to(3.0))
+        histogram.observe(100.0)
+        assert_that(histogram.percentile(100), equal_to(100.0))
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics(sample_interval=10)
+
+    def test_instruments_are_created_once(self):
+        counter = self.metrics.counter('moves')
+        counter.increment()
+        counter.increment(2)
+        assert_that(self.metrics.counter('moves').value, equal_to(3))
+        assert_that(self.metrics.histogram('time'), equal_to(self.metrics.histogram('time')))
+        assert_that(self.metrics.snapshot()['counters'], equal_to({'moves': 3}))
+
+    def test_gauges_are_sampled(self):
+        queue_length = self.metrics.gauge('queue')
+        buffer_length = self.metrics.gauge('buffer')
+        queue_length.set(5)
+        buffer_length.set(7)
+        # too early for the next sample
+        queue_length.set(6)
+        self.metrics.sample_gauges(time.time() + 11)
+        samples = self.metrics.snapshot()['samples']
+        assert_that(len(samples), equal_to(2))
+        assert_that(samples[0]['gauges'], equal_to({'queue': 5, 'buffer': 0}))
+        assert_that(samples[1]['gauges'], equal_to({'queue': 6, 'buffer': 7}))
+
+    def test_reset(self):
+        self.metrics.counter('moves').increment()
+        self.metrics.histogram('time').observe(0.1)
+        self.metrics.gauge('queue').set(3)
+        self.metrics.reset()
+        snapshot = self.metrics.snapshot()
+        assert_that(snapshot['counters'], equal_to({'moves': 0}))
+        assert_that(snapshot['histograms']['time']['count'], equal_to(0))
+        assert_that(snapshot['gauges'], equal_to({'queue': 0}))
+        assert_that(snapshot['samples'], equal_to([]))
+
+
+class MachineMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.firmware = SimulatedFirmware(time_scale=0)
+        self.firmware.start()
+        self.machine = Machine(serial_port="simulated", reset_pin="P9_12")
+        self.machine._open_serial = lambda: SimulatedSerialPort(self.firmware, timeout=0.1)
+        self.machine.connect()
+        metrics.reset()
+        self.bytes_received = self.firmware.bytes_received
+
+    def tearDown(self):
+        metrics.enabled = True
+        self.machine.disconnect()
+        self.firmware.stop()
+
+    def _print(self, move_count):
+        self.machine.start_motion()
+        for move in range(move_count):
+            self.machine.move_to([{'motor': 1, 'target': move * 100, 'type': 'way', 'speed': 1000.0,
+                                   'acceleration': 1000.0, 'startBow': 10000}])
+        self.machine.finish_motion()
+
+    def test_serial_metrics(self):
+        self._print(20)
+        snapshot = metrics.snapshot()
+        # the start & the end of the motion too
+        assert_that(snapshot['counters']['serial_commands_sent'], equal_to(22))
+        assert_that(snapshot['counters']['serial_bytes_sent'],
+                    equal_to(self.firmware.bytes_received - self.bytes_received))
+        assert_that(snapshot['histograms']['serial_round_trip_seconds']['count'], equal_to(22))
+        assert_that(snapshot['histograms']['machine_command_buffer_wait_seconds']['count'], equal_to(20))
+        assert_that(snapshot['histograms']['arduino_buffer_fill']['count'], greater_than(19))
+        assert_that(snapshot['gauges'], has_key('arduino_queue_length'))
+
+    def test_metrics_switched_on_while_waiting_for_the_buffer(self):
+        metrics.enabled = False
+        command_buffer_free = self.machine._command_buffer_free
+
+        def switch_on():
+            # like Printer.configure from another thread
+            metrics.enabled = True
+            return command_buffer_free()
+
+        self.machine._command_buffer_free = switch_on
+        self._print(1)
+        # the move which started unmeasured stays unmeasured
+        assert_that(metrics.snapshot()['histograms']['machine_command_buffer_wait_seconds']['count'], equal_to(0))
+
+    def test_disabled_metrics(self):
+        metrics.enabled = False
+        self._print(20)
+        snapshot = metrics.snapshot()
+        assert_that(snapshot['counters']['serial_commands_sent'], equal_to(0))
+        assert_that(snapshot['histograms']['serial_round_trip_seconds']['count'], equal_to(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,10 @@ import unittest
 
 from hamcrest import assert_that, not_none, equal_to, close_to, less_than_or_equal_to, greater_than, less_than, \
     has_length, none
-from t_bone.printer import calculate_relative_vector, find_shortest_vector, PrintQueue, Printer, get_target_velocity, \
-    calculate_ideal_s_curve_acceleration
+from t_bone.simulated_hardware import install_hardware_shims
+install_hardware_shims()
+from t_bone.helpers import calculate_relative_vector, find_shortest_vector
+from t_bone.printer import PrintQueue, Printer, get_target_velocity, calculate_ideal_s_curve_acceleration
 
 
 class VectorTests(unittest.TestCase):
@@ -102,6 +104,7 @@ class VectorTests(unittest.TestCase):
                 while self.running:
                     self.queue.next_movement()
                     # and throw away
+                    self.queue.movement_done()
 
         emptyerThread = QueueEmptyThread(queue=queue, )
         emptyerThread.start()
@@ -115,7 +118,7 @@ class VectorTests(unittest.TestCase):
                     'f': 1
                 }
                 queue.add_movement(position, timeout=default_timeout)
-            queue.finish(timeout=default_timeout)
+            assert_that(queue.finish(timeout=default_timeout), equal_to(True))
             assert_that(queue.queue.empty(), equal_to(True))
             assert_that(queue.planning_list, has_length(0))
         finally:
@@ -129,6 +132,83 @@ class VectorTests(unittest.TestCase):
             queue.finish(timeout=default_timeout)
             emptyerThread.join()
 
+    def test_print_queue_finish_timeout(self):
+        axis_config = {
+            'x': {
+                'max_acceleration': 1,
+                'max_speed': 1,
+                'bow': 1,
+                'steps_per_mm': 1
+            },
+            'y': {
+                'max_acceleration': 1,
+                'max_speed': 1,
+                'bow': 1,
+                'steps_per_mm': 1
+            },
+            'z': {
+                'steps_per_mm': 1
+            },
+            'e': {
+                'steps_per_mm': 1
+            }
+        }
+        queue = PrintQueue(axis_config=axis_config, min_length=2, max_length=5)
+        queue.default_target_speed = 1
+        for i in range(2):
+            queue.add_movement({
+                'type': 'move',
+                'x': i,
+                'y': i
+            })
+        # nobody executes the movements
+        assert_that(queue.finish(timeout=0.1), equal_to(False))
+        assert_that(queue.planning_list, has_length(0))
+        for i in range(2):
+            queue.next_movement(timeout=0.1)
+            queue.movement_done()
+        assert_that(queue.finish(timeout=0.1), equal_to(True))
+
+    def test_print_queue_finish_with_full_queue(self):
+        axis_config = {
+            'x': {
+                'max_acceleration': 1,
+                'max_speed': 1,
+                'bow': 1,
+                'steps_per_mm': 1
+            },
+            'y': {
+                'max_acceleration': 1,
+                'max_speed': 1,
+                'bow': 1,
+                'steps_per_mm': 1
+            },
+            'z': {
+                'steps_per_mm': 1
+            },
+            'e': {
+                'steps_per_mm': 1
+            }
+        }
+        queue = PrintQueue(axis_config=axis_config, min_length=2, max_length=3)
+        queue.default_target_speed = 1
+        for i in range(3):
+            queue.add_movement({
+                'type': 'move',
+                'x': i,
+                'y': i
+            }, timeout=0.1)
+        # nobody executes the movements and the execution queue cannot take the rest
+        assert_that(queue.finish(timeout=0.1), equal_to(False))
+        assert_that(queue.planning_list, has_length(2))
+        # the movements stay in the planning list until the queue has room for them
+        for i in range(3):
+            assert_that(queue.finish(timeout=0.1), equal_to(False))
+            queue.next_movement(timeout=0.1)
+            queue.movement_done()
+        assert_that(queue.planning_list, has_length(0))
+        assert_that(queue.finish(timeout=0.1), equal_to(True))
+
     def test_print_queue_calculations(self):
         default_timeout = 0.1
         max_speed_x = 3
@@ -166,48 +246,48 @@ class VectorTests(unittest.TestCase):
                 'f': 10
             })
         last_movement = queue.previous_movement
-        assert_that(last_movement['speed'], not_none())
-        assert_that(last_movement['speed']['x'], not_none())
-        assert_that(last_movement['speed']['x'], less_than_or_equal_to(max_speed_x))
-        assert_that(last_movement['speed']['y'], not_none())
-        assert_that(last_movement['speed']['y'], less_than_or_equal_to(max_speed_y))
-        assert_that(last_movement['speed']['x'], close_to(max_speed_y, 0.01))  # becaus we go 1/1 each time
-        assert_that(last_movement['speed']['y'], close_to(max_speed_y, 0.01))
+        assert_that(last_movement.speed, not_none())
+        assert_that(last_movement.speed.x, not_none())
+        assert_that(last_movement.speed.x, less_than_or_equal_to(max_speed_x))
+        assert_that(last_movement.speed.y, not_none())
+        assert_that(last_movement.speed.y, less_than_or_equal_to(max_speed_y))
+        assert_that(last_movement.speed.x, close_to(max_speed_y, 0.01))  # becaus we go 1/1 each time
+        assert_that(last_movement.speed.y, close_to(max_speed_y, 0.01))
         queue.add_movement({
             'type': 'move',
             'x': 7,
             'y': 6
         })
         last_movement = queue.previous_movement
-        assert_that(last_movement['speed']['x'], less_than_or_equal_to(max_speed_x))
-        assert_that(last_movement['speed']['x'], greater_than(0))
-        assert_that(last_movement['speed']['y'], equal_to(0))
+        assert_that(last_movement.speed.x, less_than_or_equal_to(max_speed_x))
+        assert_that(last_movement.speed.x, greater_than(0))
+        assert_that(last_movement.speed.y, equal_to(0))
         previous_movement = queue.planning_list[-1]
-        assert_that(previous_movement['speed']['x'], less_than(max_speed_x))
-        assert_that(previous_movement['speed']['y'], less_than(max_speed_y))
-        assert_that(previous_movement['y_stop'], equal_to(True))
+        assert_that(previous_movement.speed.x, less_than(max_speed_x))
+        assert_that(previous_movement.speed.y, less_than(max_speed_y))
+        assert_that(previous_movement.y_stop, equal_to(True))
         # we still go on in x - so in thery we can speed up to desired target speed
-        assert_that(last_movement['speed']['x'], greater_than(previous_movement['speed']['x']))
+        assert_that(last_movement.speed.x, greater_than(previous_movement.speed.x))
         previous_movement = queue.planning_list[-3]
-        assert_that(previous_movement['speed']['x'], close_to(max_speed_y, 0.5))  # becaus we go 1/1 each time
-        assert_that(previous_movement['speed']['y'], close_to(max_speed_y, 0.5))
+        assert_that(previous_movement.speed.x, close_to(max_speed_y, 0.5))  # becaus we go 1/1 each time
+        assert_that(previous_movement.speed.y, close_to(max_speed_y, 0.5))
         queue.add_movement({
             'type': 'move',
             'x': 7,
             'y': 7
         })
         last_movement = queue.previous_movement
-        assert_that(last_movement['speed']['x'], equal_to(0))
-        assert_that(last_movement['speed']['y'], greater_than(0))
-        assert_that(last_movement['speed']['y'], less_than(max_speed_y))
+        assert_that(last_movement.speed.x, equal_to(0))
+        assert_that(last_movement.speed.y, greater_than(0))
+        assert_that(last_movement.speed.y, less_than(max_speed_y))
         previous_movement = queue.planning_list[-1]
-        assert_that(previous_movement['speed']['x'], less_than(max_speed_x))
-        assert_that(previous_movement['x_stop'], equal_to(True))
-        assert_that(previous_movement['speed']['y'], less_than(max_speed_y))
-        assert_that(previous_movement['speed']['y'], equal_to(0))
+        assert_that(previous_movement.speed.x, less_than(max_speed_x))
+        assert_that(previous_movement.x_stop, equal_to(True))
+        assert_that(previous_movement.speed.y, less_than(max_speed_y))
+        assert_that(previous_movement.speed.y, equal_to(0))
         previous_movement = queue.planning_list[-4]
-        assert_that(previous_movement['speed']['x'], close_to(max_speed_y, 0.5))  # becaus we go 1/1 each time
-        assert_that(previous_movement['speed']['y'], close_to(max_speed_y, 0.5))
+        assert_that(previous_movement.speed.x, close_to(max_speed_y, 0.5))  # becaus we go 1/1 each time
+        assert_that(previous_movement.speed.y, close_to(max_speed_y, 0.5))
         # let's go back to zero to begin a new test
         queue.add_movement({
             'type': 'move',
@@ -216,10 +296,10 @@ class VectorTests(unittest.TestCase):
         })
         last_movement = queue.previous_movement
         # it is a long go - so we should be able to speed up to full steam
-        assert_that(last_movement['speed']['x'], close_to(-max_speed_x, 0.5))
-        assert_that(last_movement['speed']['y'], equal_to(0))
+        assert_that(last_movement.speed.x, close_to(-max_speed_x, 0.5))
+        assert_that(last_movement.speed.y, equal_to(0))
         previous_movement = queue.planning_list[-1]
-        assert_that(previous_movement['y_stop'], equal_to(True))
+        assert_that(previous_movement.y_stop, equal_to(True))
         queue.add_movement({
             'type': 'move',
             'x': 0,
@@ -227,10 +307,10 @@ class VectorTests(unittest.TestCase):
         })
         last_movement = queue.previous_movement
         # it is a long go - so we should be able to speed up to full steam
-        assert_that(last_movement['speed']['x'], equal_to(0))
-        assert_that(last_movement['speed']['y'], close_to(-max_speed_y, 0.5))
+        assert_that(last_movement.speed.x, equal_to(0))
+        assert_that(last_movement.speed.y, close_to(-max_speed_y, 0.5))
         previous_movement = queue.planning_list[-1]
-        assert_that(previous_movement['x_stop'], equal_to(True))
+        assert_that(previous_movement.x_stop, equal_to(True))
         # speed up
         for i in range(4):
             queue.add_movement({
@@ -239,8 +319,8 @@ class VectorTests(unittest.TestCase):
                 'y': i + 1,
             })
         last_movement = queue.previous_movement
-        assert_that(last_movement['speed']['x'], close_to(max_speed_y, 0.01))  # becaus we go 1/1 each time
-        assert_that(last_movement['speed']['y'], close_to(max_speed_y, 0.01))
+        assert_that(last_movement.speed.x, close_to(max_speed_y, 0.01))  # becaus we go 1/1 each time
+        assert_that(last_movement.speed.y, close_to(max_speed_y, 0.01))
         # and check if we can do a full stop
         queue.add_movement({
             'type': 'move',
@@ -248,19 +328,19 @@ class VectorTests(unittest.TestCase):
             'y': 3
         })
         last_movement = queue.previous_movement
-        assert_that(last_movement['speed']['x'], less_than(0))
-        assert_that(last_movement['speed']['x'], greater_than(-max_speed_x))
-        assert_that(last_movement['speed']['y'], less_than(0))
-        assert_that(last_movement['speed']['y'], greater_than(-max_speed_y))
+        assert_that(last_movement.speed.x, less_than(0))
+        assert_that(last_movement.speed.x, greater_than(-max_speed_x))
+        assert_that(last_movement.speed.y, less_than(0))
+        assert_that(last_movement.speed.y, greater_than(-max_speed_y))
         previous_movement = queue.planning_list[-1]
-        assert_that(previous_movement['speed']['x'], less_than(max_speed_x))
-        assert_that(previous_movement['speed']['y'], less_than(max_speed_y))
-        assert_that(previous_movement['y_stop'], equal_to(True))
-        assert_that(previous_movement['x_stop'], equal_to(True))
+        assert_that(previous_movement.speed.x, less_than(max_speed_x))
+        assert_that(previous_movement.speed.y, less_than(max_speed_y))
+        assert_that(previous_movement.y_stop, equal_to(True))
+        assert_that(previous_movement.x_stop, equal_to(True))
         another_previous_movement = queue.planning_list[-3]
-        assert_that(another_previous_movement['speed']['x'],
-                    greater_than(previous_movement['speed']['x']))  # becaus we stopped to turn around
-        assert_that(another_previous_movement['speed']['y'], greater_than(previous_movement['speed']['x']))
+        assert_that(another_previous_movement.speed.x,
+                    greater_than(previous_movement.speed.x))  # becaus we stopped to turn around
+        assert_that(another_previous_movement.speed.y, greater_than(previous_movement.speed.x))
 
 
     def test_vector_math(self):
@@ -439,70 +519,58 @@ class VectorTests(unittest.TestCase):
         assert_that(queue.planning_list, has_length(12))
         planned_list = queue.planning_list
 
-        assert_that(planned_list[1]['speed']['x'], equal_to(max_speed))
-        assert_that(planned_list[0]['speed']['x'], greater_than(0))
-        assert_that(planned_list[0]['speed']['x'], less_than(planned_list[1]['speed']['x']))
-        assert_that(planned_list[3]['speed']['x'], less_than(planned_list[1]['speed']['x']))
-        assert_that(planned_list[3]['speed']['x'], equal_to(planned_list[0]['speed']['x']))
-        assert_that(planned_list[3]['speed']['x'], greater_than(0))
+        assert_that(planned_list[1].speed.x, equal_to(max_speed))
+        assert_that(planned_list[0].speed.x, greater_than(0))
+        assert_that(planned_list[0].speed.x, less_than(planned_list[1].speed.x))
+        assert_that(planned_list[3].speed.x, less_than(planned_list[1].speed.x))
+        assert_that(planned_list[3].speed.x, equal_to(planned_list[0].speed.x))
+        assert_that(planned_list[3].speed.x, greater_than(0))
         for i in range(0, 3):
-            assert_that(planned_list[i]['delta_y'], equal_to(0))
-            assert_that(planned_list[i]['speed']['y'], equal_to(0))
-            assert_that(planned_list[i]['speed']['x'], greater_than(0))
+            assert_that(planned_list[i].delta_y, equal_to(0))
+            assert_that(planned_list[i].speed.y, equal_to(0))
+            assert_that(planned_list[i].speed.x, greater_than(0))
 
-        try:
-            assert_that(planned_list[2]['x_stop'], not (equal_to(True)))
-        except KeyError:
-            pass  # ok, this is enough - it should just not be true
-        assert_that(planned_list[3]['x_stop'], equal_to(True))
-
-        assert_that(planned_list[4]['speed']['y'], equal_to(max_speed))
-        assert_that(planned_list[3]['speed']['y'], greater_than(0))
-        assert_that(planned_list[3]['speed']['y'], less_than(planned_list[4]['speed']['y']))
-        assert_that(planned_list[6]['speed']['y'], less_than(planned_list[4]['speed']['y']))
-        assert_that(planned_list[6]['speed']['y'], greater_than(0))
-        assert_that(planned_list[6]['speed']['y'], equal_to(planned_list[3]['speed']['y']))
-        assert_that(planned_list[3]['delta_x'], equal_to(1))
+        assert_that(planned_list[2].x_stop, equal_to(False))
+        assert_that(planned_list[3].x_stop, equal_to(True))
+
+        assert_that(planned_list[4].speed.y, equal_to(max_speed))
+        assert_that(planned_list[3].speed.y, greater_than(0))
+        assert_that(planned_list[3].speed.y, less_than(planned_list[4].speed.y))
+        assert_that(planned_list[6].speed.y, less_than(planned_list[4].speed.y))
+        assert_that(planned_list[6].speed.y, greater_than(0))
+        assert_that(planned_list[6].speed.y, equal_to(planned_list[3].speed.y))
+        assert_that(planned_list[3].delta_x, equal_to(1))
 
         for i in range(4, 5):
-            assert_that(planned_list[i]['delta_x'], equal_to(0))
-            assert_that(planned_list[i]['speed']['x'], equal_to(0))
-            assert_that(planned_list[i]['speed']['y'], greater_than(0))
+            assert_that(planned_list[i].delta_x, equal_to(0))
+            assert_that(planned_list[i].speed.x, equal_to(0))
+            assert_that(planned_list[i].speed.y, greater_than(0))
 
-        try:
-            assert_that(planned_list[5]['y_stop'], not (equal_to(True)))
-        except KeyError:
-            pass  # ok, this is enough - it should just not be true
-        assert_that(planned_list[6]['y_stop'], equal_to(True))
-
-        assert_that(planned_list[7]['speed']['x'], equal_to(-max_speed))
-        assert_that(planned_list[6]['speed']['x'], less_than(0))
-        assert_that(planned_list[6]['speed']['x'], greater_than(planned_list[7]['speed']['x']))
-        assert_that(planned_list[8]['speed']['x'], greater_than(planned_list[7]['speed']['x']))
-        assert_that(planned_list[8]['speed']['x'], less_than(0))
-        assert_that(planned_list[8]['delta_x'], equal_to(-2))
-        assert_that(planned_list[8]['x_stop'], equal_to(True))
+        assert_that(planned_list[5].y_stop, equal_to(False))
+        assert_that(planned_list[6].y_stop, equal_to(True))
+
+        assert_that(planned_list[7].speed.x, equal_to(-max_speed))
+        assert_that(planned_list[6].speed.x, less_than(0))
+        assert_that(planned_list[6].speed.x, greater_than(planned_list[7].speed.x))
+        assert_that(planned_list[8].speed.x, greater_than(planned_list[7].speed.x))
+        assert_that(planned_list[8].speed.x, less_than(0))
+        assert_that(planned_list[8].delta_x, equal_to(-2))
+        assert_that(planned_list[8].x_stop, equal_to(True))
 
         for i in range(7, 8):
-            assert_that(planned_list[i]['delta_y'], equal_to(0))
-            assert_that(planned_list[i]['speed']['y'], equal_to(0))
+            assert_that(planned_list[i].delta_y, equal_to(0))
+            assert_that(planned_list[i].speed.y, equal_to(0))
 
-        try:
-            assert_that(planned_list[7]['x_stop'], not (equal_to(True)))
-        except KeyError:
-            pass  # ok, this is enough - it should just not be true
-        assert_that(planned_list[8]['x_stop'], equal_to(True))
+        assert_that(planned_list[7].x_stop, equal_to(False))
+        assert_that(planned_list[8].x_stop, equal_to(True))
 
         for i in range(9, 10):
-            assert_that(planned_list[i]['delta_x'], equal_to(0))
-            assert_that(planned_list[i]['speed']['x'], equal_to(0))
-            assert_that(planned_list[i]['speed']['y'], less_than(0))
+            assert_that(planned_list[i].delta_x, equal_to(0))
+            assert_that(planned_list[i].speed.x, equal_to(0))
+            assert_that(planned_list[i].speed.y, less_than(0))
 
-        try:
-            assert_that(planned_list[10]['y_stop'], not (equal_to(True)))
-        except KeyError:
-            pass  # ok, this is enough - it should just not be true
-        assert_that(planned_list[11]['y_stop'], equal_to(True))
+        assert_that(planned_list[10].y_stop, equal_to(False))
+        assert_that(planned_list[11].y_stop, equal_to(True))
 
         # ok so far so good - but let's see if this is correctly converted to a motion
         printer = Printer(serial_port="none", reset_pin="X")
@@ -524,10 +592,10 @@ class VectorTests(unittest.TestCase):
         for movement in planned_list:
             nr_of_commands += 1
             step_pos, step_speed_vector = printer._add_movement_calculations(movement)
-            assert_that(step_pos['x'], equal_to(movement['x'] * 7))
-            assert_that(step_pos['y'], equal_to(movement['y'] * 11))
-            assert_that(step_speed_vector['x'], equal_to(int(movement['speed']['x'] * 7)))
-            assert_that(step_speed_vector['y'], equal_to(int(movement['speed']['y'] * 11)))
+            assert_that(step_pos['x'], equal_to(movement.x * 7))
+            assert_that(step_pos['y'], equal_to(movement.y * 11))
+            assert_that(step_speed_vector['x'], equal_to(int(movement.speed.x * 7)))
+            assert_that(step_speed_vector['y'], equal_to(int(movement.speed.y * 11)))
             x_move_config, y_move_config, z_move_config, e_move_config = printer._generate_move_config(movement,
                                                                                                        step_pos,
                                                                                                        step_speed_vector)
@@ -535,15 +603,15 @@ class VectorTests(unittest.TestCase):
                 assert_that(x_move_config['motor'], equal_to(0))
                 assert_that(x_move_config['acceleration'], equal_to(1))
                 assert_that(x_move_config['startBow'], equal_to(7))
-                assert_that(x_move_config['target'], equal_to(movement['x'] * 7))
-                assert_that(x_move_config['speed'], equal_to(abs(int(movement['speed']['x'] * 7))))
+                assert_that(x_move_config['target'], equal_to(movement.x * 7))
+                assert_that(x_move_config['speed'], equal_to(abs(int(movement.speed.x * 7))))
 
             if y_move_config:
                 assert_that(y_move_config['motor'], equal_to(1))
                 assert_that(y_move_config['acceleration'], equal_to(2))
                 assert_that(y_move_config['startBow'], equal_to(11))
-                assert_that(y_move_config['target'], equal_to(movement['y'] * 11))
-                assert_that(y_move_config['speed'], equal_to(abs(int(movement['speed']['y'] * 11))))
+                assert_that(y_move_config['target'], equal_to(movement.y * 11))
+                assert_that(y_move_config['speed'], equal_to(abs(int(movement.speed.y * 11))))
             # #collect the move configs for later analyisis
             move_configs.append({
                 'x': x_move_config,
@@ -0,0 +1,111 @@
+from Queue import Full
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to, greater_than, less_than, less_than_or_equal_to, none, close_to
+from t_bone.simulated_hardware import install_hardware_shims
+install_hardware_shims()
+from t_bone.printer import PrintQueue
+from t_bone.queue_sizing import QueueSizer
+
+__author__ = 'marcus'
+
+_axis_config = {
+    'x': {
+        'max_acceleration': 1,
+        'max_speed': 1,
+        'bow': 1,
+        'steps_per_mm': 1
+    },
+    'y': {
+        'max_acceleration': 1,
+        'max_speed': 1,
+        'bow': 1,
+        'steps_per_mm': 1
+    },
+    'z': {
+        'steps_per_mm': 1
+    },
+    'e': {
+        'steps_per_mm': 1
+    }
+}
+
+
+class QueueSizerTests(unittest.TestCase):
+    def setUp(self):
+        self.sizer = QueueSizer(20, smallest_window=10, largest_window=200, buffer_time=2.0, rate_window=2.0)
+        self.sizer.start(20)
+        self.now = time.time()
+        self.moves = 0
+
+    def _run(self, seconds, moves_per_second, queue_length=30, motors_per_move=2):
+        # the host keeps the queue at the same length - everything it adds is executed
+        window_lengths = []
+        for step in range(int(seconds * 10)):
+            self.now += 0.1
+            self.moves += moves_per_second / 10.0
+            window_length = self.sizer.queue_reported(queue_length, int(self.moves), int(self.moves) * motors_per_move,
+                                                      now=self.now)
+            if window_length:
+                window_lengths.append(window_length)
+        return window_lengths
+
+    def test_execution_rate(self):
+        assert_that(self.sizer.execution_rate(), none())
+        self._run(3, 50)
+        assert_that(self.sizer.execution_rate(), close_to(50, 1))
+
+    def test_short_moves_get_a_longer_window(self):
+        window_lengths = self._run(10, 50)
+        # 2s of 50 moves/s
+        assert_that(self.sizer.window_length, greater_than(80))
+        assert_that(self.sizer.window_length, less_than_or_equal_to(100))
+        assert_that(window_lengths, equal_to(sorted(window_lengths)))
+
+    def test_long_moves_get_a_shorter_window(self):
+        self._run(10, 2)
+        assert_that(self.sizer.window_length, less_than(15))
+        assert_that(self.sizer.window_length, greater_than(9))
+
+    def test_slow_host_does_not_grow_the_window(self):
+        # 20 moves/s are not enough for a longer window
+        self.sizer.move_planned(0.05)
+        assert_that(self._run(10, 50), equal_to([]))
+        assert_that(self.sizer.window_length, equal_to(20))
+
+    def test_stopped_machine(self):
+        self._run(3, 0)
+        assert_that(self.sizer.window_length, equal_to(20))
+
+
+class PrintQueueResizeTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = PrintQueue(axis_config=_axis_config, min_length=4, max_length=8)
+        self.queue.default_target_speed = 1
+
+    def _add(self, count, timeout=None):
+        for i in range(count):
+            self.queue.add_movement({'type': 'move', 'x': i, 'y': i, 'f': 1}, timeout=timeout)
+
+    def test_shrinking(self):
+        self._add(4)
+        assert_that(len(self.queue.planning_list), equal_to(3))
+        self.queue.resize(3)
+        assert_that(self.queue.queue.maxsize, equal_to(3))
+        self._add(1, 0.01)
+        # the moves beyond the window went to the execution queue at once
+        assert_that(len(self.queue.planning_list), equal_to(2))
+        assert_that(self.queue.queue.qsize(), equal_to(2))
+
+    def test_growing(self):
+        self._add(8)
+        self.assertRaises(Full, self._add, 1, 0.01)
+        self.queue.resize(8)
+        assert_that(self.queue.queue.maxsize, equal_to(8))
+        self._add(8, 0.01)
+        assert_that(len(self.queue.planning_list), equal_to(7))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to, less_than, greater_than, close_to
+from t_bone.simulated_hardware import hardware, install_hardware_shims, SimulatedHeater, reading_for_temperature
+install_hardware_shims()
+from t_bone.simulation import SimulatedFirmware, SimulatedSerialPort, SimulatedPty
+from t_bone.machine import Machine
+from t_bone.thermistors import get_thermistor
+
+__author__ = 'marcus'
+
+
+def _move(motor, target, speed=100000.0):
+    return [{
+        'motor': motor,
+        'target': target,
+        'type': 'way',
+        'speed': speed,
+        'acceleration': 1000.0,
+        'startBow': 10000
+    }]
+
+
+class SimulatedFirmwareTests(unittest.TestCase):
+    def setUp(self):
+        self.firmware = SimulatedFirmware(queue_length=10)
+        self.firmware.start()
+
+    def tearDown(self):
+        self.firmware.stop()
+
+    def _replies(self):
+        time.sleep(0.01)
+        return [reply for reply in self.firmware.read(10000).split(";\r\n") if reply and not reply.startswith("-128")]
+
+    def test_unknown_commands(self):
+        self.firmware.receive("99,1;")
+        assert_that(self._replies(), equal_to(["-9,U,99"]))
+
+    def test_queue_overflow(self):
+        for move in range(11):
+            self.firmware.receive("10,1,%s,119,1000,100,100;" % (move * 100))
+        replies = self._replies()
+        assert_that(replies[9], equal_to("0,10,10,-1"))
+        assert_that(replies[10], equal_to("-9,-100"))
+        # nothing is executed without motion
+        assert_that(self.firmware.queue_count, equal_to(10))
+
+    def test_moves_take_their_time(self):
+        self.firmware.receive("11,1,0;")
+        # 5000 steps at 50000 steps/s
+        for move in range(6):
+            self.firmware.receive("10,1,%s,119,50000,100,100;" % ((move + 1) * 5000))
+        time.sleep(0.2)
+        # the last 5 moves stay in the queue until the motion finishes
+        assert_that(self.firmware.moves_executed, equal_to(1))
+        assert_that(self.firmware.position(1), close_to(5000, 1))
+        self.firmware.receive("11,-1;")
+        time.sleep(0.25)
+        assert_that(self.firmware.moves_executed, less_than(6))
+        assert_that(self.firmware.position(1), greater_than(5000))
+        time.sleep(0.5)
+        assert_that(self.firmware.moves_executed, equal_to(6))
+        assert_that(self.firmware.position(1), equal_to(30000))
+        self.firmware.receive("11,0;")
+        assert_that(self._replies()[-1], equal_to("11,-1"))
+
+    def test_reset(self):
+        self.firmware.receive("11,1,0;10,1,5000,119,10000,100,100;")
+        self.firmware.reset()
+        assert_that(self.firmware.queue_count, equal_to(0))
+        # it says hello after the reset
+        assert_that(self.firmware.read(10000), equal_to("-128,0,10;\r\n"))
+
+
+class SimulatedMachineTests(unittest.TestCase):
+    def setUp(self):
+        self.firmware = SimulatedFirmware(time_scale=0.01)
+        self.firmware.start()
+        self.machine = Machine(serial_port="simulated", reset_pin="P9_12")
+        self.machine._open_serial = lambda: SimulatedSerialPort(self.firmware, timeout=0.1)
+        hardware.on_rising_edge("P9_12", self.firmware.reset)
+
+    def tearDown(self):
+        self.machine.disconnect()
+        self.firmware.stop()
+
+    def test_print(self):
+        self.machine.connect()
+        assert_that(self.machine.binary_moves_supported, equal_to(True))
+        self.machine.start_motion()
+        for move in range(100):
+            self.machine.move_to(_move(1, move * 1000))
+        self.machine.finish_motion()
+        end = time.time() + 5
+        while self.firmware.moves_executed < 100 and time.time() < end:
+            time.sleep(0.05)
+        assert_that(self.firmware.moves_executed, equal_to(100))
+        assert_that(self.machine.read_positon(1), equal_to(99000))
+        assert_that(self.machine.read_axes_status([1, 2])[1]['position'], equal_to(99000))
+
+    def test_reset_pin_resets_the_firmware(self):
+        self.machine.connect(soft_connect=False)
+        assert_that(self.firmware.commands_received, equal_to(1))
+
+    def test_pseudo_terminal(self):
+        simulated_pty = SimulatedPty(self.firmware)
+        try:
+            self.machine.serial_port = simulated_pty.port
+            del self.machine._open_serial
+            self.machine.connect()
+            assert_that(self.machine.read_positon(2), equal_to(0))
+        finally:
+            self.machine.disconnect()
+            simulated_pty.close()
+
+
+class SimulatedHardwareTests(unittest.TestCase):
+    def test_reading_for_temperature(self):
+        for name in ("epcos-100k", "B57560G104F"):
+            thermistor = get_thermistor(name)
+            for temperature in (25.0, 100.0, 220.0):
+                assert_that(thermistor.convert(reading_for_temperature(thermistor, temperature)),
+                            close_to(temperature, 1.0))
+
+    def test_heater(self):
+        heater = hardware.add_heater("P9_14", "P9_39", SimulatedHeater("epcos-100k", heating_rate=1000.0))
+        from Adafruit_BBIO import ADC, PWM
+
+        cold = get_thermistor("epcos-100k").convert(ADC.read("P9_39"))
+        PWM.start("P9_14", 100.0, 1000, 0)
+        time.sleep(0.1)
+        PWM.stop("P9_14")
+        assert_that(get_thermistor("epcos-100k").convert(ADC.read("P9_39")), greater_than(cold + 20))
+        assert_that(heater.power, equal_to(0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to, greater_than, greater_than_or_equal_to, less_than_or_equal_to, close_to
+from t_bone.simulated_hardware import install_hardware_shims
+install_hardware_shims()
+from t_bone.simulation import SimulatedFirmware, SimulatedSerialPort
+from t_bone.machine import Machine
+from t_bone.metrics import metrics
+from t_bone.starvation import StarvationDetector
+
+__author__ = 'marcus'
+
+
+class StarvationDetectorTests(unittest.TestCase):
+    def setUp(self):
+        self.host_queues = (10, 2, 1)
+        self.detector = StarvationDetector(lambda: self.host_queues, starved_queue_length=5)
+        metrics.reset()
+
+    def test_start_of_the_print_is_no_starvation(self):
+        self.detector.start()
+        for queue_length in (0, 2, 4, 5):
+            self.detector.queue_reported(queue_length, 40)
+        summary = self.detector.finish()
+        assert_that(summary['starvations'], equal_to(0))
+        assert_that(summary['printing'], equal_to(False))
+
+    def test_starvations(self):
+        self.detector.start()
+        self.detector.queue_reported(20, 40)
+        self.detector.queue_reported(5, 40)
+        # it is still the same starvation
+        self.detector.queue_reported(0, 40)
+        time.sleep(0.05)
+        self.detector.queue_reported(10, 40)
+        self.host_queues = (0, 0, 0)
+        self.detector.queue_reported(3, 40)
+        summary = self.detector.finish()
+        assert_that(summary['starvations'], equal_to(2))
+        assert_that(summary['longest_starvation'], greater_than(0.04))
+        events = summary['events']
+        assert_that(len(events), equal_to(2))
+        assert_that(events[0]['queue_length'], equal_to(5))
+        assert_that(events[0]['planning_queue_length'], equal_to(10))
+        assert_that(events[0]['execution_queue_length'], equal_to(2))
+        assert_that(events[0]['commands_in_flight'], equal_to(1))
+        assert_that(events[0]['duration'], close_to(0.05, 0.04))
+        assert_that(events[1]['execution_queue_length'], equal_to(0))
+        # the last one lasted until the print has ended
+        assert_that(events[1]['duration'], less_than_or_equal_to(summary['starved_time']))
+        # nothing is watched after the print
+        self.detector.queue_reported(20, 40)
+        self.detector.queue_reported(0, 40)
+        assert_that(self.detector.summary()['starvations'], equal_to(2))
+
+    def test_slow_stage(self):
+        self.detector.start()
+        self.detector.queue_reported(20, 40)
+        metrics.histogram('gcode_parse_seconds').observe(0.01)
+        metrics.histogram('planner_recalculation_seconds').observe(0.2)
+        self.detector.queue_reported(2, 40)
+        summary = self.detector.finish()
+        assert_that(summary['events'][0]['slow_stage'], equal_to('planning'))
+        assert_that(summary['slow_stages'], equal_to({'planning': 1}))
+
+    def test_reset_metrics(self):
+        self.detector.start()
+        metrics.histogram('planner_recalculation_seconds').observe(0.2)
+        self.detector.queue_reported(20, 40)
+        # e.g. a POST to /metrics/reset during the print
+        metrics.reset()
+        metrics.histogram('gcode_parse_seconds').observe(0.01)
+        self.detector.queue_reported(2, 40)
+        metrics.histogram('gcode_parse_seconds').observe(0.01)
+        self.detector.queue_reported(10, 40)
+        self.detector.queue_reported(2, 40)
+        summary = self.detector.finish()
+        assert_that(summary['events'][0]['slow_stage'], equal_to(None))
+        assert_that(summary['events'][1]['slow_stage'], equal_to('parsing'))
+        for event in summary['events']:
+            for stage_time in (event['stage_times'] or {}).values():
+                assert_that(stage_time, greater_than_or_equal_to(0))
+
+    def test_a_new_print_starts_over(self):
+        self.detector.start()
+        self.detector.queue_reported(20, 40)
+        self.detector.queue_reported(2, 40)
+        self.detector.finish()
+        self.detector.start()
+        assert_that(self.detector.summary()['starvations'], equal_to(0))
+        assert_that(self.detector.summary()['events'], equal_to([]))
+
+
+class MachineStarvationTests(unittest.TestCase):
+    def setUp(self):
+        self.firmware = SimulatedFirmware()
+        self.firmware.start()
+        self.machine = Machine(serial_port="simulated", reset_pin="P9_12")
+        self.machine._open_serial = lambda: SimulatedSerialPort(self.firmware, timeout=0.1)
+        self.machine.connect()
+        self.detector = StarvationDetector(lambda: (0, 0, self.machine.commands_in_flight))
+        self.machine.queue_listeners.append(self.detector.queue_reported)
+
+    def tearDown(self):
+        self.machine.disconnect()
+        self.firmware.stop()
+
+    def _move(self, move):
+        # 10ms each
+        self.machine.move_to([{'motor': 1, 'target': move * 10, 'type': 'way', 'speed': 1000.0,
+                               'acceleration': 1000.0, 'startBow': 10000}])
+
+    def test_slow_host(self):
+        self.machine.start_motion()
+        self.detector.start()
+        for move in range(30):
+            self._move(move)
+        # the host does not send anything for a while
+        time.sleep(0.6)
+        for move in range(30, 40):
+            self._move(move)
+        summary = self.detector.finish()
+        self.machine.finish_motion()
+        assert_that(self.firmware.underruns, greater_than(0))
+        # while the queue fills up again it may run dry once more
+        assert_that(summary['starvations'], greater_than(0))
+        longest = max(summary['events'], key=lambda event: event['duration'])
+        assert_that(longest['queue_length'], less_than_or_equal_to(5))
+        assert_that(longest['duration'], greater_than(0.2))
+        assert_that(summary['longest_starvation'], equal_to(longest['duration']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+from threading import Condition, Timer
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to, less_than, greater_than
+from t_bone.status_sampler import StatusSampler, StatusStream, status_changes
+
+__author__ = 'marcus'
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.internal_queue_length = "0"
+        self.internal_queue_max_length = "40"
+        self._keep_alive = Condition()
+
+    def keep_alive(self, queue_length):
+        with self._keep_alive:
+            self.internal_queue_length = str(queue_length)
+            self._keep_alive.notify_all()
+
+    def wait_for_keep_alive(self, timeout):
+        with self._keep_alive:
+            queue_length = self.internal_queue_length
+            self._keep_alive.wait(timeout)
+            return queue_length != self.internal_queue_length
+
+
+class FakeMachine(object):
+    def __init__(self):
+        self.machine_connection = FakeConnection()
+
+
+class FakeHeater(object):
+    def __init__(self, temperature):
+        self.temperature = temperature
+
+    def get_set_temperature(self):
+        return 200.0
+
+
+class FakePrinter(object):
+    def __init__(self):
+        self.machine = FakeMachine()
+        self.printing = False
+        self.extruder_heater = FakeHeater(180.0)
+        self.heated_bed = None
+        self.status_reads = 0
+
+    def read_axis_status(self):
+        self.status_reads += 1
+        return {'x': {'position': self.status_reads}}
+
+
+class StatusSamplerTests(unittest.TestCase):
+    def setUp(self):
+        self.printer = FakePrinter()
+        self.sampler = StatusSampler(self.printer, sample_interval=0.2)
+
+    def tearDown(self):
+        self.sampler.stop()
+        if self.sampler.isAlive():
+            self.sampler.join()
+
+    def test_snapshot_without_sampling_thread(self):
+        snapshot = self.sampler.snapshot()
+        assert_that(snapshot.extruder_temperature, equal_to(180.0))
+        assert_that(snapshot.axis_status, equal_to({'x': {'position': 1}}))
+        assert_that(snapshot.bed_temperature, equal_to(None))
+        # it is not sampled again for every request
+        for request in range(10):
+            assert_that(self.sampler.snapshot(), equal_to(snapshot))
+        assert_that(self.printer.status_reads, equal_to(1))
+        assert_that(self.sampler.age(snapshot), less_than(1))
+
+    def test_sampling_is_rate_limited(self):
+        self.sampler.start()
+        time.sleep(0.5)
+        for request in range(100):
+            self.sampler.snapshot()
+        assert_that(self.printer.status_reads, less_than(5))
+        assert_that(self.printer.status_reads, greater_than(1))
+
+    def test_keep_alive_updates_the_queue(self):
+        self.sampler.sample_interval = 10
+        self.sampler.queue_sample_interval = 0
+        first_snapshot = self.sampler.snapshot()
+        self.sampler.start()
+        time.sleep(0.05)
+        self.printer.machine.machine_connection.keep_alive(12)
+        time.sleep(0.05)
+        snapshot = self.sampler.snapshot()
+        assert_that(snapshot.queue_length, equal_to(12))
+        # the axis status was not read again
+        assert_that(snapshot.axis_status, equal_to(first_snapshot.axis_status))
+        assert_that(self.printer.status_reads, equal_to(1))
+
+
+    def test_keep_alive_updates_are_rate_limited(self):
+        self.sampler.sample_interval = 10
+        self.sampler.queue_sample_interval = 0.2
+        self.sampler.snapshot()
+        published = []
+        publish = self.sampler._publish
+        self.sampler._publish = lambda snapshot: (published.append(snapshot), publish(snapshot))
+        self.sampler.start()
+        # a ping every 10ms for half a second
+        for queue_length in range(1, 51):
+            self.printer.machine.machine_connection.keep_alive(queue_length)
+            time.sleep(0.01)
+        assert_that(len(published), less_than(5))
+        # the last ping is published too - just a bit later
+        time.sleep(0.3)
+        assert_that(self.sampler.snapshot().queue_length, equal_to(50))
+
+class StatusStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.sampler = StatusSampler(FakePrinter())
+        self.stream = StatusStream(self.sampler, None, history_length=3)
+        self.stream.active = True
+
+    def test_status_changes(self):
+        old_status = {'printing': False, 'axis_status': {'x': {'position': 1, 'left_endstop': False}},
+                      'lines_printed': 10}
+        new_status = {'printing': False, 'axis_status': {'x': {'position': 2, 'left_endstop': False}}}
+        assert_that(status_changes(old_status, new_status),
+                    equal_to({'axis_status': {'x': {'position': 2}}, 'lines_printed': None}))
+        assert_that(status_changes(new_status, dict(new_status)), equal_to({}))
+        assert_that(status_changes(None, new_status), equal_to(new_status))
+
+    def test_changes_since(self):
+        self.stream.update({'temperature': 20, 'axis_status': {'x': {'position': 1}, 'y': {'position': 1}}})
+        self.stream.update({'temperature': 20, 'axis_status': {'x': {'position': 2}, 'y': {'position': 1}}})
+        # nothing changed - nothing to send
+        self.stream.update({'temperature': 20, 'axis_status': {'x': {'position': 2}, 'y': {'position': 1}}})
+        self.stream.update({'temperature': 21, 'axis_status': {'x': {'position': 2}, 'y': {'position': 3}}})
+        assert_that(self.stream.sequence, equal_to(3))
+        assert_that(self.stream.changes_since(1),
+                    equal_to((3, {'temperature': 21, 'axis_status': {'x': {'position': 2}, 'y': {'position': 3}}},
+                              False)))
+        assert_that(self.stream.changes_since(3), equal_to((3, None, False)))
+        # new clients & clients we do not know get everything
+        assert_that(self.stream.changes_since(None), equal_to((3, self.stream.status, True)))
+        assert_that(self.stream.changes_since(17), equal_to((3, self.stream.status, True)))
+        # the history is not changed by merging it
+        assert_that(self.stream.changes_since(2), equal_to((3, {'temperature': 21, 'axis_status': {
+            'y': {'position': 3}}}, False)))
+
+    def test_event_ids(self):
+        assert_that(self.stream.sequence_of(self.stream.event_id(2)), equal_to(2))
+        assert_that(self.stream.sequence_of(None), equal_to(None))
+        assert_that(self.stream.sequence_of("2"), equal_to(None))
+        # a restarted server has a new stream - its sequence starts at 1 again
+        restarted_stream = StatusStream(self.sampler, None)
+        assert_that(restarted_stream.sequence_of(self.stream.event_id(2)), equal_to(None))
+
+    def test_events(self):
+        self.stream.update({'temperature': 20})
+        events = self.stream.events(timeout=0.2)
+        assert_that(next(events), equal_to((1, {'temperature': 20}, True)))
+        # nothing happens
+        assert_that(next(events), equal_to((1, None, False)))
+        Timer(0.05, self.stream.update, ({'temperature': 21},)).start()
+        assert_that(next(events), equal_to((2, {'temperature': 21}, False)))
+        self.stream.stop()
+        assert_that(list(events), equal_to([]))
+
+
+if __name__ == '__main__':
+    unittest.main()